@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+"""
+.. module:: background_sweep
+   :platform: Windows
+   :synopsis: SNIP/polycap parameter sweeps scored against M4 net ROI sums
+
+Created on Mon Oct 19 2026
+
+"""
+#
+
+############################
+#  20261019
+#
+#  The SNIP (FWHM, NREDUC, NITER) and polycap (number of points) settings of
+#  the background removal are scored against the net ROI sums exported by
+#  the M4 software (*_M4_net_roi.txt*).  The energy window of each M4 ROI is
+#  not exported, but the gross ROI sums (*_M4_sum_roi.txt*) are: the window
+#  is recovered as the channel range whose raw counts give those sums,
+#  separately for each detector calibration.
+#
+#  For the sweep, everything that does not depend on the parameters (pile-up
+#  correction, resampling to the square root energy axis) is done once per
+#  spectrum.  SNIPFASTBATCH then strips every (spectrum, SNIP setting) pair
+#  as one row of a 2D array, in blocks of rows small enough to stay in the
+#  processor cache, spread over a process pool.  All polycap settings are
+#  applied to each block before the net ROI sums are taken.
+#
+###########################
+#
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+from os import path
+import numpy as np
+import pandas as pd
+import bruker_io as bruker_io
+import spectrum_stack as spectrum_stack
+import spectrum_evaluation as spectrum_evaluation
+
+SNIP_PARAMETERS = ['FWHM', 'NREDUC', 'NITER']
+POLYCAP_PARAMETERS = ['number_of_points']
+
+
+def element_columns(table):
+    """element columns of an M4 export (all but Spectrum and the name
+    columns added by bruker_io.spectrum_name_columns)"""
+    return [column for column in table.columns
+            if column not in ('Spectrum', 'stem', 'detector', 'row', 'col')]
+
+
+def match_spectra(stack, table):
+    """ index arrays (i_stack, i_table) of the spectra of *stack* found in
+    the Spectrum column of an M4 export """
+    rows = {name: i for i, name in enumerate(table['Spectrum'])}
+    index_stack = []
+    index_table = []
+    for i, file_name in enumerate(stack.file_names):
+        name = path.splitext(path.basename(file_name))[0]
+        if name in rows:
+            index_stack.append(i)
+            index_table.append(rows[name])
+    return np.array(index_stack, dtype=int), np.array(index_table, dtype=int)
+
+
+def _single_axis(stack):
+    if not (np.all(stack.calibration_abs == stack.calibration_abs[0])
+            and np.all(stack.calibration_lin == stack.calibration_lin[0])):
+        raise ValueError('the spectra must share one energy axis, see '
+                         'spectrum_stack.rebin_stack')
+
+
+def roi_windows(stack, sum_roi, elements=None,
+                lines=spectrum_evaluation.XRF_LINES, search=60):
+    """ Function recovering the channel window of each M4 ROI
+
+    Parameters
+    ----------
+
+    stack : spectrum_stack.SpectrumStack
+        raw spectra on one energy axis
+    sum_roi : pandas.DataFrame
+        M4 gross ROI sums of the same spectra (bruker_io.m4_sum_roi_import)
+    elements : list of str [None]
+        ROIs to recover, all element columns by default
+    lines : dict [XRF_LINES]
+        line energies (keV); the window is searched around the Ka line of
+        the element (La when there is no Ka)
+    search : int [60]
+        largest distance (channels) of the window edges from the line
+
+    Returns
+    -------
+
+    pandas.DataFrame indexed by element with the line, the window
+    [first, last) in channels and keV, and the mean relative difference
+    between the raw window sums and the M4 sums (0 for an exact match)
+
+    """
+    _single_axis(stack)
+    index_stack, index_table = match_spectra(stack, sum_roi)
+    if elements is None:
+        elements = element_columns(sum_roi)
+    counts = stack.channels[index_stack].astype(float)
+    cumulative = np.zeros((counts.shape[0], counts.shape[1] + 1))
+    cumulative[:, 1:] = np.cumsum(counts, axis=1)
+    calibration_abs = stack.calibration_abs[0]
+    calibration_lin = stack.calibration_lin[0]
+    windows = []
+    for element in elements:
+        line = element + '_Ka' if element + '_Ka' in lines else element + '_La'
+        centre = int((lines[line]*1000 - calibration_abs)/calibration_lin)
+        first = np.arange(max(centre - search, 0), centre + 1)
+        last = np.arange(centre + 1, min(centre + search, stack.no_channels) + 1)
+        reference = sum_roi[element].values[index_table].astype(float)
+        sums = (cumulative[:, last][:, np.newaxis, :]
+                - cumulative[:, first][:, :, np.newaxis])
+        error = np.mean(np.abs(sums - reference[:, np.newaxis, np.newaxis])
+                        / np.maximum(np.abs(reference), 1)[:, np.newaxis,
+                                                            np.newaxis],
+                        axis=0)
+        best_first, best_last = np.unravel_index(np.argmin(error), error.shape)
+        windows.append((element, line, first[best_first], last[best_last],
+                        error[best_first, best_last]))
+    windows = pd.DataFrame(windows, columns=['element', 'line', 'first',
+                                             'last', 'error'])
+    windows['low keV'] = (calibration_abs
+                          + calibration_lin*(windows['first'] - 0.5))/1000
+    windows['high keV'] = (calibration_abs
+                           + calibration_lin*(windows['last'] - 0.5))/1000
+    return windows.set_index('element')[['line', 'first', 'last', 'low keV',
+                                         'high keV', 'error']]
+
+
+def parameter_grid(FWHM=(9, 11, 13, 15, 17), NREDUC=(5, 10, 20),
+                   NITER=(250, 500, 1000), number_of_points=(20, 30, 40, 50)):
+    """every combination of the given SNIP and polycap settings as a
+    DataFrame with one row per grid point"""
+    return pd.DataFrame(list(itertools.product(FWHM, NREDUC, NITER,
+                                               number_of_points)),
+                        columns=SNIP_PARAMETERS + POLYCAP_PARAMETERS)
+
+
+def _sweep_block(channels, channels_sqrt, energy_scale, energy_scale_sqrt,
+                 snip, knots, first, last, dtype):
+    """ net ROI sums [rows, knots, windows] of one block of (spectrum, SNIP
+    setting) rows for every polycap setting """
+    background = spectrum_evaluation.SNIPFASTBATCH(
+        channels_sqrt, snip[:, 0], snip[:, 1], snip[:, 2], dtype)
+    corrected = spectrum_evaluation.sqrt_axis_restore(
+        channels, energy_scale, energy_scale_sqrt,
+        channels_sqrt - background, dtype)
+    sums = np.zeros((corrected.shape[0], len(knots), len(first)))
+    for k, number_of_points in enumerate(knots):
+        clean = spectrum_evaluation.polycap_corrected(
+            corrected, energy_scale, number_of_points, dtype)
+        cumulative = np.zeros((clean.shape[0], clean.shape[1] + 1))
+        cumulative[:, 1:] = np.cumsum(clean, axis=1)
+        sums[:, k] = cumulative[:, last] - cumulative[:, first]
+    return sums
+
+
+def _stack_sums(stack, windows, snip, knots, pileup, block_rows, executor,
+                dtype):
+    """ net ROI sums [snip setting, spectrum, knots, ROI] of a stack on one
+    energy axis """
+    energy_scale = stack.energy_scale(0)
+    if pileup:
+        arguments = [(channels, energy_scale, life_time_in_ms, shaping_time,
+                      dtype)
+                     for channels, life_time_in_ms, shaping_time
+                     in zip(stack.channels, stack.life_time_in_ms,
+                            stack.shaping_time)]
+        if executor is None:
+            channels = [spectrum_evaluation.pileup_corrected(*argument)
+                        for argument in arguments]
+        else:
+            channels = list(executor.map(spectrum_evaluation.pileup_corrected,
+                                         *zip(*arguments)))
+        channels = np.array(channels, dtype=dtype)
+    else:
+        channels = stack.channels.astype(dtype)
+    resampled = [spectrum_evaluation.sqrt_axis_resample(
+        spectrum, energy_scale, dtype) for spectrum in channels]
+    energy_scale_sqrt = resampled[0][0]
+    channels_sqrt = np.array([spectrum for axis, spectrum in resampled])
+    # rows: every spectrum for each distinct SNIP setting
+    n_spectra = len(stack)
+    row_snip = np.repeat(np.arange(len(snip)), n_spectra)
+    row_spectrum = np.tile(np.arange(n_spectra), len(snip))
+    arguments = []
+    for start in np.arange(0, len(row_snip), block_rows):
+        rows = slice(start, start + block_rows)
+        arguments.append((channels[row_spectrum[rows]],
+                          channels_sqrt[row_spectrum[rows]],
+                          energy_scale, energy_scale_sqrt,
+                          snip[row_snip[rows]], knots,
+                          windows['first'].values, windows['last'].values,
+                          dtype))
+    if executor is None:
+        sums = [_sweep_block(*argument) for argument in arguments]
+    else:
+        sums = list(executor.map(_sweep_block, *zip(*arguments)))
+    return np.concatenate(sums).reshape(len(snip), n_spectra, len(knots),
+                                        len(windows))
+
+
+def sweep_background(stack, net_roi, sum_roi, grid=None, pileup=True,
+                     block_rows=16, processes=None, dtype=None):
+    """ Function scoring background removal settings against M4 net ROIs
+
+    Parameters
+    ----------
+
+    stack : spectrum_stack.SpectrumStack
+        raw spectra; the ROI windows are recovered separately for each
+        energy calibration (i.e. each detector)
+    net_roi : pandas.DataFrame
+        M4 net ROI sums of the same spectra (bruker_io.m4_net_roi_import)
+    sum_roi : pandas.DataFrame
+        M4 gross ROI sums of the same spectra (bruker_io.m4_sum_roi_import),
+        used by roi_windows
+    grid : pandas.DataFrame [None]
+        FWHM, NREDUC, NITER and number_of_points of each grid point,
+        parameter_grid() by default
+    pileup : bool [True]
+        apply the pile-up correction first, as spectra_fit does
+    block_rows : int [16]
+        (spectrum, SNIP setting) rows stripped together
+    processes : int [None]
+        worker processes; None uses all cores, 1 runs in this process
+    dtype : np.dtype [None]
+        working precision, spectrum_stack.PRECISION by default
+
+    Returns
+    -------
+
+    pandas.DataFrame with one row per grid point, best first: the settings,
+    the score (mean over the ROIs of the mean absolute relative difference
+    from the M4 net sums) and that difference for each ROI
+
+    """
+    dtype = spectrum_stack.working_dtype(dtype)
+    if grid is None:
+        grid = parameter_grid()
+    index_stack, index_table = match_spectra(stack, net_roi)
+    stack = stack.subset(index_stack)
+    elements = [element for element in element_columns(net_roi)
+                if element in sum_roi.columns]
+    snip, grid_snip = np.unique(grid[SNIP_PARAMETERS].values, axis=0,
+                                return_inverse=True)
+    knots, grid_knots = np.unique(grid['number_of_points'].values,
+                                  return_inverse=True)
+    calibrations = np.column_stack((stack.calibration_abs,
+                                    stack.calibration_lin))
+    unique_calibrations, group = np.unique(calibrations, axis=0,
+                                           return_inverse=True)
+    group = np.ravel(group)
+    executor = None
+    if processes != 1:
+        executor = ProcessPoolExecutor(max_workers=processes)
+    sums = []
+    references = []
+    try:
+        for i in np.arange(len(unique_calibrations)):
+            members = np.nonzero(group == i)[0]
+            windows = roi_windows(stack.subset(members), sum_roi, elements)
+            sums.append(_stack_sums(stack.subset(members), windows, snip,
+                                    knots, pileup, block_rows, executor,
+                                    dtype))
+            references.append(
+                net_roi[elements].values[index_table[members]].astype(float))
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    # sums[snip setting, spectrum, knots, ROI]
+    sums = np.concatenate(sums, axis=1)
+    reference = np.concatenate(references)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        deviation = np.abs(sums - reference[np.newaxis, :, np.newaxis, :]) \
+            / np.where(reference > 0, reference, np.nan)[np.newaxis, :,
+                                                         np.newaxis, :]
+    deviation = np.nanmean(deviation, axis=1)
+    results = grid.reset_index(drop=True).copy()
+    per_roi = deviation[np.ravel(grid_snip), np.ravel(grid_knots)]
+    results['score'] = np.nanmean(per_roi, axis=1)
+    for i, element in enumerate(elements):
+        results[element] = per_roi[:, i]
+    results = results.sort_values('score').reset_index(drop=True)
+    results.insert(0, 'rank', np.arange(1, len(results) + 1))
+    return results
+
+
+def sweep_exports(sum_roi_file, net_roi_file, grid=None, **options):
+    """ runs sweep_background on the spectra listed in an M4 export pair
+    (*_M4_sum_roi.txt*, *_M4_net_roi.txt*), read from the directory of the
+    exports; *options* are passed on to sweep_background """
+    sum_roi = bruker_io.m4_sum_roi_import(sum_roi_file)
+    net_roi = bruker_io.m4_net_roi_import(net_roi_file)
+    directory_path = path.dirname(net_roi_file)
+    file_names = [path.join(directory_path, name + '.spx')
+                  for name in net_roi['Spectrum']
+                  if path.exists(path.join(directory_path, name + '.spx'))]
+    stack = spectrum_stack.load_spx_stack(file_names)
+    return sweep_background(stack, net_roi, sum_roi, grid, **options)
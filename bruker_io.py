@@ -25,6 +25,11 @@ Created on Fri Apr 26 09:49:43 2019
 #
 import xml.etree.ElementTree as ET
 import re as re
+import io as io
+import os as os
+import hashlib as hashlib
+import weakref as weakref
+from collections import OrderedDict
 from datetime import datetime
 import numpy as np
 
@@ -45,6 +50,11 @@ class FittingData:
 
     **channels:** np.array [4096,]
         assuming 4096 MCA channels (Bruker m4)  EDAX uses 4000 instead
+        (decoded from the file on first access after a lazy
+        bruker_spx_import)
+
+    **channels_offset:** int [None]
+        byte offset of the <Channels> element, set by a lazy import
 
     **data_lines:** str [""]
         dummy string for the parsed lines of an ascii readable file
@@ -120,9 +130,37 @@ class FittingData:
     def __init__(self, file_name):
         """ name of spectrum file imported or exported"""
         self.file_name = file_name
+
+    @property
+    def channels(self):
+        """ channel counts, read from the *.spx* file when first needed """
+        if self._channels is None:
+            bruker_spx_channels_read(self)
+        return self._channels
+
+    @channels.setter
+    def channels(self, channels):
+        # counts set from outside no longer match the file
+        self._channels = channels
+        self.channels_offset = None
+
+    def release_channels(self):
+        """ drops the channel counts of a lazily imported spectrum; they are
+        decoded again on the next access.  Counts changed in place since they
+        were decoded are kept, and the spectrum is no longer lazy """
+        if self.channels_offset is None or self._channels is None:
+            return
+        if channels_digest(self._channels) != self._channels_digest:
+            self.channels_offset = None
+            return
+        self._channels = None
+        return
+
     calibration_abs = -955.1
     calibration_lin = 10
-    channels = np.zeros(4096)
+    _channels = np.zeros(4096)
+    _channels_digest = None
+    channels_offset = None
     data_lines = ''
     date_measure = ''
     detector_thickness = 0
@@ -170,7 +208,7 @@ def bruker_txt_test(fittingdata):
     -------
     
     >>>> fittingdata.file_status = bool(r'Bruker Nano GmbH Berlin, Germany\\n'
-    >>>>                                in fittingdata.file_lines[0]) 
+    >>>>                                in fittingdata.file_line) 
     
     See Also
     --------
@@ -183,15 +221,36 @@ def bruker_txt_test(fittingdata):
 #        fittingdata.file_status = bool(r'Bruker Nano GmbH Berlin, Germany\\n'
 #                                       in fittingdata.file_lines[0]) """Build and fit a model of an EDS Signal1D.
 #
-    fittingdata.file_content = open(fittingdata.file_name)
-    fittingdata.file_lines = fittingdata.file_content.readlines()
-    fittingdata.file_content.close()
+    with open(fittingdata.file_name) as file:
+        fittingdata.file_line = file.readline()
     fittingdata.file_status = bool('Bruker Nano GmbH Berlin, Germany\n'
-                                   in fittingdata.file_lines[0])
-    fittingdata.file_content = ''
-    fittingdata.file_lines = ''
+                                   in fittingdata.file_line)
+    fittingdata.file_line = ''
+    return
+
+
+###########################
+#  20261019
+#  Reads the header of a Bruker .txt file up to and including the line with
+#  'Counts', leaving the file positioned at the start of the spectrum data.
+#
+def bruker_txt_header_read(fittingdata, file):
+    """ reads the header lines of the open Bruker *.txt* *file* into
+    *fittingdata.header_lines* and sets *fittingdata.start_count* """
+    fittingdata.header_lines = []
+    for fittingdata.file_line in iter(file.readline, ''):
+        fittingdata.header_lines.append(fittingdata.file_line)
+        if fittingdata.file_line.find('Counts') != -1:
+            #looks for the word 'Counts' in each line
+            break
+    start_count = len(fittingdata.header_lines)
+    if fittingdata.start_count != start_count:
+        print('warning: start of channels != normal value')
+        fittingdata.start_count = start_count
+    fittingdata.file_line = ''
     return
 
+
 ###########################
 #  20190426 Donald Windover
 #  This function reads in the .txt file to provide data for fitting routines
@@ -199,44 +258,25 @@ def bruker_txt_test(fittingdata):
 def bruker_txt_import(fittingdata):
     """ Function to import the bruker *.txt* spectra data
 
-    The working portion of this import breaks the 2 column (energy,counts)
-    spectral data into two numpy arrays via an inefficient *for* loop:
+    The header is read line by line only until the 'Counts' line and kept in
+    *header_lines* (used again by bruker_txt_mod).  The 2 column
+    (energy, counts) spectral data is then parsed in a single call:
 
     .. code-block:: python
 
-        fittingdata.energy_scale[i] = np.float(split_line[0])
-        fittingdata.channels[i] = np.float(split_line[1])
+        data = np.fromstring(file.read(), sep=' ').reshape(-1, 2)
 
     """
     #open Bruker txt file
-    #print(txt_file)
-    fittingdata.file_content = open(fittingdata.file_name)
-    fittingdata.file_lines = fittingdata.file_content.readlines()
-    fittingdata.file_content.close()
-    #count the line where energy, counts data begins
-    fittingdata.line_count = 0
-    for fittingdata.file_line in fittingdata.file_lines:  # finds the start of the error data
-        fittingdata.line_count = fittingdata.line_count + 1
-        if fittingdata.file_line.find('Counts') != -1:  #looks for the word 'Counts' in each line
-            start_count = fittingdata.line_count
-            if fittingdata.start_count != start_count:
-                print('warning: start of channels != normal value')
-                fittingdata.start_count = start_count
-    fittingdata.data_lines = fittingdata.file_lines[fittingdata.start_count:]
-    #keeps only the lines of spectral data
-    fittingdata.energy_scale = np.zeros(len(fittingdata.data_lines))
-    fittingdata.channels = np.zeros(len(fittingdata.data_lines))
-    for i in np.arange(len(fittingdata.data_lines)):
-        fittingdata.file_line = fittingdata.data_lines[i]
-        split_line = fittingdata.file_line.split()
-        fittingdata.energy_scale[i] = np.float(split_line[0])
-        fittingdata.channels[i] = np.float(split_line[1])
+    with open(fittingdata.file_name) as file:
+        #count the line where energy, counts data begins
+        bruker_txt_header_read(fittingdata, file)
+        #keeps only the lines of spectral data
+        data = np.fromstring(file.read(), sep=' ').reshape(-1, 2)
+    fittingdata.energy_scale = data[:, 0].copy()
+    fittingdata.channels = data[:, 1].copy()
     #provides 2 1D arrays with the energy and counts data
     print('import size: ', fittingdata.channels.shape)
-    fittingdata.file_content = ''
-    fittingdata.file_lines = ''
-    fittingdata.file_line = ''
-    fittingdata.data_lines = ''
     return #these counts have been pulse pile up modified
 
 
@@ -248,50 +288,25 @@ def bruker_txt_import(fittingdata):
 def bruker_txt_mod(fittingdata):
     """ function to export a Bruker *.txt* with modified spectra data
 
-    This function opens the Bruker *.txt* file, separates the header data
-    from the spectra data section, and rewrites the content of the spectra
-    section from *energy_scale* and *channels* currently in the fittingdata
-    instance.  The data is then recombined and saved under a new name
-    combined from the original plus the *modification* string.
+    This function takes the header data saved by bruker_txt_import (or reads
+    only the header of the Bruker *.txt* file if none is saved), and writes
+    it followed by a spectra section built from *energy_scale* (4 decimals,
+    as in the Bruker files) and *channels* currently in the fittingdata
+    instance.  The file is saved under a new name combined from the original
+    plus the *modification* string.
 
     """
     print('size into string on export: ', fittingdata.channels.shape)
-    fittingdata.file_content = open(fittingdata.file_name)
-    fittingdata.file_lines = fittingdata.file_content.readlines()
-    fittingdata.file_content.close()
-    fittingdata.line_count = 0
-    for fittingdata.file_line in fittingdata.file_lines:
-        # finds the start of the error data
-        fittingdata.line_count = fittingdata.line_count +1
-        if fittingdata.file_line.find('Counts') != -1:
-            #looks for the word 'Counts' in each line
-            start_count = fittingdata.line_count
-            if fittingdata.start_count != start_count:
-                print('warning: start of channels != normal value')
-                fittingdata.start_count = start_count
-    fittingdata.header_lines = fittingdata.file_lines[:fittingdata.start_count]
-    fittingdata.data_lines = fittingdata.file_lines[fittingdata.start_count:]
-    #keeps only the lines of spectral data
-    fittingdata.replace_lines = []
-    for i in np.arange(len(fittingdata.data_lines)):
-        fittingdata.file_line = fittingdata.data_lines[i]
-        #print('line: ', line)
-        splitline = fittingdata.file_line.split()
-        splitline[1] = str(fittingdata.channels[i].astype(int)) + '\n'
-        replaceline = ' '.join(splitline)
-        fittingdata.replace_lines.append(replaceline)
-    text_list = fittingdata.header_lines + fittingdata.replace_lines
+    if not fittingdata.header_lines:
+        with open(fittingdata.file_name) as file:
+            bruker_txt_header_read(fittingdata, file)
     filenamemod = fittingdata.file_name.replace('.txt', fittingdata.modification)
-    text = "".join(text_list)
     #writing the file
-    file = open(filenamemod, "w")
-    file.write(text)
-    file.close()
-    fittingdata.file_content = ''  #zeroing all the holder spaces after use
-    fittingdata.file_lines = ''
-    fittingdata.header_lines = ''
-    fittingdata.data_lines = ''
-    fittingdata.replace_lines = []
+    with open(filenamemod, "w") as file:
+        file.writelines(fittingdata.header_lines)
+        file.write(block_format('%.4f %d\n', fittingdata.energy_scale,
+                                fittingdata.channels.astype(int)))
+    fittingdata.header_lines = ''  #zeroing all the holder spaces after use
     return
 
 
@@ -300,9 +315,22 @@ def bruker_txt_mod(fittingdata):
 #  This function reads in the *.txt file, passes the channels and energy
 #  for modification
 #
+#  20261019 units changed: OFFSET was read as -10*OFFSET and the energy
+#  scale returned in eV.  OFFSET is now read in keV like XPERCHAN
+#  (calibration_abs = 1000*OFFSET, in eV) and energy_scale is in keV, as
+#  from bruker_spx_import and bruker_txt_import, so that files written by
+#  bruker_msa_export read back unchanged.  Code relying on the old values
+#  must multiply energy_scale by 1000 (no caller in this repository did).
+#
 
 def bruker_msa_import(fittingdata):
-    """function to open Bruker MSA format spectra files"""
+    """ function to open Bruker MSA format spectra files
+
+    XPERCHAN and OFFSET are read in keV (the EMSA XUNITS, as written by
+    bruker_msa_export) into the eV calibration values; the energy scale is in
+    keV, as from bruker_spx_import.  Before 20261019 OFFSET was read as
+    -10*OFFSET and the energy scale was in eV.
+    """
     print(fittingdata.file_name)
     fittingdata.file_content = open(fittingdata.file_name)
     fittingdata.file_lines = fittingdata.file_content.readlines()
@@ -317,7 +345,7 @@ def bruker_msa_import(fittingdata):
             fittingdata.calibration_lin = 1000 * float(splitline[1])
         if fittingdata.file_line.find('OFFSET') != -1:
             splitline = fittingdata.file_line.split(':')
-            fittingdata.calibration_abs = -10 * float(splitline[1])
+            fittingdata.calibration_abs = 1000 * float(splitline[1])
         if fittingdata.file_line.find('SPECTRUM') != -1:
             # startMSA local variable only for indexing end of MSA header
             start_msa = fittingdata.line_count
@@ -327,7 +355,8 @@ def bruker_msa_import(fittingdata):
     new_string = re.sub("\n", '', string)
     fittingdata.channels = np.fromstring(new_string, sep=',')
     fittingdata.energy_scale = (fittingdata.calibration_abs +
-                                np.arange(4096) * fittingdata.calibration_lin)
+                                np.arange(len(fittingdata.channels))
+                                * fittingdata.calibration_lin)/1000
     fittingdata.file_content = ''
     fittingdata.file_lines = ''
     fittingdata.file_line = ''
@@ -335,13 +364,91 @@ def bruker_msa_import(fittingdata):
     return
 
 
+###########################
+#  20261019
+#  Lazy reading of *.spx* files.  The file is read in blocks only up to the
+#  <Channels> element; the header is parsed from those bytes (closed with
+#  the end tags of the spectrum) and the byte offset of <Channels> is kept,
+#  so the channel counts can be decoded later by a single seek and read.
+#  At most *LAZY_CHANNEL_LIMIT* lazily decoded spectra keep their counts in
+#  memory (None = no limit); the least recently decoded are released first.
+#  Only counts still equal to the file are released: a digest is taken on
+#  decoding, and counts replaced (channels setter) or changed in place (e.g.
+#  by pulse_pileup_removal) are kept.
+#
+LAZY_CHANNEL_LIMIT = None
+_lazy_decoded = OrderedDict()
+
+
+def channels_digest(channels):
+    """digest of the counts (and their type) of a decoded spectrum"""
+    channels = np.ascontiguousarray(channels)
+    digest = hashlib.sha1(channels.tobytes())
+    digest.update(str(channels.dtype).encode('ascii'))
+    return digest.hexdigest()
+
+
+def bruker_spx_header_root(fittingdata, block_size=8192):
+    """ reads a *.spx* file up to <Channels>, records the byte offset in
+    *fittingdata.channels_offset*, and returns the parsed header as XML """
+    header = b''
+    with open(fittingdata.file_name, 'rb') as file:
+        offset = -1
+        while offset == -1:
+            block = file.read(block_size)
+            if not block:
+                break
+            header = header + block
+            offset = header.find(b'<Channels>',
+                                 max(len(header) - len(block) - 10, 0))
+    if offset == -1:
+        raise ValueError('no <Channels> element in ' + fittingdata.file_name)
+    fittingdata.channels_offset = offset
+    return ET.fromstring(header[:offset] + b'</ClassInstance></TRTSpectrum>')
+
+
+def bruker_spx_channels_read(fittingdata):
+    """ decodes the <Channels> element of a lazily imported *.spx* file
+    (as spectrum_stack.PRECISION.counts) """
+    import spectrum_stack as spectrum_stack
+    with open(fittingdata.file_name, 'rb') as file:
+        file.seek(fittingdata.channels_offset + len(b'<Channels>'))
+        text = b''
+        end = -1
+        while end == -1:
+            block = file.read(16384)
+            if not block:
+                break
+            text = text + block
+            end = text.find(b'</Channels>')
+    fittingdata._channels = np.fromstring(text[:end].decode('ascii'),
+                                          dtype=spectrum_stack.PRECISION.counts,
+                                          sep=',')
+    fittingdata._channels_digest = channels_digest(fittingdata._channels)
+    if LAZY_CHANNEL_LIMIT is not None:
+        _lazy_decoded[id(fittingdata)] = weakref.ref(fittingdata)
+        _lazy_decoded.move_to_end(id(fittingdata))
+        while len(_lazy_decoded) > LAZY_CHANNEL_LIMIT:
+            oldest = _lazy_decoded.popitem(last=False)[1]()
+            if oldest is not None:
+                oldest.release_channels()
+    return
+
+
 ###########################
 #  20190426 Donald Windover
 #  This function reads in the *.SPX file, passes the channels and energy
 #  for modification
 #
-def bruker_spx_import(fittingdata):
-    """function to import channels and energy info from Bruker *.spx* file"""
+def bruker_spx_import(fittingdata, lazy=False):
+    """function to import channels and energy info from Bruker *.spx* file
+
+    With *lazy* only the header (everything before the <Channels> element)
+    is parsed; the channel counts are decoded from the recorded byte offset
+    when *fittingdata.channels* is first used.  The counts are stored as
+    spectrum_stack.PRECISION.counts (uint32 by default).
+    """
+    import spectrum_stack as spectrum_stack
     #
     #establish 4096 array to take the channel data from an spx file
     #for the Bruker spx data (assumes all 4096 channels present)
@@ -351,8 +458,12 @@ def bruker_spx_import(fittingdata):
     #
     try:
         #opens the XML file
-        tree = ET.parse(open(fittingdata.file_name, "r"))
-        root = tree.getroot()
+        if lazy:
+            root = bruker_spx_header_root(fittingdata)
+            fittingdata._channels = None
+        else:
+            tree = ET.parse(open(fittingdata.file_name, "r"))
+            root = tree.getroot()
         print(r'SPXFile: ', fittingdata.file_name)
     except TypeError:
         #fails gracefully, if filename or format is not XML.
@@ -362,7 +473,8 @@ def bruker_spx_import(fittingdata):
     for level_two in root:
         if level_two.find('Channels') is not None:
             channels = level_two.find('Channels')
-            fittingdata.channels = np.asarray(channels.text.split(','), dtype=int)
+            fittingdata.channels = np.asarray(
+                channels.text.split(','), dtype=spectrum_stack.PRECISION.counts)
             #print('import size: ', fittingdata.channels.shape)
         #pulls in the parameters needed for the txt file
         for level_three in level_two:
@@ -426,10 +538,10 @@ def bruker_spx_import(fittingdata):
     fwhm_factor = 1000 * np.sqrt(8*np.log(2))*sigma
     fittingdata.mn_fwhm = float(fwhm_factor)  #we now know the calc rather than needing a const.
     #print(fittingdata.mn_fwhm)
-    #Energy scale calculation
-    for i in np.arange(4096):
-        fittingdata.energy_scale[i] = (fittingdata.calibration_abs +
-                                       fittingdata.calibration_lin*i)/1000            
+    #Energy scale calculation (for the ChannelCount given in the file)
+    fittingdata.energy_scale = (fittingdata.calibration_abs +
+                                fittingdata.calibration_lin
+                                * np.arange(int(fittingdata.no_channels)))/1000
     return# provides the comma delimited list of channel intensity
 
 ###########################
@@ -441,87 +553,30 @@ def bruker_spx_to_txt_convert(fittingdata):
     """function converting Bruker *.spx* to *.txt* """
     # prints which file is being converted
     print(fittingdata.file_name)
-    #
-    try:
-        #opens the XML file
-        tree = ET.parse(open(fittingdata.file_name, "r"))
-        root = tree.getroot()
-    except TypeError:
-        #fails gracefully, if filename or format is not XML.
-        print("Unable to open and parse input definition file: "
-              + fittingdata.file_name)
-    #pulls in the channle data
-    for level_two in root:
-        if level_two.find('Channels') is not None:
-            channels = level_two.find('Channels')
-            fittingdata.channels = np.fromstring((channels.text), sep=',')
-        #pulls in the parameters needed for the txt file
-        for level_three in level_two:
-            if level_three.tag == 'TRTHeaderedClass':
-                for level_four in level_three:
-                    #pulls in the collection time information
-                    if {'Type': 'TRTSpectrumHardwareHeader'} == level_four.attrib:
-                        for level_five in level_four:
-                            if level_five.tag == 'RealTime':
-                                fittingdata.real_time_in_ms = np.float(
-                                    level_five.text)
-                            if level_five.tag == 'LifeTime':
-                                fittingdata.life_time_in_ms = np.float(
-                                    level_five.text)
-                            if level_five.tag == 'PulseDensity':
-                                fittingdata.pulse_density = level_five.text
-                            if level_five.tag == 'ShapingTime':
-                                fittingdata.shaping_time = np.float(
-                                    level_five.text)
-                    if {'Type' : 'TRTDetectorHeader'} == level_four.attrib:
-                        for level_five in level_four:
-                            #pulls is in the detector info
-                            if level_five.tag == 'Type':
-                                fittingdata.detector_type = level_five.text
-                            if level_five.tag == 'DetectorThickness':
-                                fittingdata.detector_thickness = float(level_five.text)
-                            if level_five.tag == 'SiDeadLayerThickness':
-                                fittingdata.si_dead_layer = level_five.text
-                            if level_five.tag == 'WindowType':
-                                fittingdata.window_type = level_five.text
-            if {'Type': 'TRTSpectrumHeader'} == level_three.attrib:
-                for level_four in level_three:
-                    #pulls in the energy calibration info
-                    if level_four.tag == 'Date':
-                        date = level_four.text
-                    if level_four.tag == 'Time':
-                        time = level_four.text
-                    if level_four.tag == 'ChannelCount':
-                        fittingdata.no_channels = level_four.text
-                    if level_four.tag == 'CalibAbs':
-                        calibration_abs = np.float(level_four.text)
-                    if level_four.tag == 'CalibLin':
-                        calibration_lin = np.float(level_four.text)
-                    if level_four.tag == 'SigmaAbs':
-                        sigma_abs = np.float(level_four.text)
-                    if level_four.tag == 'SigmaLin':
-                        sigma_lin = np.float(level_four.text)
-    #converts the time to the correct format
-    time = datetime.strptime(time, "%H:%M:%S")
-    fittingdata.time_measure = time.strftime("%I:%M:%S %p")
-    #converts the date to the correct format
-    date = datetime.strptime(date, "%d.%m.%Y")
-    fittingdata.date_measure = date.strftime("%m/%d/%Y")
-    # rescales energy calibration factors for the txt format
-    fittingdata.calibration_abs = 1000 * calibration_abs
-    fittingdata.calibration_lin = 1000 * calibration_lin
-    #Energy used in the calucation of Mn FWHM (approximated on 2017/10/19)
-    mn_energy = 5.900
-    #Formula given by Bruker (Falk Reinhardt) on 2017/10/19
-    sigma = np.sqrt(sigma_abs + mn_energy*sigma_lin)
-    fwhm_factor = 1000 * np.sqrt(8*np.log(2))*sigma
-    fittingdata.mn_fwhm = float(fwhm_factor)  #we now know the calc rather than needing a const.
+    bruker_spx_import(fittingdata)
     print(fittingdata.mn_fwhm)
-    #Energy scale calculation
-    for i in np.arange(4096):
-        fittingdata.energy_scale[i] = (fittingdata.calibration_abs +
-                                       fittingdata.calibration_lin*i)/1000
-    #text file data formatting
+    #chaning .spx to a .txt extension
+    bruker_txt_export(fittingdata,
+                      fittingdata.file_name.replace('.spx', '_python.txt'))
+    #returning to 2d arrays with the energy and channels info through fittingdata
+    return
+
+
+###########################
+#  20261019
+#  Writers for the txt, msa, and npz formats.  The spectrum data section is
+#  formatted in one operation by repeating the line format for every channel
+#  (block_format) instead of building one string per channel.
+#
+def block_format(line_format, *columns):
+    """ formats equal length 1D arrays *columns* into one string, one line
+    of *line_format* per element (a single % operation for all lines) """
+    data = np.column_stack(columns).ravel().tolist()
+    return (line_format*len(columns[0])) % tuple(data)
+
+
+def bruker_txt_header(fittingdata):
+    """list of the header lines of the Bruker *.txt* format"""
     text_header = []
     text_header.append(r'Bruker Nano GmbH Berlin, Germany')
     text_header.append(r'esprit 1.9')
@@ -542,26 +597,368 @@ def bruker_spx_to_txt_convert(fittingdata):
     text_header.append(r'Calibration, abs.: ' + '%.3f' % fittingdata.calibration_abs)
     text_header.append(r'Mn FWHM: ' + '%.3f' % fittingdata.mn_fwhm)
     text_header.append(r'Fano factor: 0.116')
-    text_header.append(r'Channels: ' + fittingdata.no_channels)
+    text_header.append(r'Channels: ' + str(fittingdata.no_channels))
     text_header.append(r'')
     text_header.append(r'Energy Counts')
-    #including energy and counts
-    for i in np.arange(int(fittingdata.no_channels)):
-        text_header.append('%.4f' % fittingdata.energy_scale[i] +
-                           '    ' + '%.0f' % fittingdata.channels[i])
-    text_header.append(r'')
-    #combining the list of strings into one long string
-    text = "\n".join(text_header)
-    #chaning .spx to a .txt extension
-    file_name_mod = fittingdata.file_name.replace('.spx', '_python.txt')
-    #writing the file
-    file = open(file_name_mod, "w")
-    file.write(text)
-    file.close()
-    #returning to 2d arrays with the energy and channels info through fittingdata
+    return text_header
+
+
+def bruker_txt_export(fittingdata, file_name):
+    """ function writing the spectrum of a fittingdata instance (read by
+    bruker_spx_import) as a Bruker *.txt* file named *file_name* """
+    no_channels = int(fittingdata.no_channels)
+    text = ("\n".join(bruker_txt_header(fittingdata)) + "\n"
+            + block_format('%.4f    %.0f\n',
+                           fittingdata.energy_scale[:no_channels],
+                           fittingdata.channels[:no_channels]))
+    with open(file_name, "w") as file:
+        file.write(text)
     return
 
 
+def bruker_msa_export(fittingdata, file_name):
+    """ function writing the spectrum of a fittingdata instance (read by
+    bruker_spx_import) as an EMSA/MAS *.msa* file named *file_name*
+
+    The data section is written 5 values per line, each line but the last
+    ending in a comma, so that bruker_msa_import reads the channels back.
+    XPERCHAN and OFFSET are written in keV as given by the EMSA format.
+    """
+    no_channels = int(fittingdata.no_channels)
+    channels = np.asarray(fittingdata.channels[:no_channels], dtype=float)
+    full_lines = no_channels - no_channels % 5
+    data = block_format('%.0f, %.0f, %.0f, %.0f, %.0f,\n',
+                        *channels[:full_lines].reshape(-1, 5).T)
+    data = data + ', '.join(['%.0f' % count for count in channels[full_lines:]])
+    data = data.rstrip(',\n') + '\n'
+    date = datetime.strptime(fittingdata.date_measure, "%m/%d/%Y")
+    time = datetime.strptime(fittingdata.time_measure, "%I:%M:%S %p")
+    msa_header = []
+    msa_header.append(r'#FORMAT      : EMSA/MAS Spectral Data File')
+    msa_header.append(r'#VERSION     : 1.0')
+    msa_header.append(r'#TITLE       : ' + fittingdata.file_name)
+    msa_header.append(r'#DATE        : ' + date.strftime("%d-%b-%Y").upper())
+    msa_header.append(r'#TIME        : ' + time.strftime("%H:%M"))
+    msa_header.append(r'#OWNER       : ')
+    msa_header.append(r'#NPOINTS     : ' + str(no_channels))
+    msa_header.append(r'#NCOLUMNS    : 5')
+    msa_header.append(r'#XUNITS      : keV')
+    msa_header.append(r'#YUNITS      : counts')
+    msa_header.append(r'#DATATYPE    : Y')
+    msa_header.append(r'#XPERCHAN    : ' + '%.6f' % (fittingdata.calibration_lin/1000))
+    msa_header.append(r'#OFFSET      : ' + '%.6f' % (fittingdata.calibration_abs/1000))
+    msa_header.append(r'#SIGNALTYPE  : XRF')
+    msa_header.append(r'#LIVETIME    : ' + '%.3f' % (fittingdata.life_time_in_ms/1000))
+    msa_header.append(r'#REALTIME    : ' + '%.3f' % (fittingdata.real_time_in_ms/1000))
+    msa_header.append(r'#SPECTRUM    : Spectral Data Starts Here')
+    text = "\n".join(msa_header) + "\n" + data + r'#ENDOFDATA   : ' + "\n"
+    with open(file_name, "w") as file:
+        file.write(text)
+    return
+
+
+def bruker_npz_export(fittingdata, file_name):
+    """ function writing the channels, energy scale and header values of a
+    fittingdata instance as a compressed NumPy *.npz* file """
+    no_channels = int(fittingdata.no_channels)
+    np.savez_compressed(file_name,
+                        channels=np.asarray(fittingdata.channels[:no_channels]),
+                        energy_scale=fittingdata.energy_scale[:no_channels],
+                        calibration_abs=fittingdata.calibration_abs,
+                        calibration_lin=fittingdata.calibration_lin,
+                        life_time_in_ms=fittingdata.life_time_in_ms,
+                        real_time_in_ms=fittingdata.real_time_in_ms,
+                        mn_fwhm=fittingdata.mn_fwhm,
+                        date_measure=fittingdata.date_measure,
+                        time_measure=fittingdata.time_measure)
+    return
+
+
+###########################
+#  20261019
+#  Batch conversion of every *.spx* below a directory.  The files are spread
+#  over a process pool; an output is skipped when it is newer than its
+#  *.spx* file unless *force* is given.  With an *output_directory* the
+#  subdirectories below *directory_path* are recreated in it, so files of the
+#  same name in different series do not overwrite each other.
+#
+CONVERT_FORMATS = {'txt': ('_python.txt', bruker_txt_export),
+                   'msa': ('.msa', bruker_msa_export),
+                   'npz': ('.npz', bruker_npz_export)}
+
+
+def _convert_outputs(spx_file, formats, output_directory, force,
+                     directory_path='.'):
+    """ (format, output file) pairs of *spx_file* that need to be written;
+    outputs go next to *spx_file*, or to its directory relative to
+    *directory_path* below *output_directory* """
+    stem = os.path.splitext(os.path.basename(spx_file))[0]
+    if output_directory is None:
+        directory = os.path.dirname(spx_file)
+    else:
+        directory = os.path.normpath(os.path.join(
+            output_directory,
+            os.path.relpath(os.path.dirname(spx_file), directory_path)))
+    outputs = []
+    for output_format in formats:
+        output_file = os.path.join(directory,
+                                   stem + CONVERT_FORMATS[output_format][0])
+        if (force or not os.path.exists(output_file) or
+                os.path.getmtime(output_file) < os.path.getmtime(spx_file)):
+            outputs.append((output_format, output_file))
+    return outputs
+
+
+def _convert_spx(spx_file, outputs):
+    """reads one *.spx* and writes each of its (format, file) outputs"""
+    spx = FittingData(spx_file)
+    bruker_spx_import(spx)
+    for output_format, output_file in outputs:
+        CONVERT_FORMATS[output_format][1](spx, output_file)
+    return [output_file for output_format, output_file in outputs]
+
+
+def bruker_batch_convert(directory_path, formats=('txt', 'msa', 'npz'),
+                         output_directory=None, processes=None, force=False):
+    """ Function converting all *.spx* files below *directory_path*
+
+    Parameters
+    ----------
+
+    directory_path : str
+        top of the directory tree searched for *.spx* files
+    formats : tuple of str [('txt', 'msa', 'npz')]
+        output formats, keys of CONVERT_FORMATS
+    output_directory : str [None]
+        directory for all outputs, with the subdirectories of
+        *directory_path* recreated in it; None writes next to each *.spx*
+    processes : int [None]
+        worker processes; None uses all cores, 1 converts in this process
+    force : bool [False]
+        rewrite outputs that are already up to date
+
+    Returns
+    -------
+
+    list of the files written
+
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    jobs = []
+    for (dirpath, dirnames, filenames) in os.walk(directory_path):
+        for file in sorted(filenames):
+            if file.endswith('.spx'):
+                spx_file = os.path.join(dirpath, file)
+                outputs = _convert_outputs(spx_file, formats,
+                                           output_directory, force,
+                                           directory_path)
+                if outputs:
+                    jobs.append((spx_file, outputs))
+    for directory in {os.path.dirname(output_file) for spx_file, outputs in jobs
+                      for output_format, output_file in outputs}:
+        os.makedirs(directory, exist_ok=True)
+    if processes == 1:
+        written = [_convert_spx(*job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            written = list(executor.map(_convert_spx, *zip(*jobs))) if jobs else []
+    return [output_file for outputs in written for output_file in outputs]
+
+
+###########################
+#  20261019
+#  Spectrum names of the M4 measurements.  The repeat files are named
+#  *_D1_0_<n>.spx / *_D2_0_<n>.spx and the map files *det_1_<row>_<col>.spx /
+#  *det_2_<row>_<col>.spx; the detector tag is removed to give a point key.
+#
+DETECTOR_PATTERN = re.compile(r'(?:_D|det_)([12])_')
+
+
+def detector_point_key(file_name):
+    """ returns (detector, point key) for a detector 1 or 2 file name, or
+    (0, file stem) when the name carries no detector tag """
+    stem = re.split(r'[\\/]', file_name)[-1].replace('.spx', '')
+    match = None
+    for match in DETECTOR_PATTERN.finditer(stem):
+        pass
+    if match is None:
+        return 0, stem
+    key = stem[:match.start()] + '_' + stem[match.end():]
+    return int(match.group(1)), key
+
+
+def grid_index(file_name):
+    """ returns (row, col) from the two trailing integers of a map file name
+    (*det_1_<row>_<col>*); repeat files give (0, <repeat number>) """
+    stem = re.split(r'[\\/]', file_name)[-1].replace('.spx', '')
+    match = re.search(r'_(\d+)_(\d+)$', stem)
+    if match is None:
+        return -1, -1
+    return int(match.group(1)), int(match.group(2))
+
+
+
+###########################
+#  20261019
+#  Readers for the text exports of the M4 software (fit results, ROI sums,
+#  net ROI sums, background sums, and concentrations).  All share the layout
+#
+#      <title line, e.g. 'ROI net sum'>
+#      <blank>
+#      Spectrum   Na   Mg ...
+#      ---------------------
+#      <one row per spectrum>
+#      <'-----' or blank lines>
+#      Mean value:  / Std. Abw.: / Std. Abw. rel. [%]: / Conf. interval:
+#
+#  The header and the end of the data rows are found from the content, and
+#  only the data rows are given to the (fast) C parser of pandas; the
+#  skipfooter option used before forces the slow Python parser.  Each table
+#  gets 'stem', 'detector', 'row', and 'col' columns for joining with the
+#  spectra_fit results, and is cached as a pickle next to the export.
+#
+M4_EXPORT_TITLES = {'Net counts': 'fit',
+                    'ROI sum': 'sum_roi',
+                    'ROI net sum': 'net_roi',
+                    'ROI backgr, sum': 'bg_roi',
+                    'Mass percent (%)': 'mass_conc',
+                    'Atomic percent (%)': 'atm_conc'}
+CACHE_EXTENSION = '.cache.pkl'
+
+
+def _cache_read(file_name, cache):
+    """returns the cached table of *file_name* if it is newer than the file"""
+    import pandas as pd
+    cache_name = file_name + CACHE_EXTENSION
+    if (cache and os.path.exists(cache_name) and
+            os.path.getmtime(cache_name) >= os.path.getmtime(file_name)):
+        return pd.read_pickle(cache_name)
+    return None
+
+
+def _cache_write(file_name, cache, table):
+    """stores *table* as the cache of *file_name*"""
+    if cache:
+        table.to_pickle(file_name + CACHE_EXTENSION)
+    return table
+
+
+def spectrum_name_columns(table, name_column):
+    """ adds 'stem', 'detector', 'row', and 'col' columns derived from the
+    spectrum names in *name_column* of *table* """
+    stems = [re.split(r'[\\/]', name)[-1].replace('.spx', '')
+             for name in table[name_column]]
+    keys = [detector_point_key(stem) for stem in stems]
+    grid = np.array([grid_index(stem) for stem in stems],
+                    dtype=int).reshape(-1, 2)
+    table['stem'] = stems
+    table['detector'] = np.array([key[0] for key in keys], dtype=int)
+    table['row'] = grid[:, 0]
+    table['col'] = grid[:, 1]
+    return table
+
+
+def m4_export_import(file_name, layout=None, cache=True):
+    """ Function to import an M4 text export (fit, ROI sum, net ROI, ...)
+
+    Parameters
+    ----------
+
+    file_name : str
+        M4 export file (e.g. *_M4_fit.txt*, *_M4_net_roi.txt*)
+    layout : str [None]
+        expected layout, one of the values of M4_EXPORT_TITLES; the title
+        line of the file is checked against it when given
+    cache : bool [True]
+        reuse / write a pickle of the parsed table next to the file
+
+    Returns
+    -------
+
+    pandas.DataFrame with 'Spectrum' (str), one column per element, and the
+    'stem', 'detector', 'row', 'col' columns of spectrum_name_columns
+
+    """
+    with open(file_name) as file:
+        title = file.readline().strip()
+        if layout is not None and M4_EXPORT_TITLES.get(title) != layout:
+            raise ValueError(file_name + ' is not an M4 ' + layout
+                             + ' export (title: ' + repr(title) + ')')
+        table = _cache_read(file_name, cache)
+        if table is not None:
+            return table
+        # header: the line starting with 'Spectrum'
+        file_line = file.readline()
+        while file_line and not file_line.startswith('Spectrum'):
+            file_line = file.readline()
+        header = file_line
+        data_lines = []
+        for file_line in file:
+            if file_line.startswith('-') and not data_lines:
+                continue
+            if (not file_line.strip() or file_line.startswith('-')
+                    or file_line.startswith('Mean value:')):
+                break
+            data_lines.append(file_line)
+    import pandas as pd
+    table = pd.read_csv(io.StringIO(header + ''.join(data_lines)),
+                        sep=r'\s+', dtype={'Spectrum': str}, engine='c')
+    table = spectrum_name_columns(table, 'Spectrum')
+    return _cache_write(file_name, cache, table)
+
+
+def m4_fit_import(file_name, cache=True):
+    """M4 fit results (*_M4_fit.txt*, 'Net counts'), see m4_export_import"""
+    return m4_export_import(file_name, 'fit', cache)
+
+
+def m4_sum_roi_import(file_name, cache=True):
+    """M4 ROI sums (*_M4_sum_roi.txt*, 'ROI sum'), see m4_export_import"""
+    return m4_export_import(file_name, 'sum_roi', cache)
+
+
+def m4_net_roi_import(file_name, cache=True):
+    """M4 net ROI sums (*_M4_net_roi.txt* and the *ROI_sum* summaries in
+    M4_refinements, 'ROI net sum'), see m4_export_import"""
+    return m4_export_import(file_name, 'net_roi', cache)
+
+
+def m4_roi_summary_import(file_name, cache=True):
+    """any M4 ROI summary table (*_M4_ROI_*_sum_*.txt*, concentrations);
+    the layout is taken from the title line, see m4_export_import"""
+    return m4_export_import(file_name, None, cache)
+
+
+###########################
+#  20261019
+#  Reader for the stage coordinates (*XYZ.txt*).  Each line is
+#  'x,y,z<path>' or 'x,y,z,<path>' with the path of the measured spectrum.
+#
+def m4_xyz_import(file_name, cache=True):
+    """ Function to import the stage positions of an M4 map (*XYZ.txt*)
+
+    Returns
+    -------
+
+    pandas.DataFrame with float 'x', 'y', 'z' (mm), the 'path' of the
+    spectrum, and the columns of spectrum_name_columns
+
+    """
+    table = _cache_read(file_name, cache)
+    if table is not None:
+        return table
+    with open(file_name) as file:
+        text = file.read()
+    number = r'([-+]?\d+(?:\.\d*)?(?:[Ee][-+]?\d+)?)'
+    rows = re.findall(r'^\s*' + number + ',' + number + ',' + number
+                      + r',?(.*?)\s*$', text, flags=re.MULTILINE)
+    import pandas as pd
+    table = pd.DataFrame(rows, columns=['x', 'y', 'z', 'path'])
+    table[['x', 'y', 'z']] = table[['x', 'y', 'z']].astype(float)
+    table = spectrum_name_columns(table, 'path')
+    return _cache_write(file_name, cache, table)
+
+
 
 def test_io():
     """Funcion tests the spx, msa, and txt readers using sample files
@@ -603,4 +1000,22 @@ def test_io():
     spx = FittingData(spx_file)
     bruker_spx_import(spx)
     bruker_spx_to_txt_convert(spx)
-    return
\ No newline at end of file
+    return
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='convert Bruker *.spx* files to txt, msa, and npz')
+    parser.add_argument('directory_path')
+    parser.add_argument('--formats', nargs='+', default=['txt', 'msa', 'npz'],
+                        choices=sorted(CONVERT_FORMATS))
+    parser.add_argument('--output-directory', default=None)
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--force', action='store_true')
+    arguments = parser.parse_args()
+    print(len(bruker_batch_convert(arguments.directory_path,
+                                   tuple(arguments.formats),
+                                   arguments.output_directory,
+                                   arguments.processes, arguments.force)),
+          'files written')
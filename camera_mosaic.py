@@ -0,0 +1,365 @@
+# -*- coding: utf-8 -*-
+"""
+.. module:: camera_mosaic
+   :platform: Windows
+   :synopsis: lazily tiled mosaic of the M4 camera frames on the stage axes
+
+Created on Mon Oct 19 2026
+
+"""
+#
+
+############################
+#  20261019
+#
+#  The mapping program (*.prg*) saves camera frames as
+#  <name>camera_<magnification>_<i>_<j>.bmp, taken at the stage position of
+#  spectrum <name>_<i>_<j>, so each frame is registered on the stage axes
+#  through the *XYZ.txt* position of that point (frame centre = point).  The
+#  pixel size of each magnification is not stored by the M4: the values of
+#  CAMERA_PIXEL_SIZE are nominal and should be calibrated on a feature seen
+#  at two stage positions.
+#
+#  The pixels of a BMP file are memory mapped (uncompressed 24/32 bit
+#  files), nothing is decoded until used.  The mosaic is served as square
+#  tiles at power of two downsampling levels; a tile samples only the frame
+#  rows and columns it needs, so a coarse tile reads a few rows of each
+#  frame, and the most recently used tiles are kept in an LRU cache.  Finer
+#  frames are drawn over coarser ones.
+#
+###########################
+#
+import os
+import re
+import struct
+from collections import OrderedDict
+import numpy as np
+import bruker_io as bruker_io
+import measurement_catalog as measurement_catalog
+
+# mm per pixel of each camera (nominal, see above)
+CAMERA_PIXEL_SIZE = {'10x': 2.5e-3, '100x': 2.5e-4}
+CAMERA_PATTERN = re.compile(r'^(.*)camera_(\w+?)_(\d+)_(\d+)\.bmp$',
+                            re.IGNORECASE)
+
+
+def bmp_memmap(file_name):
+    """ pixels of an uncompressed 24 or 32 bit BMP file as a read only
+    memory mapped RGB array [height, width, 3], top row first """
+    with open(file_name, 'rb') as file:
+        header = file.read(54)
+    if header[:2] != b'BM':
+        raise ValueError(file_name + ' is not a BMP file')
+    offset = struct.unpack('<I', header[10:14])[0]
+    width, height, planes, bits, compression = struct.unpack(
+        '<iiHHI', header[18:34])
+    if bits not in (24, 32) or compression not in (0, 3):
+        raise ValueError(file_name + ': only uncompressed 24/32 bit BMP '
+                         'files are read, not ' + str(bits) + ' bit')
+    depth = bits//8
+    stride = (width*depth + 3)//4*4
+    rows = np.memmap(file_name, dtype=np.uint8, mode='r', offset=offset,
+                     shape=(abs(height), stride))
+    pixels = rows[:, :width*depth].reshape(abs(height), width, depth)[..., 2::-1]
+    # a positive height stores the bottom row first
+    return pixels[::-1] if height > 0 else pixels
+
+
+class CameraFrame:
+    """ one camera image placed on the stage axes
+
+    def __init__(self, file_name, magnification, point, x, y, pixel_size,
+                 flip_x=False, flip_y=False):
+
+    **file_name:** str
+        BMP file
+
+    **magnification:** str
+        '10x' or '100x'
+
+    **point:** str
+        map point key (bruker_io.detector_point_key) of the frame
+
+    **x, y:** float
+        stage position (mm) of the centre of the frame
+
+    **pixel_size:** float
+        mm per pixel
+
+    **flip_x, flip_y:** bool [False]
+        image columns run against stage x / image rows run with stage y
+
+    """
+
+    def __init__(self, file_name, magnification, point, x, y, pixel_size,
+                 flip_x=False, flip_y=False):
+        self.file_name = file_name
+        self.magnification = magnification
+        self.point = point
+        self.x = float(x)
+        self.y = float(y)
+        self.pixel_size = float(pixel_size)
+        self.flip_x = flip_x
+        self.flip_y = flip_y
+        self._pixels = None
+
+    @property
+    def pixels(self):
+        """memory mapped RGB pixels [height, width, 3]"""
+        if self._pixels is None:
+            self._pixels = bmp_memmap(self.file_name)
+        return self._pixels
+
+    @property
+    def shape(self):
+        """(height, width) in pixels"""
+        return self.pixels.shape[:2]
+
+    def extent(self):
+        """(x_min, x_max, y_min, y_max) in mm covered by the frame"""
+        height, width = self.shape
+        half_x = width*self.pixel_size/2
+        half_y = height*self.pixel_size/2
+        return (self.x - half_x, self.x + half_x,
+                self.y - half_y, self.y + half_y)
+
+    def pixel_index(self, x, y):
+        """ (row, col) of the frame pixels at stage positions *x*, *y*
+        (mm, arrays); -1 outside the frame """
+        height, width = self.shape
+        x_min, x_max, y_min, y_max = self.extent()
+        col = np.floor((np.asarray(x) - x_min)/self.pixel_size).astype(int)
+        row = np.floor((y_max - np.asarray(y))/self.pixel_size).astype(int)
+        if self.flip_x:
+            col = width - 1 - col
+        if self.flip_y:
+            row = height - 1 - row
+        col[(col < 0) | (col >= width)] = -1
+        row[(row < 0) | (row >= height)] = -1
+        return row, col
+
+
+def camera_frames(directory_path, pixel_size=CAMERA_PIXEL_SIZE,
+                  flip_x=False, flip_y=False):
+    """ Function finding and registering the camera frames of a map
+
+    Parameters
+    ----------
+
+    directory_path : str
+        map directory with the *camera_<magnification>_<i>_<j>.bmp* frames
+        and the *XYZ.txt* stage positions
+    pixel_size : dict [CAMERA_PIXEL_SIZE]
+        mm per pixel of each magnification
+    flip_x, flip_y : bool [False]
+        orientation of the images on the stage axes
+
+    Returns
+    -------
+
+    list of CameraFrame, coarse magnifications first (frames without a
+    stage position or pixel size are left out)
+
+    """
+    positions = measurement_catalog.stage_positions(directory_path, '')
+    frames = []
+    for file in sorted(os.listdir(directory_path)):
+        match = CAMERA_PATTERN.match(file)
+        if match is None:
+            continue
+        name, magnification, i, j = match.groups()
+        point = bruker_io.detector_point_key(name + '_' + i + '_' + j)[1]
+        if point not in positions or magnification not in pixel_size:
+            continue
+        x, y, z = positions[point]
+        frames.append(CameraFrame(directory_path + '/' + file, magnification,
+                                  point, x, y, pixel_size[magnification],
+                                  flip_x, flip_y))
+    frames.sort(key=lambda frame: -frame.pixel_size)
+    return frames
+
+
+class CameraMosaic:
+    """ camera frames served as cached square tiles on the stage axes
+
+    def __init__(self, frames, tile_size=256, max_tiles=64):
+
+    **frames:** list of CameraFrame
+        drawn in order (later frames over earlier ones)
+
+    **tile_size:** int [256]
+        pixels along each side of a tile
+
+    **max_tiles:** int [64]
+        tiles kept in the LRU cache (None = no limit)
+
+    **pixel_size:** float
+        mm per pixel of level 0 (the finest frame); level n is downsampled
+        2**n times
+
+    **hits, misses:** int
+        tiles read from / rendered for the cache
+
+    Tile (level, tx, ty) covers, from the top left corner of the mosaic,
+    x_min + tx*size .. x_min + (tx + 1)*size and y_max - (ty + 1)*size ..
+    y_max - ty*size with size = tile_size*pixel_size*2**level.
+
+    """
+
+    def __init__(self, frames, tile_size=256, max_tiles=64):
+        self.frames = list(frames)
+        if not self.frames:
+            raise ValueError('no camera frames')
+        self.tile_size = tile_size
+        self.max_tiles = max_tiles
+        self.pixel_size = min(frame.pixel_size for frame in self.frames)
+        extents = np.array([frame.extent() for frame in self.frames])
+        self.x_min = extents[:, 0].min()
+        self.x_max = extents[:, 1].max()
+        self.y_min = extents[:, 2].min()
+        self.y_max = extents[:, 3].max()
+        self.tiles = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def tile_span(self, level):
+        """mm covered by one side of a tile at *level*"""
+        return self.tile_size*self.pixel_size*2**level
+
+    def tile_count(self, level):
+        """(columns, rows) of tiles covering the mosaic at *level*"""
+        span = self.tile_span(level)
+        return (int(np.ceil((self.x_max - self.x_min)/span)),
+                int(np.ceil((self.y_max - self.y_min)/span)))
+
+    def render_tile(self, level, tx, ty):
+        """ draws tile (level, tx, ty) from the frames (uncached); pixels no
+        frame covers are 0 """
+        size = self.pixel_size*2**level
+        span = self.tile_span(level)
+        x = self.x_min + tx*span + (np.arange(self.tile_size) + 0.5)*size
+        y = self.y_max - ty*span - (np.arange(self.tile_size) + 0.5)*size
+        tile = np.zeros((self.tile_size, self.tile_size, 3), dtype=np.uint8)
+        x_low, x_high, y_low, y_high = x[0], x[-1], y[-1], y[0]
+        for frame in self.frames:
+            f_x_min, f_x_max, f_y_min, f_y_max = frame.extent()
+            if (f_x_max < x_low or f_x_min > x_high or f_y_max < y_low
+                    or f_y_min > y_high):
+                continue
+            row, _ = frame.pixel_index(np.full(len(y), frame.x), y)
+            _, col = frame.pixel_index(x, np.full(len(x), frame.y))
+            inside_rows = np.nonzero(row >= 0)[0]
+            inside_cols = np.nonzero(col >= 0)[0]
+            # only the sampled rows and columns of the frame are read
+            tile[np.ix_(inside_rows, inside_cols)] = frame.pixels[
+                np.ix_(row[inside_rows], col[inside_cols])]
+        return tile
+
+    def tile(self, level, tx, ty):
+        """tile (level, tx, ty) [tile_size, tile_size, 3], from the cache
+        when possible"""
+        key = (level, tx, ty)
+        if key in self.tiles:
+            self.tiles.move_to_end(key)
+            self.hits = self.hits + 1
+            return self.tiles[key]
+        tile = self.render_tile(level, tx, ty)
+        tile.setflags(write=False)
+        self.misses = self.misses + 1
+        self.tiles[key] = tile
+        if self.max_tiles is not None:
+            while len(self.tiles) > self.max_tiles:
+                self.tiles.popitem(last=False)
+        return tile
+
+    def region(self, x_range=None, y_range=None, level=0):
+        """ Function assembling the tiles covering a stage region
+
+        Parameters
+        ----------
+
+        x_range, y_range : (float, float) [None]
+            stage region in mm (the whole mosaic by default)
+        level : int [0]
+            downsampling level, 2**level mosaic pixels per output pixel
+
+        Returns
+        -------
+
+        (image, extent) with the RGB image [rows, cols, 3], top row at the
+        largest y, and its (x_min, x_max, y_min, y_max) in mm, ready for
+        matplotlib imshow(image, extent=extent)
+
+        """
+        if x_range is None:
+            x_range = (self.x_min, self.x_max)
+        if y_range is None:
+            y_range = (self.y_min, self.y_max)
+        span = self.tile_span(level)
+        columns, rows = self.tile_count(level)
+        tx_first = max(int(np.floor((x_range[0] - self.x_min)/span)), 0)
+        tx_last = min(int(np.ceil((x_range[1] - self.x_min)/span)), columns)
+        ty_first = max(int(np.floor((self.y_max - y_range[1])/span)), 0)
+        ty_last = min(int(np.ceil((self.y_max - y_range[0])/span)), rows)
+        image = np.zeros(((ty_last - ty_first)*self.tile_size,
+                          (tx_last - tx_first)*self.tile_size, 3),
+                         dtype=np.uint8)
+        for ty in np.arange(ty_first, ty_last):
+            for tx in np.arange(tx_first, tx_last):
+                image[(ty - ty_first)*self.tile_size:
+                      (ty - ty_first + 1)*self.tile_size,
+                      (tx - tx_first)*self.tile_size:
+                      (tx - tx_first + 1)*self.tile_size] = self.tile(
+                          level, int(tx), int(ty))
+        extent = (self.x_min + tx_first*span, self.x_min + tx_last*span,
+                  self.y_max - ty_last*span, self.y_max - ty_first*span)
+        return image, extent
+
+
+def point_map(table, column, directory_path, name_column='filename'):
+    """ Function laying the values of one column out on the stage positions
+    of a map, for display over CameraMosaic.region
+
+    Parameters
+    ----------
+
+    table : pandas.DataFrame
+        one row per spectrum (e.g. spectra_fit output or an M4 export)
+    column : str
+        column to be mapped (e.g. 'Fe_Ka')
+    directory_path : str
+        map directory holding the *XYZ.txt* stage positions
+    name_column : str ['filename']
+        column of the spectrum names ('Spectrum' for the M4 exports)
+
+    Returns
+    -------
+
+    (values, extent) with values [y, x] (top row at the largest y, NaN where
+    no spectrum was measured) and its (x_min, x_max, y_min, y_max) in mm;
+    the two detectors of a point are averaged
+
+    """
+    positions = measurement_catalog.stage_positions(directory_path, '')
+    points = [bruker_io.detector_point_key(name)[1]
+              for name in table[name_column]]
+    found = np.array([point in positions for point in points])
+    xy = np.array([positions[point][:2] for point, keep
+                   in zip(points, found) if keep]).reshape(-1, 2)
+    values = np.asarray(table[column], dtype=float)[found]
+    x_axis = np.unique(np.round(xy[:, 0], 6))
+    y_axis = np.unique(np.round(xy[:, 1], 6))[::-1]
+    col = np.searchsorted(x_axis, np.round(xy[:, 0], 6))
+    row = len(y_axis) - 1 - np.searchsorted(y_axis[::-1],
+                                            np.round(xy[:, 1], 6))
+    total = np.zeros((len(y_axis), len(x_axis)))
+    count = np.zeros((len(y_axis), len(x_axis)))
+    np.add.at(total, (row, col), values)
+    np.add.at(count, (row, col), 1)
+    with np.errstate(invalid='ignore'):
+        grid = total/count
+    step_x = np.min(np.diff(x_axis)) if len(x_axis) > 1 else 1.0
+    step_y = np.min(np.diff(y_axis[::-1])) if len(y_axis) > 1 else 1.0
+    extent = (x_axis[0] - step_x/2, x_axis[-1] + step_x/2,
+              y_axis[-1] - step_y/2, y_axis[0] + step_y/2)
+    return grid, extent
@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+"""
+.. module:: energy_drift
+   :platform: Windows
+   :synopsis: energy drift tracking and batched recalibration of stacks
+
+Created on Mon Oct 19 2026
+
+"""
+#
+
+############################
+#  20261019
+#
+#  Over a multi-hour map the detector gain drifts and the peaks move by
+#  fractions of a channel.  Each spectrum of a stack is cross-correlated with
+#  a reference spectrum by FFT in a few energy windows; the position of the
+#  correlation maximum, refined by a parabola through its three highest
+#  points, gives the shift of the spectrum in each window.  A straight line
+#  through the window shifts gives a channel offset and a gain for every
+#  spectrum, i.e. a corrected calibration.  The line is a weighted least
+#  squares fit over every window with a usable correlation peak, each window
+#  weighted by the inverse variance of a shift measured in it (the Poisson
+#  information of the reference peaks in the window); the default windows
+#  each hold one line group of SRM 1831, from Si K (1.7 keV) to Rh K
+#  (20.2 keV), so the gain is set by the whole energy range and not by two
+#  broad windows.  The whole stack is then
+#  resampled onto the reference energy axis by one block diagonal sparse
+#  operator (spectrum_stack.batched_rebin_operator).
+#
+#  Before the correlation the continuum is removed with a moving average
+#  (high-pass), so the result follows the peaks and not the background.
+#
+###########################
+#
+import numpy as np
+import pandas as pd
+import scipy.ndimage as ndimage
+import spectrum_stack as spectrum_stack
+
+# energy windows (keV) of the main SRM 1831 lines: Si K, Rh L, K and Ca K
+# (one window: the high-pass of Ca Ka reaches into the K Ka peak), Fe K,
+# Sr Ka and the Rh Ka tube line
+DRIFT_WINDOWS = [(1.45, 2.05), (2.45, 2.95), (3.05, 4.3), (6.1, 7.3),
+                 (13.85, 14.45), (19.9, 20.5)]
+
+
+def _highpass(channels, smooth):
+    """spectra minus their moving average over *smooth* channels"""
+    channels = np.atleast_2d(np.asarray(channels, dtype=float))
+    return channels - ndimage.uniform_filter1d(channels, smooth, axis=-1,
+                                               mode='nearest')
+
+
+def correlation_shifts(channels, reference, windows, max_shift=20,
+                       smooth=41):
+    """ Function measuring the shift (channels) of every spectrum against
+    the reference in each channel window by FFT cross-correlation
+
+    Parameters
+    ----------
+
+    channels : np.array [n_spectra, n_channels]
+    reference : np.array [n_channels,]
+    windows : list of (first, last) channel ranges
+    max_shift : int [20]
+        largest shift searched for, in channels
+    smooth : int [41]
+        width of the moving average removed before the correlation
+
+    Returns
+    -------
+
+    shifts : np.array [n_spectra, n_windows]
+        positive when the peaks of a spectrum lie at higher channels than
+        in the reference; NaN where the correlation has no maximum inside
+        the searched shifts
+    centres : np.array [n_windows,]
+        intensity weighted centre channel of each window of the reference
+
+    """
+    spectra = _highpass(channels, smooth)
+    reference = _highpass(reference, smooth)[0]
+    no_channels = spectra.shape[1]
+    n_fft = 1 << int(np.ceil(np.log2(2*no_channels)))
+    lags = np.arange(-max_shift, max_shift + 1)
+    shifts = np.zeros((spectra.shape[0], len(windows)))
+    centres = np.zeros(len(windows))
+    index = np.arange(no_channels)
+    for i, (first, last) in enumerate(windows):
+        mask = (index >= first) & (index < last)
+        reference_window = np.where(mask, reference, 0)
+        weight = np.clip(reference_window, 0, None)
+        centres[i] = np.sum(weight*index)/np.sum(weight)
+        correlation = np.fft.irfft(
+            np.fft.rfft(np.where(mask, spectra, 0), n_fft, axis=1)
+            * np.conj(np.fft.rfft(reference_window, n_fft)), n_fft, axis=1)
+        correlation = correlation[:, lags % n_fft]
+        peak = np.clip(np.argmax(correlation, axis=1), 1, len(lags) - 2)
+        rows = np.arange(correlation.shape[0])
+        left = correlation[rows, peak - 1]
+        center = correlation[rows, peak]
+        right = correlation[rows, peak + 1]
+        curve = left - 2*center + right
+        with np.errstate(divide='ignore', invalid='ignore'):
+            refine = np.where(curve < 0, 0.5*(left - right)/curve, 0)
+        usable = ((center >= left) & (center >= right) & (curve < 0)
+                  & (np.abs(refine) <= 0.5))
+        shifts[:, i] = np.where(usable, lags[peak] + refine, np.nan)
+    return shifts, centres
+
+
+def drift_calibration(stack, reference=None, windows=DRIFT_WINDOWS,
+                      max_shift=20, smooth=41):
+    """ Function reporting the energy drift of every spectrum of a stack
+
+    Parameters
+    ----------
+
+    stack : spectrum_stack.SpectrumStack
+    reference : np.array [n_channels,] [None]
+        reference spectrum on the axis of the first spectrum of the stack;
+        defaults to the mean spectrum of the stack
+    windows : list of (low, high) keV [DRIFT_WINDOWS]
+        energy windows correlated separately; a spectrum with two or more
+        usable windows gets an offset and a gain, with one only an offset,
+        with none neither (offset 0, gain 1)
+
+    Returns
+    -------
+
+    pandas.DataFrame with, per spectrum, the shift in each window, the
+    channel offset and gain (channel = offset + gain * reference channel),
+    the number of windows used, and the corrected calibration_abs and
+    calibration_lin in eV
+
+    """
+    if reference is None:
+        reference = stack.channels.mean(axis=0)
+    reference_abs = stack.calibration_abs[0]
+    reference_lin = stack.calibration_lin[0]
+    channel_windows = [(int((low*1000 - reference_abs)/reference_lin),
+                        int((high*1000 - reference_abs)/reference_lin))
+                       for low, high in windows]
+    shifts, centres = correlation_shifts(stack.channels, reference,
+                                         channel_windows, max_shift, smooth)
+    # weight of each window: the Poisson (Fisher) information on a shift of
+    # the reference in it, sum of slope**2/counts, i.e. 1/variance of the
+    # shift of a spectrum like the reference
+    reference = np.asarray(reference, dtype=float)
+    information = np.gradient(reference)**2/np.clip(reference, 1, None)
+    strength = np.array([np.sum(information[first:last])
+                         for first, last in channel_windows])
+    weights = np.where(np.isnan(shifts), 0, strength)
+    values = np.nan_to_num(shifts)
+    # weighted least squares line shift = offset + slope * centre, solved
+    # for every spectrum at once from its normal equations
+    s0 = weights.sum(axis=1)
+    s1 = weights @ centres
+    s2 = weights @ centres**2
+    t0 = np.sum(weights*values, axis=1)
+    t1 = np.sum(weights*values*centres, axis=1)
+    determinant = s0*s2 - s1**2
+    n_windows = np.count_nonzero(weights, axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = np.where(n_windows > 1, (s0*t1 - s1*t0)/determinant, 0)
+        offset = np.where(n_windows > 0, (t0 - slope*s1)/s0, 0)
+    drift = pd.DataFrame({'filename': stack.file_names})
+    for i, (low, high) in enumerate(windows):
+        drift['shift ' + str(low) + '-' + str(high) + ' keV'] = shifts[:, i]
+    drift['offset'] = offset
+    drift['gain'] = gain = 1 + slope
+    drift['windows used'] = n_windows
+    # the reference energy of channel c of a spectrum is that of reference
+    # channel (c - offset)/gain
+    drift['calibration_abs'] = reference_abs - reference_lin*offset/gain
+    drift['calibration_lin'] = reference_lin/gain
+    return drift
+
+
+def drift_correct(stack, drift=None, reference=None, windows=DRIFT_WINDOWS,
+                  dtype=None):
+    """ Function resampling a stack onto the energy axis of its first
+    spectrum using the corrected calibrations from drift_calibration, in one
+    sparse matrix product for the whole stack, in the working precision
+    (spectrum_stack.PRECISION) unless *dtype* is given
+
+    Returns
+    -------
+
+    (corrected SpectrumStack, drift table)
+
+    """
+    if drift is None:
+        drift = drift_calibration(stack, reference, windows)
+    dtype = spectrum_stack.working_dtype(dtype)
+    target_abs = stack.calibration_abs[0]
+    target_lin = stack.calibration_lin[0]
+    operator = spectrum_stack.batched_rebin_operator(
+        drift['calibration_abs'].values, drift['calibration_lin'].values,
+        stack.no_channels, target_abs, target_lin)
+    channels = (operator.astype(dtype)
+                @ stack.channels.ravel().astype(dtype)).reshape(
+        len(stack), stack.no_channels)
+    return spectrum_stack.SpectrumStack(channels, target_abs, target_lin,
+                                        stack.life_time_in_ms,
+                                        stack.file_names,
+                                        stack.shaping_time), drift
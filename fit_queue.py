@@ -0,0 +1,355 @@
+# -*- coding: utf-8 -*-
+"""
+.. module:: fit_queue
+   :platform: Windows
+   :synopsis: SQLite work queue sharding spectra_fit over many workers
+
+Created on Mon Oct 19 2026
+
+"""
+#
+
+############################
+#  20261019
+#
+#  A campaign (repeats, maps and wafer, both detectors, several element sets
+#  such as COA/select/full) is split into one job per (file, element set,
+#  fitter, method).  The coordinator writes the jobs into an SQLite file;
+#  any number of workers, on this computer or on others that mount the same
+#  share, claim jobs one at a time and write the fitted lines back into the
+#  same file.
+#
+#  A claim is a single BEGIN IMMEDIATE transaction (one writer at a time), so
+#  no job is handed to two workers.  A claimed job carries a lease: when a
+#  worker dies, its job is claimed again once the lease has run out.  A job
+#  that raises is put back in the queue until it has failed *max_attempts*
+#  times, then it is marked failed with the traceback kept in the table.
+#
+#  The rollback journal is used rather than WAL, which does not work over a
+#  network share; SQLite locking on a share relies on the file server, so
+#  keep the queue on a local disk when the workers all run on one host.
+#
+###########################
+#
+import argparse
+import json
+import os
+import socket
+import sqlite3
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    file_name TEXT NOT NULL,
+    element_set TEXT NOT NULL,
+    elements TEXT NOT NULL,
+    fitter TEXT NOT NULL,
+    method TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker TEXT,
+    claimed REAL,
+    finished REAL,
+    life_time_in_ms REAL,
+    error TEXT,
+    UNIQUE (file_name, element_set, fitter, method));
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id);
+CREATE TABLE IF NOT EXISTS results (
+    job_id INTEGER NOT NULL REFERENCES jobs (id),
+    position INTEGER NOT NULL,
+    line TEXT NOT NULL,
+    roi REAL,
+    model REAL,
+    PRIMARY KEY (job_id, position));
+"""
+
+
+def connect(database, timeout=60):
+    """ opens (and creates when needed) a queue file; transactions are
+    begun explicitly, *timeout* (s) is the wait for a locked file """
+    connection = sqlite3.connect(database, timeout=timeout,
+                                 isolation_level=None)
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def enqueue(database, file_names, element_sets, fitter='leastsq',
+            method='ls'):
+    """ Function adding fitting jobs to a queue
+
+    Parameters
+    ----------
+
+    database : str
+        queue file
+    file_names : list of str
+        *.spx* files to be fitted
+    element_sets : dict
+        name of each element set (e.g. 'COA') and its list of elements;
+        every file is fitted with every set
+    fitter, method : str ['leastsq', 'ls']
+        passed on to the hyperspy fit
+
+    Returns
+    -------
+
+    number of new jobs (jobs already in the queue are left as they are)
+
+    """
+    connection = connect(database)
+    try:
+        connection.execute('BEGIN IMMEDIATE')
+        before = connection.total_changes
+        connection.executemany(
+            'INSERT OR IGNORE INTO jobs (file_name, element_set, elements, '
+            'fitter, method) VALUES (?, ?, ?, ?, ?)',
+            [(file_name, name, json.dumps(list(elements)), fitter, method)
+             for name, elements in element_sets.items()
+             for file_name in file_names])
+        added = connection.total_changes - before
+        connection.execute('COMMIT')
+    finally:
+        connection.close()
+    return added
+
+
+def claim(connection, worker, lease=3600, max_attempts=3):
+    """ atomically takes the next pending job (or one whose lease ran out)
+    for *worker*; returns (id, file_name, elements, fitter, method) or None
+    when there is nothing left to do """
+    now = time.time()
+    connection.execute('BEGIN IMMEDIATE')
+    try:
+        connection.execute(
+            "UPDATE jobs SET status = 'failed', error = 'lease expired' "
+            "WHERE status = 'running' AND claimed < ? AND attempts >= ?",
+            (now - lease, max_attempts))
+        job = connection.execute(
+            "SELECT id, file_name, elements, fitter, method FROM jobs "
+            "WHERE status = 'pending' "
+            "OR (status = 'running' AND claimed < ?) ORDER BY id LIMIT 1",
+            (now - lease,)).fetchone()
+        if job is not None:
+            connection.execute(
+                "UPDATE jobs SET status = 'running', worker = ?, claimed = ?, "
+                "attempts = attempts + 1 WHERE id = ?", (worker, now, job[0]))
+        connection.execute('COMMIT')
+    except BaseException:
+        connection.execute('ROLLBACK')
+        raise
+    if job is None:
+        return None
+    return job[0], job[1], json.loads(job[2]), job[3], job[4]
+
+
+def complete(connection, job_id, line_names, roi, model, life_time_in_ms):
+    """stores the fitted lines of a job and marks it done"""
+    connection.execute('BEGIN IMMEDIATE')
+    try:
+        connection.execute('DELETE FROM results WHERE job_id = ?', (job_id,))
+        connection.executemany(
+            'INSERT INTO results (job_id, position, line, roi, model) '
+            'VALUES (?, ?, ?, ?, ?)',
+            [(job_id, i, str(line), float(roi[i]), float(model[i]))
+             for i, line in enumerate(line_names)])
+        connection.execute(
+            "UPDATE jobs SET status = 'done', finished = ?, "
+            "life_time_in_ms = ?, error = NULL WHERE id = ?",
+            (time.time(), float(life_time_in_ms), job_id))
+        connection.execute('COMMIT')
+    except BaseException:
+        connection.execute('ROLLBACK')
+        raise
+
+
+def fail(connection, job_id, error, max_attempts=3):
+    """ records the error of a job and returns it to the queue, or marks it
+    failed after *max_attempts* attempts """
+    connection.execute(
+        "UPDATE jobs SET status = CASE WHEN attempts >= ? THEN 'failed' "
+        "ELSE 'pending' END, error = ? WHERE id = ?",
+        (max_attempts, error, job_id))
+
+
+def run_worker(database, fit=None, lease=3600, max_attempts=3):
+    """ Function working through the queue until no job is left
+
+    Parameters
+    ----------
+
+    database : str
+        queue file
+    fit : function [None]
+        fit(file_name, fitter, method, elements) returning (line_names, roi,
+        model, life_time_in_ms); spectrum_evaluation.spectrum_fit by default
+    lease : float [3600]
+        seconds after which a claimed job is considered abandoned
+    max_attempts : int [3]
+        attempts before a job is marked failed
+
+    Returns
+    -------
+
+    number of jobs completed by this worker
+
+    """
+    if fit is None:
+        # hyperspy is only needed by the workers, not by the coordinator
+        import spectrum_evaluation as spectrum_evaluation
+        fit = spectrum_evaluation.spectrum_fit
+    worker = socket.gethostname() + ':' + str(os.getpid())
+    connection = connect(database)
+    done = 0
+    try:
+        while True:
+            job = claim(connection, worker, lease, max_attempts)
+            if job is None:
+                break
+            job_id, file_name, elements, fitter, method = job
+            try:
+                line_names, roi, model, life_time_in_ms = fit(
+                    file_name, fitter, method, elements)
+            except Exception:
+                fail(connection, job_id, traceback.format_exc(), max_attempts)
+                continue
+            complete(connection, job_id, line_names, roi, model,
+                     life_time_in_ms)
+            done = done + 1
+    finally:
+        connection.close()
+    return done
+
+
+def run_local_workers(database, processes=None, fit=None, lease=3600,
+                      max_attempts=3):
+    """ starts *processes* workers on this computer (all cores by default)
+    and returns the number of jobs each completed """
+    if processes is None:
+        processes = os.cpu_count()
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        return list(executor.map(run_worker, [database]*processes,
+                                 [fit]*processes, [lease]*processes,
+                                 [max_attempts]*processes))
+
+
+def queue_status(database):
+    """number of jobs in each state for each element set"""
+    connection = connect(database)
+    try:
+        status = pd.read_sql_query(
+            'SELECT element_set, status, COUNT(*) AS jobs FROM jobs '
+            'GROUP BY element_set, status', connection)
+    finally:
+        connection.close()
+    return status.pivot(index='element_set', columns='status',
+                        values='jobs').fillna(0).astype(int)
+
+
+def collect_results(database, element_set, directory_path=None,
+                    fitter='leastsq', method='ls'):
+    """ Function gathering the finished jobs of one element set
+
+    Returns
+    -------
+
+    (roi_df, model_df) laid out as the output of spectra_fit: filename,
+    one column per line, and 'life time in ms'; only files inside
+    *directory_path* when it is given
+
+    """
+    connection = connect(database)
+    try:
+        results = pd.read_sql_query(
+            "SELECT jobs.file_name, jobs.life_time_in_ms, results.position, "
+            "results.line, results.roi, results.model FROM jobs "
+            "JOIN results ON results.job_id = jobs.id "
+            "WHERE jobs.status = 'done' AND jobs.element_set = ? "
+            "AND jobs.fitter = ? AND jobs.method = ? "
+            "ORDER BY jobs.file_name, results.position",
+            connection, params=(element_set, fitter, method))
+    finally:
+        connection.close()
+    if directory_path is not None:
+        directory_path = os.path.normpath(directory_path)
+        results = results[[os.path.dirname(os.path.normpath(file_name))
+                           == directory_path
+                           for file_name in results['file_name']]]
+    line_names = list(results.sort_values('position')['line'].unique())
+    tables = []
+    for value in ('roi', 'model'):
+        table = results.pivot(index='file_name', columns='line',
+                              values=value)[line_names]
+        life_time = results.groupby('file_name')['life_time_in_ms'].first()
+        table = table.reset_index(drop=True)
+        table.columns.name = None
+        table.insert(0, 'filename', [os.path.basename(file_name)
+                                     for file_name in life_time.index])
+        table['life time in ms'] = life_time.values
+        tables.append(table)
+    return tables[0], tables[1]
+
+
+def export_results(database, element_set, directory_path, file_prefix,
+                   fitter='leastsq', method='ls'):
+    """ writes the results of one directory and element set to the pickles
+    read by the notebook: *file_prefix* + *element_set* + '_roi.pkl' and
+    '_model.pkl' """
+    roi, model = collect_results(database, element_set, directory_path,
+                                 fitter, method)
+    roi.to_pickle(file_prefix + element_set + '_roi.pkl')
+    model.to_pickle(file_prefix + element_set + '_model.pkl')
+    return roi, model
+
+
+###########################
+#  20261019
+#  Command line: the coordinator enqueues from Python (or with 'enqueue'),
+#  every machine then runs
+#      python fit_queue.py work //share/SRM_1831/fit_queue.sqlite
+#
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='SQLite work queue for spectra_fit')
+    commands = parser.add_subparsers(dest='command')
+    work = commands.add_parser('work', help='fit queued jobs until none left')
+    work.add_argument('database')
+    work.add_argument('--processes', type=int, default=None,
+                      help='local worker processes (default: all cores)')
+    work.add_argument('--lease', type=float, default=3600)
+    work.add_argument('--attempts', type=int, default=3)
+    add = commands.add_parser('enqueue', help='queue every .spx file of the '
+                              'directories for each element set')
+    add.add_argument('database')
+    add.add_argument('directories', nargs='+')
+    add.add_argument('--set', action='append', required=True,
+                     metavar='NAME=El,El,...', dest='element_sets')
+    add.add_argument('--fitter', default='leastsq')
+    add.add_argument('--method', default='ls')
+    status = commands.add_parser('status', help='jobs per element set')
+    status.add_argument('database')
+    arguments = parser.parse_args()
+    if arguments.command == 'work':
+        print(sum(run_local_workers(arguments.database, arguments.processes,
+                                    None, arguments.lease,
+                                    arguments.attempts)), 'jobs done')
+    elif arguments.command == 'enqueue':
+        element_sets = {}
+        for element_set in arguments.element_sets:
+            name, elements = element_set.split('=')
+            element_sets[name] = elements.split(',')
+        file_names = []
+        for directory_path in arguments.directories:
+            file_names.extend(
+                os.path.join(directory_path, file)
+                for file in sorted(os.listdir(directory_path))
+                if '.spx' in file)
+        print(enqueue(arguments.database, file_names, element_sets,
+                      arguments.fitter, arguments.method), 'jobs added')
+    elif arguments.command == 'status':
+        print(queue_status(arguments.database))
+    else:
+        parser.print_help()
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+.. module:: heterogeneity_bootstrap
+   :platform: Windows
+   :synopsis: bootstrap confidence intervals for heterogeneity and PCA results
+
+Created on Mon Oct 19 2026
+
+"""
+#
+
+############################
+#  20261019
+#
+#  The var, skew, and kurtosis of each element come from 100 to 400 spectra.
+#  To attach confidence intervals, the spectra are resampled with
+#  replacement.  A block of replicates is drawn as one index matrix
+#  [n_replicates, n_spectra]; the moments of every replicate are computed in
+#  one array operation, and optionally projected onto a PCA fitted on the
+#  original statistics.  Blocks are spread over a process pool, each with
+#  its own child seed of one SeedSequence, so the result only depends on the
+#  seed and the block size, not on the number of processes.
+#
+###########################
+#
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from heterogeneity_stats import sample_moments, STATISTICS
+
+
+def pca_projection(pca, scaler=None, columns=('var', 'skew', 'kurtosis')):
+    """ Function packing a fitted sklearn PCA (and the StandardScaler applied
+    before it, as in the notebook) into the arrays used by bootstrap_moments
+
+    Returns
+    -------
+
+    tuple (statistic indices, scale, mean, components); the scaler mean is
+    folded into *mean*, (x - scaler mean)/scale - pca mean being
+    x/scale - (scaler mean/scale + pca mean)
+
+    """
+    index = np.array([STATISTICS.index(column) for column in columns])
+    scale = np.ones(len(index))
+    mean = np.asarray(pca.mean_, dtype=float)
+    if scaler is not None and scaler.scale_ is not None:
+        scale = np.asarray(scaler.scale_, dtype=float)
+    if (scaler is not None and getattr(scaler, 'with_mean', True)
+            and getattr(scaler, 'mean_', None) is not None):
+        mean = mean + np.asarray(scaler.mean_, dtype=float)/scale
+    return index, scale, mean, np.asarray(pca.components_)
+
+
+def _bootstrap_block(values, n_replicates, seed_sequence, projection):
+    """draws one block of replicates and returns their moments and scores"""
+    rng = np.random.default_rng(seed_sequence)
+    n_spectra = values.shape[0]
+    index = rng.integers(0, n_spectra, size=(n_replicates, n_spectra))
+    # [n_replicates, n_columns, n_statistics]
+    moments = sample_moments(values[index], axis=1)
+    if projection is None:
+        return moments, None
+    statistic_index, scale, mean, components = projection
+    table = moments[:, :, statistic_index]/scale - mean
+    scores = np.einsum('rcs,ks->rck', table, components)
+    return moments, scores
+
+
+def bootstrap_moments(values, n_replicates=10000, block_size=250, seed=0,
+                      processes=None, projection=None):
+    """ Function bootstrapping the moment statistics of a result table
+
+    Parameters
+    ----------
+
+    values : np.array or pandas.DataFrame [n_spectra, n_columns]
+        one row per spectrum, one column per element line
+    n_replicates : int [10000]
+        number of bootstrap replicates
+    block_size : int [250]
+        replicates drawn per index matrix (memory is about
+        8 * block_size * n_spectra * n_columns bytes)
+    seed : int [0]
+        root seed; the same seed and block size give the same replicates
+    processes : int [None]
+        worker processes; None uses all cores, 1 runs in this process
+    projection : tuple [None]
+        output of pca_projection; when given the PCA scores of each
+        replicate are returned as well
+
+    Returns
+    -------
+
+    moments : np.array [n_replicates, n_columns, 5]
+        statistics of each replicate in the order of STATISTICS
+    scores : np.array [n_replicates, n_columns, n_components] or None
+
+    """
+    values = np.asarray(values, dtype=float)
+    sizes = [block_size]*(n_replicates // block_size)
+    if n_replicates % block_size:
+        sizes.append(n_replicates % block_size)
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    arguments = [(values, size, seed_sequence, projection)
+                 for size, seed_sequence in zip(sizes, seeds)]
+    if processes == 1:
+        results = [_bootstrap_block(*argument) for argument in arguments]
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            results = list(executor.map(_bootstrap_block, *zip(*arguments)))
+    moments = np.concatenate([result[0] for result in results])
+    if projection is None:
+        return moments, None
+    return moments, np.concatenate([result[1] for result in results])
+
+
+def confidence_intervals(values, moments, columns=None, level=0.95):
+    """ Function summarizing bootstrap replicates as a DataFrame with one
+    row per (column, statistic): the estimate from the original data, the
+    bootstrap standard error, and the percentile interval at *level* """
+    if columns is None:
+        columns = getattr(values, 'columns', np.arange(moments.shape[1]))
+    estimate = sample_moments(np.asarray(values, dtype=float), axis=0)
+    alpha = 100*(1 - level)/2
+    lower, upper = np.nanpercentile(moments, [alpha, 100 - alpha], axis=0)
+    index = pd.MultiIndex.from_product([list(columns), STATISTICS],
+                                       names=['line', 'statistic'])
+    return pd.DataFrame({'estimate': estimate.ravel(),
+                         'std error': np.nanstd(moments, axis=0,
+                                                ddof=1).ravel(),
+                         'lower': lower.ravel(),
+                         'upper': upper.ravel()}, index=index)
@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+"""
+.. module:: heterogeneity_stats
+   :platform: Windows
+   :synopsis: streaming and mergeable moment statistics for heterogeneity
+
+Created on Mon Oct 19 2026
+
+"""
+#
+
+############################
+#  20261019
+#
+#  The heterogeneity study uses the mean, std, var, skew and kurtosis of the
+#  intensity of each element line.  Instead of keeping every fitted row and
+#  calling pandas for each statistic, the central moment sums are updated as
+#  each spectrum result arrives, and partial sums from different workers or
+#  files are merged (Pebay, SAND2008-6212, formulas for arbitrary order
+#  pairwise updates).  The results agree with pandas mean/std/var/skew/kurt.
+#
+###########################
+#
+import numpy as np
+import pandas as pd
+from bruker_io import detector_point_key
+
+STATISTICS = ['mean', 'std', 'var', 'skew', 'kurtosis']
+
+
+def _skew(count, m2, m3):
+    """ adjusted Fisher-Pearson skewness G1 (as pandas.skew) from the
+    count and the central moment sums; 0 where m2 is 0 """
+    n = float(count)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        skew = np.sqrt(n*(n - 1))/(n - 2)*(m3/n)/(m2/n)**1.5
+    return np.where(m2 == 0, 0, skew)
+
+
+def _kurtosis(count, m2, m4):
+    """ unbiased excess kurtosis G2 (as pandas.kurtosis) from the count and
+    the central moment sums; 0 where m2 is 0 """
+    n = float(count)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        kurtosis = (n*(n + 1)*(n - 1)*m4/((n - 2)*(n - 3)*m2**2)
+                    - 3*(n - 1)**2/((n - 2)*(n - 3)))
+    return np.where(m2 == 0, 0, kurtosis)
+
+
+class MomentAccumulator:
+    """ running count, mean, and central moment sums M2, M3, M4 per column
+
+    def __init__(self, columns):
+
+        **columns:** list of str
+            names of the quantities (e.g. element lines) being accumulated
+
+    **count:** int [0]
+        number of rows accumulated
+
+    **mean:** np.array [n_columns,]
+        running mean of each column
+
+    **m2, m3, m4:** np.array [n_columns,]
+        sums of the 2nd, 3rd, and 4th powers of the deviations from the mean
+
+    """
+
+    def __init__(self, columns):
+        self.columns = list(columns)
+        self.count = 0
+        self.mean = np.zeros(len(self.columns))
+        self.m2 = np.zeros(len(self.columns))
+        self.m3 = np.zeros(len(self.columns))
+        self.m4 = np.zeros(len(self.columns))
+
+    def update(self, row):
+        """add a single row (one value per column)"""
+        self.update_batch(np.asarray(row, dtype=float)[np.newaxis, :])
+        return self
+
+    def update_batch(self, rows):
+        """add a 2D block of rows [n_rows, n_columns] in one step"""
+        rows = np.asarray(rows, dtype=float)
+        if rows.shape[0] == 0:
+            return self
+        batch = MomentAccumulator(self.columns)
+        batch.count = rows.shape[0]
+        batch.mean = rows.mean(axis=0)
+        deviation = rows - batch.mean
+        batch.m2 = np.sum(deviation**2, axis=0)
+        batch.m3 = np.sum(deviation**3, axis=0)
+        batch.m4 = np.sum(deviation**4, axis=0)
+        return self.merge(batch)
+
+    def merge(self, other):
+        """combine the moments of *other* (same columns) into this one"""
+        if other.count == 0:
+            return self
+        if self.count == 0:
+            self.count = other.count
+            self.mean = other.mean.copy()
+            self.m2 = other.m2.copy()
+            self.m3 = other.m3.copy()
+            self.m4 = other.m4.copy()
+            return self
+        n_a = float(self.count)
+        n_b = float(other.count)
+        n = n_a + n_b
+        delta = other.mean - self.mean
+        m4 = (self.m4 + other.m4
+              + delta**4*n_a*n_b*(n_a**2 - n_a*n_b + n_b**2)/n**3
+              + 6*delta**2*(n_a**2*other.m2 + n_b**2*self.m2)/n**2
+              + 4*delta*(n_a*other.m3 - n_b*self.m3)/n)
+        m3 = (self.m3 + other.m3
+              + delta**3*n_a*n_b*(n_a - n_b)/n**2
+              + 3*delta*(n_a*other.m2 - n_b*self.m2)/n)
+        m2 = self.m2 + other.m2 + delta**2*n_a*n_b/n
+        self.mean = self.mean + delta*n_b/n
+        self.m2 = m2
+        self.m3 = m3
+        self.m4 = m4
+        self.count = self.count + other.count
+        return self
+
+    def var(self):
+        """sample variance (ddof = 1, as pandas)"""
+        return self.m2/(self.count - 1)
+
+    def std(self):
+        """sample standard deviation (ddof = 1, as pandas)"""
+        return np.sqrt(self.var())
+
+    def skew(self):
+        """adjusted Fisher-Pearson skewness G1 (as pandas.skew)"""
+        return _skew(self.count, self.m2, self.m3)
+
+    def kurtosis(self):
+        """unbiased excess kurtosis G2 (as pandas.kurtosis)"""
+        return _kurtosis(self.count, self.m2, self.m4)
+
+    def to_frame(self):
+        """DataFrame of the statistics with the columns as index, laid out
+        as the mean/std/var/skew/kurtosis tables in the notebook"""
+        data = np.column_stack((self.mean, self.std(), self.var(),
+                                self.skew(), self.kurtosis()))
+        return pd.DataFrame(data=data, index=self.columns, columns=STATISTICS)
+
+
+def sample_moments(values, axis=0):
+    """ Function computing mean, std, var, skew, and kurtosis along *axis*
+    of an array in one vectorized step (same skew and kurtosis functions as
+    MomentAccumulator); the statistics are stacked on a new last axis in
+    the order of STATISTICS """
+    values = np.asarray(values, dtype=float)
+    n = float(values.shape[axis])
+    mean = values.mean(axis=axis, keepdims=True)
+    deviation = values - mean
+    deviation_2 = deviation**2
+    m2 = np.sum(deviation_2, axis=axis)
+    m3 = np.sum(deviation_2*deviation, axis=axis)
+    m4 = np.sum(deviation_2**2, axis=axis)
+    var = m2/(n - 1)
+    return np.stack((np.squeeze(mean, axis=axis), np.sqrt(var), var,
+                     _skew(n, m2, m3), _kurtosis(n, m2, m4)), axis=-1)
+
+
+###########################
+#  20261019
+#  Grouping of results by scan type and detector.  The key is
+#  ('repeat' or 'map', detector number) from the spectrum file name.
+#
+def scan_group(file_name):
+    """ returns ('repeat' | 'map' | 'other', detector) for a spectrum name"""
+    detector, key = detector_point_key(file_name)
+    if 'det_' in file_name:
+        return 'map', detector
+    if detector > 0:
+        return 'repeat', detector
+    return 'other', detector
+
+
+class GroupedMoments:
+    """ one MomentAccumulator per group key, created on first use
+
+    def __init__(self, columns, group_key=scan_group):
+
+        **columns:** list of str
+            names of the quantities being accumulated
+
+        **group_key:** function
+            maps a spectrum file name to its group
+
+    """
+
+    def __init__(self, columns, group_key=scan_group):
+        self.columns = list(columns)
+        self.group_key = group_key
+        self.groups = {}
+
+    def accumulator(self, group):
+        """the accumulator of *group*, created empty if needed"""
+        if group not in self.groups:
+            self.groups[group] = MomentAccumulator(self.columns)
+        return self.groups[group]
+
+    def update(self, file_name, row):
+        """add the result row of one spectrum to its group"""
+        self.accumulator(self.group_key(file_name)).update(row)
+        return self
+
+    def merge(self, other):
+        """combine all groups of *other* into this one"""
+        for group, accumulator in other.groups.items():
+            self.accumulator(group).merge(accumulator)
+        return self
+
+    def to_frames(self):
+        """dict of group -> statistics DataFrame"""
+        return {group: accumulator.to_frame()
+                for group, accumulator in sorted(self.groups.items())}
+
+
+def frame_moments(data_frame, columns=None, file_column='filename',
+                  chunk_size=1000):
+    """ Function accumulating a result DataFrame (as returned by spectra_fit)
+    into a GroupedMoments in blocks of *chunk_size* rows per group
+
+    Parameters
+    ----------
+
+    data_frame : pandas.DataFrame or iterable of DataFrames
+        a result table, or chunks of one (e.g. read_csv with chunksize)
+    columns : list of str
+        columns to accumulate; defaults to all but *file_column* and
+        'life time in ms'
+
+    """
+    if isinstance(data_frame, pd.DataFrame):
+        data_frame = [data_frame]
+    moments = None
+    for chunk in data_frame:
+        if moments is None:
+            if columns is None:
+                columns = [column for column in chunk.columns
+                           if column not in (file_column, 'life time in ms')]
+            moments = GroupedMoments(columns)
+        groups = chunk[file_column].map(moments.group_key)
+        for group, rows in chunk.groupby(groups, sort=False):
+            values = rows[columns].values.astype(float)
+            for start in np.arange(0, values.shape[0], chunk_size):
+                moments.accumulator(group).update_batch(
+                    values[start:start + chunk_size])
+    return moments
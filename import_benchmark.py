@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""
+.. module:: import_benchmark
+   :platform: Windows
+   :synopsis: start-up time of the analysis modules in fresh interpreters
+
+Created on Mon Oct 19 2026
+
+"""
+#
+
+############################
+#  20261019
+#
+#  Every measurement starts a new Python process, so nothing is already in
+#  sys.modules, times 'import <module>' (or a short worker script) and
+#  reports which of the heavy packages (hyperspy, pandas, scipy, sklearn)
+#  the import pulled in.  The median of several runs is reported, the first
+#  run is also slowed by the disk cache.
+#
+#      python import_benchmark.py [repeats]
+#
+###########################
+#
+import json
+import os
+import subprocess
+import sys
+import numpy as np
+
+HEAVY_MODULES = ['hyperspy', 'pandas', 'scipy', 'sklearn']
+# start of a worker that reads spectra (the corrections then run at the same
+# speed whatever was imported)
+PARSE_WORKER = """
+import spectrum_evaluation as spectrum_evaluation
+spx = spectrum_evaluation.bruker_io.FittingData({file_name!r})
+spectrum_evaluation.bruker_io.bruker_spx_import(spx)
+"""
+RUNNER = """
+import json, sys, time, io, contextlib
+start = time.perf_counter()
+with contextlib.redirect_stdout(io.StringIO()):
+    exec(compile({code!r}, 'benchmark', 'exec'))
+seconds = time.perf_counter() - start
+print(json.dumps([seconds, sorted(name for name in {heavy!r}
+                                  if name in sys.modules)]))
+"""
+
+
+def time_code(code, repeats=5):
+    """ median time (s) of *code* in *repeats* fresh interpreters started in
+    this directory, and the heavy modules it loaded (NaN and the error when
+    *code* fails, e.g. on a missing dependency) """
+    directory_path = os.path.dirname(os.path.abspath(__file__))
+    seconds = []
+    for i in np.arange(repeats):
+        output = subprocess.run(
+            [sys.executable, '-c', RUNNER.format(code=code,
+                                                 heavy=HEAVY_MODULES)],
+            cwd=directory_path, capture_output=True, text=True)
+        if output.returncode != 0:
+            return np.nan, [output.stderr.strip().splitlines()[-1]]
+        run_seconds, loaded = json.loads(output.stdout.strip().splitlines()[-1])
+        seconds.append(run_seconds)
+    return float(np.median(seconds)), loaded
+
+
+def import_benchmark(modules=('bruker_io', 'spectrum_stack',
+                              'spectrum_evaluation', 'spectrum_pipeline',
+                              'fit_queue', 'measurement_catalog'),
+                     file_name='M4_measurements/20200807_unknown_1.spx',
+                     repeats=5):
+    """ Function timing the import of each module and a parse-only worker
+
+    Parameters
+    ----------
+
+    modules : list of str
+        modules imported on their own
+    file_name : str ['M4_measurements/20200807_unknown_1.spx']
+        spectrum read by the worker run (skipped when None or missing)
+    repeats : int [5]
+        fresh interpreters per measurement
+
+    Returns
+    -------
+
+    list of (name, median seconds, heavy modules loaded)
+
+    """
+    results = [('numpy', ) + time_code('import numpy', repeats)]
+    for module in modules:
+        results.append((module, ) + time_code('import ' + module, repeats))
+    if file_name is not None and os.path.exists(file_name):
+        results.append(('parse-only worker', )
+                       + time_code(PARSE_WORKER.format(file_name=file_name),
+                                   repeats))
+    return results
+
+
+if __name__ == '__main__':
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    for name, seconds, loaded in import_benchmark(repeats=repeats):
+        print('{:22s} {:7.3f} s   {}'.format(name, seconds,
+                                             ', '.join(loaded) or '-'))
@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+"""
+.. module:: measurement_catalog
+   :platform: Windows
+   :synopsis: SQLite catalog of the header and grid metadata of every spectrum
+
+Created on Mon Oct 19 2026
+
+"""
+#
+
+############################
+#  20261019
+#
+#  Every .spx file under M4_measurements is indexed once into an SQLite
+#  table: file size, mtime and SHA-1, the detector and grid point from the
+#  file name, the stage position from the *XYZ.txt* file of its directory,
+#  and live/real time, calibration, shaping time and measurement date from
+#  the header (read lazily, the channels are not decoded).  Subsets are then
+#  selected with indexed queries instead of walking the directories and
+#  matching 'D1'/'det_1' in the file names.
+#
+#  refresh_catalog only rereads files whose size or mtime changed, adds new
+#  files and drops deleted ones; the stage positions are joined again on
+#  every refresh (m4_xyz_import keeps its own cache).
+#
+###########################
+#
+import hashlib
+import os
+import sqlite3
+from datetime import datetime
+import pandas as pd
+import bruker_io as bruker_io
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS spectra (
+    path TEXT PRIMARY KEY,
+    series TEXT NOT NULL,
+    file_name TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    hash TEXT NOT NULL,
+    detector INTEGER NOT NULL,
+    point TEXT NOT NULL,
+    row INTEGER NOT NULL,
+    col INTEGER NOT NULL,
+    x REAL,
+    y REAL,
+    z REAL,
+    life_time_in_ms REAL,
+    real_time_in_ms REAL,
+    calibration_abs REAL,
+    calibration_lin REAL,
+    no_channels INTEGER,
+    shaping_time REAL,
+    measured TEXT);
+CREATE INDEX IF NOT EXISTS spectra_series ON spectra (series, detector);
+CREATE INDEX IF NOT EXISTS spectra_grid ON spectra (series, row, col);
+CREATE INDEX IF NOT EXISTS spectra_point ON spectra (point);
+CREATE INDEX IF NOT EXISTS spectra_measured ON spectra (measured);
+CREATE INDEX IF NOT EXISTS spectra_hash ON spectra (hash);
+"""
+COLUMNS = ['path', 'series', 'file_name', 'size', 'mtime', 'hash', 'detector',
+           'point', 'row', 'col', 'life_time_in_ms', 'real_time_in_ms',
+           'calibration_abs', 'calibration_lin', 'no_channels',
+           'shaping_time', 'measured']
+
+
+def connect(database):
+    """opens (and creates when needed) a catalog file"""
+    connection = sqlite3.connect(database)
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def file_hash(file_name, block_size=1 << 20):
+    """SHA-1 of the content of a file"""
+    digest = hashlib.sha1()
+    with open(file_name, 'rb') as file:
+        for block in iter(lambda: file.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def scan_spectrum(file_name, series, stat=None):
+    """ catalog row (dict of COLUMNS) of one *.spx* file, from its name and
+    its header """
+    if stat is None:
+        stat = os.stat(file_name)
+    spx = bruker_io.FittingData(file_name)
+    bruker_io.bruker_spx_import(spx, lazy=True)
+    detector, point = bruker_io.detector_point_key(file_name)
+    row, col = bruker_io.grid_index(file_name)
+    try:
+        measured = datetime.strptime(
+            spx.date_measure + ' ' + spx.time_measure,
+            '%m/%d/%Y %I:%M:%S %p').isoformat(' ')
+    except ValueError:
+        measured = None
+    return {'path': file_name, 'series': series,
+            'file_name': os.path.basename(file_name),
+            'size': stat.st_size, 'mtime': stat.st_mtime,
+            'hash': file_hash(file_name), 'detector': int(detector),
+            'point': os.path.join(series, point), 'row': int(row),
+            'col': int(col), 'life_time_in_ms': float(spx.life_time_in_ms),
+            'real_time_in_ms': float(spx.real_time_in_ms),
+            'calibration_abs': float(spx.calibration_abs),
+            'calibration_lin': float(spx.calibration_lin),
+            'no_channels': int(spx.no_channels),
+            'shaping_time': float(spx.shaping_time), 'measured': measured}
+
+
+def stage_positions(directory_path, series):
+    """ x, y, z of each point key of a directory, from its *XYZ.txt* files
+    (matched through bruker_io.detector_point_key, so both detectors of a
+    point get its position) """
+    positions = {}
+    for file in sorted(os.listdir(directory_path)):
+        if not file.endswith('XYZ.txt'):
+            continue
+        xyz = bruker_io.m4_xyz_import(directory_path + '/' + file)
+        for stem, x, y, z in zip(xyz['stem'], xyz['x'], xyz['y'], xyz['z']):
+            point = os.path.join(series, bruker_io.detector_point_key(stem)[1])
+            positions.setdefault(point, (x, y, z))
+    return positions
+
+
+def refresh_catalog(database, root='M4_measurements'):
+    """ Function building or updating the catalog of every *.spx* file under
+    *root*
+
+    Parameters
+    ----------
+
+    database : str
+        catalog file (created when missing)
+    root : str ['M4_measurements']
+        directory searched recursively; the series of a spectrum is its
+        directory relative to *root* ('' for files directly in *root*)
+
+    Returns
+    -------
+
+    dict with the number of spectra 'added', 'updated', 'removed' and
+    'unchanged'
+
+    """
+    connection = connect(database)
+    counts = {'added': 0, 'updated': 0, 'removed': 0, 'unchanged': 0}
+    try:
+        known = {path: (size, mtime) for path, size, mtime in
+                 connection.execute('SELECT path, size, mtime FROM spectra')}
+        found = set()
+        positions = {}
+        for (dirpath, dirnames, filenames) in os.walk(root):
+            dirnames.sort()
+            series = os.path.relpath(dirpath, root).replace('\\', '/')
+            if series == '.':
+                series = ''
+            spx_files = [file for file in sorted(filenames)
+                         if file.endswith('.spx')]
+            if not spx_files:
+                continue
+            positions.update(stage_positions(dirpath, series))
+            for file in spx_files:
+                file_name = dirpath.replace('\\', '/') + '/' + file
+                found.add(file_name)
+                stat = os.stat(file_name)
+                if known.get(file_name) == (stat.st_size, stat.st_mtime):
+                    counts['unchanged'] += 1
+                    continue
+                row = scan_spectrum(file_name, series, stat)
+                counts['updated' if file_name in known else 'added'] += 1
+                connection.execute(
+                    'INSERT OR REPLACE INTO spectra (' + ', '.join(COLUMNS)
+                    + ') VALUES (' + ', '.join('?'*len(COLUMNS)) + ')',
+                    [row[column] for column in COLUMNS])
+        removed = [(path,) for path in known if path not in found]
+        connection.executemany('DELETE FROM spectra WHERE path = ?', removed)
+        counts['removed'] = len(removed)
+        connection.execute('UPDATE spectra SET x = NULL, y = NULL, z = NULL')
+        connection.executemany(
+            'UPDATE spectra SET x = ?, y = ?, z = ? WHERE point = ?',
+            [(float(x), float(y), float(z), point)
+             for point, (x, y, z) in positions.items()])
+        connection.commit()
+    finally:
+        connection.close()
+    return counts
+
+
+def query_catalog(database, sql, parameters=()):
+    """result of any SQL query on the catalog as a DataFrame"""
+    connection = connect(database)
+    try:
+        return pd.read_sql_query(sql, connection, params=parameters)
+    finally:
+        connection.close()
+
+
+def select_spectra(database, series=None, detector=None, row=None, col=None,
+                   measured_from=None, measured_to=None):
+    """ Function selecting catalogued spectra
+
+    Parameters
+    ----------
+
+    database : str
+        catalog file
+    series : str [None]
+        directory of the series, e.g. 'SRM_1831_300s_20x20'
+    detector : int [None]
+        1 or 2 (0 for files without a detector tag)
+    row, col : int [None]
+        grid point
+    measured_from, measured_to : str [None]
+        'YYYY-MM-DD[ HH:MM:SS]' limits of the measurement time
+
+    Returns
+    -------
+
+    pandas.DataFrame of the catalog rows, sorted by series, detector and
+    grid point (criteria left as None are not applied)
+
+    """
+    conditions = []
+    parameters = []
+    for column, value in (('series', series), ('detector', detector),
+                          ('row', row), ('col', col)):
+        if value is not None:
+            conditions.append(column + ' = ?')
+            parameters.append(value)
+    if measured_from is not None:
+        conditions.append('measured >= ?')
+        parameters.append(measured_from)
+    if measured_to is not None:
+        conditions.append('measured <= ?')
+        parameters.append(measured_to)
+    sql = 'SELECT * FROM spectra'
+    if conditions:
+        sql = sql + ' WHERE ' + ' AND '.join(conditions)
+    sql = sql + ' ORDER BY series, detector, row, col, file_name'
+    return query_catalog(database, sql, parameters)
+
+
+def catalog_files(database, **criteria):
+    """paths of the spectra chosen by select_spectra(**criteria), e.g. for
+    spectrum_stack.load_spx_stack"""
+    return list(select_spectra(database, **criteria)['path'])
+
+
+###########################
+#  20261019
+#  Command line: python measurement_catalog.py M4_catalog.sqlite [root]
+#
+if __name__ == '__main__':
+    import sys
+    print(refresh_catalog(*sys.argv[1:3]))
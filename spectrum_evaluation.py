@@ -8,13 +8,22 @@ Fortran code converted into Python
 """
 
 import numpy as np
-import scipy as sp
-import scipy.signal as signal
 from os import walk
 import bruker_io as bruker_io
-import hyperspy as hs
+import spectrum_stack as spectrum_stack
 import copy
-import pandas as pd
+
+###########################
+#  20261019
+#  hyperspy, pandas and scipy are imported inside the functions that use
+#  them: importing this module (for the SPX reader, SNIP or the pile-up
+#  correction) then costs numpy only, and hyperspy, which takes seconds to
+#  load, is only loaded by a worker that actually fits.  It is imported
+#  through its public entry point hyperspy.api, which loads hs.signals; a
+#  fresh worker process has not imported it beforehand as the notebooks do.
+#  A module is loaded once per process, later imports are a dictionary
+#  lookup.  See import_benchmark.py.
+#
 
 # Savitsky and Golay Poly Smoothing (pg 315 in Fortran)
 #
@@ -89,6 +98,71 @@ def SNIPBG(Y, NCHAN, ICH1, ICH2, FWHM, NREDUC, NITER):
     return YBACK
 
 
+###########################
+#  20261019
+#  SGSMITH and SNIPBG for a stack of spectra Y [n_spectra, NCHAN], all with
+#  the same ICH1, ICH2, FWHM, NREDUC and NITER.  Each row is bit for bit the
+#  output of SNIPBG on that row: the same float64 operations are done in
+#  the same order, only on whole columns of the stack at once.
+#  The stripping keeps the in-place channel scan of SNIPBG, where channel i
+#  sees channel i-IW already stripped in this pass and channel i+IW not yet.
+#  Within a run of IW channels no channel is a neighbour of another, so a
+#  run is updated in one step from the values left by the previous runs;
+#  channel 0 is done on its own when ICH1 = 0, being the (clipped) left
+#  neighbour of the channels below IW.  A pass then takes about NCHAN/IW
+#  numpy steps instead of NCHAN, and the N spectra share them.
+#
+def SGSMITHBATCH(Y, NCHAN, ICH1, ICH2, IWID):
+    Y = np.atleast_2d(Y)
+    IW = np.min([IWID, 51])
+    C = np.zeros(IW)
+    M = np.int((IW-1)/2)
+    SUM = (2*M-1)*(2*M+1)*(2*M+3)
+    for j in np.arange(IW):
+        C[j] = 3*(3*M**2 + 3*M-1-5*(j-M)**2)
+    JCH1 = np.max([ICH1, M])
+    JCH2 = np.min([ICH2, NCHAN-1-M])
+    S = np.zeros((Y.shape[0], NCHAN))
+    if JCH2 > JCH1:
+        for j in np.arange(IW):
+            S[:, JCH1:JCH2] = S[:, JCH1:JCH2] + C[j]*Y[:, JCH1+(j-M):JCH2+(j-M)]
+        S[:, JCH1:JCH2] = S[:, JCH1:JCH2]/SUM
+    return S
+
+
+def SNIPBGBATCH(Y, NCHAN, ICH1, ICH2, FWHM, NREDUC, NITER):
+    IW = np.int(FWHM)
+    I1 = np.max([ICH1-IW, 0])
+    I2 = np.min([ICH2+IW, NCHAN-1])
+    YBACK = SGSMITHBATCH(Y, NCHAN, I1, I2, IW)
+    zeros = np.zeros(NCHAN)
+    YBACK = np.sqrt(np.maximum(YBACK, zeros))
+    REDFAC = 1
+    for n in np.arange(0, NITER):
+        if n+1 > NITER-NREDUC:
+            REDFAC = REDFAC/np.sqrt(2)
+        IW = np.max([np.int(REDFAC*FWHM), 1])
+        i = ICH1
+        if i == 0 and i < ICH2:
+            YBACK[:, 0] = np.minimum(YBACK[:, 0],
+                                     0.5*(YBACK[:, 0]+YBACK[:, np.min([IW, NCHAN-1])]))
+            i = 1
+        while i < ICH2:
+            END = np.min([i+IW, ICH2])
+            if i-IW >= 0:
+                LEFT = YBACK[:, i-IW:END-IW]
+            else:
+                LEFT = YBACK[:, np.maximum(np.arange(i, END)-IW, 0)]
+            if END-1+IW <= NCHAN-1:
+                RIGHT = YBACK[:, i+IW:END+IW]
+            else:
+                RIGHT = YBACK[:, np.minimum(np.arange(i, END)+IW, NCHAN-1)]
+            YBACK[:, i:END] = np.minimum(YBACK[:, i:END], 0.5*(LEFT+RIGHT))
+            i = END
+    YBACK = np.square(YBACK)
+    return YBACK
+
+
 # TOPHAT TOPHAT filtering protram (pg 323)
 #
 # Input:  IN        Spectrum
@@ -178,6 +252,7 @@ def TOPHATFAST(IN, NCHAN, IWIDTH, MODE):
     #print('tophat_var: ',tophat_var)
     #print('tophat: ', np.sum(tophat))
     #print(tophat)
+    import scipy.signal as signal
     # call to scipy.signal for S.G. filter
     IN = signal.savgol_filter(IN, IWIDTH, 2)
     if MODE == 0:
@@ -209,15 +284,19 @@ def TOPHATFAST(IN, NCHAN, IWIDTH, MODE):
 # comment:  uses subroutine SGSMITH
 
 
-def SNIPFAST (Y, NCHAN, FWHM, NREDUC, NITER):
+def SNIPFAST (Y, NCHAN, FWHM, NREDUC, NITER, dtype=None):
+    # dtype: working precision (float32/float64), spectrum_stack.PRECISION
+    # when None; every array of the loop is kept in that type
+    dtype = spectrum_stack.working_dtype(dtype)
+    import scipy.signal as signal
     REDFAC = 1
     if np.mod(FWHM,2) == 0: FWHM = FWHM + 1
     #Smooth spectrum using scipy.signal function of S.G.
-    YBACK = Y
+    YBACK = np.asarray(Y, dtype=dtype)
     #YBACK = signal.savgol_filter(Y, FWHM, 2 )
     #initialize two NCHAN arrays for calulation of sums
-    zeros = np.zeros(NCHAN)
-    YBACK_sum = np.zeros(NCHAN)
+    zeros = np.zeros(NCHAN, dtype=dtype)
+    YBACK_sum = np.zeros(NCHAN, dtype=dtype)
 
     # we are using a non linear square/square root scaling circa Van espen    
     YBACK = np.sqrt(np.maximum(YBACK, zeros))
@@ -231,11 +310,11 @@ def SNIPFAST (Y, NCHAN, FWHM, NREDUC, NITER):
         #Allow for a reduction in 'FWHM' over loops with a minimum IW of 1
         IW = np.max([np.int(REDFAC*FWHM),1])
         #make a function [1,0,0,0,...1] width 2W+1 for convolve
-        straddle = np.zeros(2*IW+1)
+        straddle = np.zeros(2*IW+1, dtype=dtype)
         straddle[0]=1
         straddle[-1]=1
         # use scipy.signal.convolve to determine +/- average for test
-        YBACK_sum = 0.5*signal.convolve(YBACK, straddle, mode='same')
+        YBACK_sum = dtype.type(0.5)*signal.convolve(YBACK, straddle, mode='same')
         YBACK = np.minimum(YBACK, YBACK_sum) 
     # we are using a non linear square/square root scaling circa Van espen
     YBACK = np.square(YBACK)
@@ -245,9 +324,55 @@ def SNIPFAST (Y, NCHAN, FWHM, NREDUC, NITER):
     return YBACK
 
 
-
-
-def pulse_pileup_removal(fittingdata):
+###########################
+#  20261019
+#  SNIPFAST for many spectra, each row with its own FWHM, NREDUC and NITER.
+#  The clipping window schedule of every distinct setting is computed as in
+#  SNIPFAST, then every iteration updates all rows at once: the rows are
+#  held with PAD zero channels on both sides, so the +/- IW neighbours of a
+#  row are two slices (the zero padding is the zero fill of convolve 'same').
+#  Rows that have done their NITER iterations are left untouched.  Each row
+#  equals SNIPFAST of that row.
+#
+def SNIPFASTBATCH(Y, FWHM, NREDUC, NITER, dtype=None):
+    dtype = spectrum_stack.working_dtype(dtype)
+    Y = np.atleast_2d(np.asarray(Y, dtype=dtype))
+    ROWS, NCHAN = Y.shape
+    FWHM, NREDUC, NITER = [np.broadcast_to(np.asarray(P, dtype=int), (ROWS,))
+                           for P in (FWHM, NREDUC, NITER)]
+    SETTINGS, ROW_SETTING = np.unique(np.column_stack((FWHM, NREDUC, NITER)),
+                                      axis=0, return_inverse=True)
+    # IW[k, n]: window of setting k at iteration n (0 once finished)
+    IW = np.zeros((len(SETTINGS), np.max(NITER)), dtype=int)
+    for k, (WIDTH, REDUC, ITER) in enumerate(SETTINGS):
+        REDFAC = 1
+        if np.mod(WIDTH,2) == 0: WIDTH = WIDTH + 1
+        for n in np.arange(0, ITER):
+            if n+1 > ITER-REDUC:
+                REDFAC = REDFAC/np.sqrt(2)
+            IW[k, n] = np.max([np.int(REDFAC*WIDTH),1])
+    ROW_SETTING = np.ravel(ROW_SETTING)
+    PAD = np.max(IW)
+    YBACK = np.zeros((ROWS, NCHAN + 2*PAD), dtype=dtype)
+    YBACK[:, PAD:PAD+NCHAN] = np.sqrt(np.maximum(Y, 0))
+    HALF = dtype.type(0.5)
+    for n in np.arange(IW.shape[1]):
+        for k in np.unique(IW[:, n][IW[:, n] > 0]):
+            W = IW[:, n] == k
+            if np.all(W):
+                ROW = slice(None)
+            else:
+                ROW = np.nonzero(W[ROW_SETTING])[0]
+            YBACK_sum = HALF*(YBACK[ROW, PAD-k:PAD-k+NCHAN]
+                              + YBACK[ROW, PAD+k:PAD+k+NCHAN])
+            YBACK[ROW, PAD:PAD+NCHAN] = np.minimum(
+                YBACK[ROW, PAD:PAD+NCHAN], YBACK_sum)
+    return np.square(YBACK[:, PAD:PAD+NCHAN])
+
+
+
+
+def pulse_pileup_removal(fittingdata, dtype=None):
     """Removal tool for first-order pulse-pileups in XRF data.
     
     Parameters
@@ -256,79 +381,164 @@ def pulse_pileup_removal(fittingdata):
     energy_scale : array of MCA energy at each channel (in eVs)
     channels : array from MCA giving counts in each channel
     shaping_time : events per second that can be processed
+    dtype : working precision, spectrum_stack.PRECISION when None
     
 
     Examples
     --------
     
     """
-    pos_channels = \
-    fittingdata.channels[np.nonzero(fittingdata.energy_scale>0)[0][0]:-1]
-    pos_channels_per_s = pos_channels/(fittingdata.life_time_in_ms/1000)
-    pileup_sum = np.zeros(len(pos_channels))   
+    corrected = pileup_corrected(
+        fittingdata.channels, fittingdata.energy_scale,
+        fittingdata.life_time_in_ms, fittingdata.shaping_time, dtype)
+    if fittingdata.channels.dtype.kind == 'u':
+        # the correction can go below zero, which unsigned counts would wrap
+        fittingdata.channels = np.trunc(corrected).astype(np.int64)
+    else:
+        fittingdata.channels[:] = corrected
+    return 
+    
+       
+def SCALEDSNIP(fittingdata, dtype=None):
+    fittingdata.channels[:] = snip_corrected(
+        fittingdata.channels, fittingdata.energy_scale, dtype=dtype)
+    return
+
+
+def polycap_remove(fittingdata, dtype=None):
+    fittingdata.channels = polycap_corrected(
+        fittingdata.channels, fittingdata.energy_scale, dtype=dtype)
+    return
+
+
+###########################
+#  20261019
+#  Pure array versions of the preprocessing stages of spectra_fit.  Each
+#  takes the counts and energy scale (keV) of one spectrum, leaves them
+#  untouched and returns a new array in the working precision.  The
+#  FittingData functions above write the result back into the spectrum (the
+#  integer channels of bruker_spx_import truncate it to whole counts, as
+#  before; pulse_pileup_removal moves unsigned counts to int64 first, since
+#  its result can be negative).
+#
+def pileup_corrected(channels, energy_scale, life_time_in_ms, shaping_time,
+                     dtype=None):
+    """ counts corrected for first-order pulse pile-up (see
+    pulse_pileup_removal) """
+    dtype = spectrum_stack.working_dtype(dtype)
+    corrected = np.array(channels, dtype=dtype)
+    first = np.nonzero(energy_scale>0)[0][0]
+    pos_channels = np.asarray(channels)[first:-1]
+    pos_channels_per_s = \
+    (pos_channels/(life_time_in_ms/1000)).astype(dtype)
+    pileup_sum = np.zeros(len(pos_channels), dtype=dtype)
     for i in np.arange(100,len(pos_channels)):
         forward = pos_channels_per_s[0:i]
         reverse = np.flip(forward, axis=0)
-        shape_factor = (0.006/fittingdata.shaping_time)
+        shape_factor = (0.006/shaping_time)
         pileup = shape_factor*(forward)*(reverse)
         pileup_sum[i] = sum(pileup)
-    fittingdata.channels[np.nonzero(fittingdata.energy_scale>0)[0][0]:-1] = \
-    (pos_channels_per_s - pileup_sum) * (fittingdata.life_time_in_ms/1000)
-    return 
-    
-       
-def SCALEDSNIP(fittingdata):
-    pos_energy_scale = \
-    fittingdata.energy_scale[np.nonzero(fittingdata.energy_scale>0)[0][0]:-1]
-    pos_channels = \
-    fittingdata.channels[np.nonzero(fittingdata.energy_scale>0)[0][0]:-1]
+    corrected[first:-1] = \
+    (pos_channels_per_s - pileup_sum) * (life_time_in_ms/1000)
+    return corrected
+
+
+def snip_corrected(channels, energy_scale, FWHM=13, NREDUC=10, NITER=1000,
+                   dtype=None):
+    """ counts with the SNIP continuum removed, SNIPFAST being run on a
+    square root energy axis where the peak widths are nearly constant (see
+    SCALEDSNIP) """
+    dtype = spectrum_stack.working_dtype(dtype)
+    energy_scale_sqrt, channels_sqrt = sqrt_axis_resample(
+        channels, energy_scale, dtype)
+    data_bg = SNIPFAST(channels_sqrt, len(channels_sqrt), FWHM, NREDUC, NITER,
+                       dtype=dtype)
+    #data_bg = SNIPBG(channels_sqrt, len(channels_sqrt), 0, len(channels_sqrt)-1, 13, 10, 1000)
+    new_data_corr = channels_sqrt - data_bg
+    return sqrt_axis_restore(channels, energy_scale, energy_scale_sqrt,
+                             new_data_corr, dtype)
+
+
+def sqrt_axis_resample(channels, energy_scale, dtype=None):
+    """ the positive energy channels resampled on an axis linear in the
+    square root of the energy; returns (energy_scale_sqrt, channels_sqrt) """
+    import scipy.interpolate as interpolate
+    dtype = spectrum_stack.working_dtype(dtype)
+    first = np.nonzero(energy_scale>0)[0][0]
+    pos_energy_scale = energy_scale[first:-1]
+    pos_channels = np.asarray(channels, dtype=dtype)[first:-1]
     spectrum_function = \
-    sp.interpolate.interp1d(np.sqrt(pos_energy_scale),
-                            pos_channels, kind = 'linear',
-                            fill_value = (0,0), bounds_error = False )
+    interpolate.interp1d(np.sqrt(pos_energy_scale),
+                         pos_channels, kind = 'linear',
+                         fill_value = (0,0), bounds_error = False )
     energy_scale_sqrt = np.arange(0,np.sqrt(max(pos_energy_scale)),
                                   np.sqrt(max(pos_energy_scale))
                                   /len(pos_channels))
-    channels_sqrt = spectrum_function(energy_scale_sqrt)
-    data_bg = SNIPFAST(channels_sqrt, len(channels_sqrt), 13, 10, 1000)
-    #data_bg = SNIPBG(channels_sqrt, len(channels_sqrt), 0, len(channels_sqrt)-1, 13, 10, 1000)
-    new_data_corr = channels_sqrt - data_bg
+    channels_sqrt = spectrum_function(energy_scale_sqrt).astype(dtype)
+    return energy_scale_sqrt, channels_sqrt
+
+
+def sqrt_axis_restore(channels, energy_scale, energy_scale_sqrt,
+                      corrected_sqrt, dtype=None):
+    """ *channels* with the positive energy channels replaced by
+    *corrected_sqrt* resampled back from the square root axis and clipped at
+    0; *corrected_sqrt* may hold several rows [..., len(energy_scale_sqrt)] """
+    import scipy.interpolate as interpolate
+    dtype = spectrum_stack.working_dtype(dtype)
+    corrected_sqrt = np.asarray(corrected_sqrt)
+    corrected = np.array(np.broadcast_to(
+        channels, corrected_sqrt.shape[:-1] + (len(energy_scale),)),
+        dtype=dtype)
+    first = np.nonzero(energy_scale>0)[0][0]
+    pos_energy_scale = energy_scale[first:-1]
     spectrum_function_squared = \
-    sp.interpolate.interp1d(np.square(energy_scale_sqrt), 
-                            new_data_corr, kind = 'linear', 
-                            fill_value = (0,0), bounds_error = False )
-    channels_corr = spectrum_function_squared(pos_energy_scale)
-    channels_corr = channels_corr.clip(min=0)
-    fittingdata.channels[np.nonzero(fittingdata.energy_scale>0)[0][0]:-1] = \
-    channels_corr
-    return
-
-
-def polycap_remove(fittingdata):
-    number_of_points = 40 #changed from 40 on 20190725 dw
+    interpolate.interp1d(np.square(energy_scale_sqrt), 
+                         corrected_sqrt, kind = 'linear', axis = -1,
+                         fill_value = (0,0), bounds_error = False )
+    channels_corr = spectrum_function_squared(pos_energy_scale).astype(dtype)
+    corrected[..., first:-1] = channels_corr.clip(min=0)
+    return corrected
+
+
+def polycap_corrected(channels, energy_scale, number_of_points=40,
+                      dtype=None):
+    """ counts with the polycapillary transmission background removed: a
+    cubic spline through the minimum count of *number_of_points* windows
+    (see polycap_remove); *channels* may hold several spectra
+    [..., n_channels] on the same energy scale """
+    import scipy.interpolate as interpolate
+    dtype = spectrum_stack.working_dtype(dtype)
+    channels = np.asarray(channels)
     scaling = int(4000/number_of_points)
     bg_energy_scale = np.zeros(number_of_points)
-    bg_channels = np.zeros(number_of_points)
+    bg_channels = np.zeros(channels.shape[:-1] + (number_of_points,),
+                           dtype=dtype)
     for i in np.arange(bg_energy_scale.shape[0]):
-        bg_energy_scale[i] = fittingdata.energy_scale[i*scaling + 100]
-        bg_channels[i] = np.min(fittingdata.channels[i*scaling + 50:(i+1)*scaling+50])
+        bg_energy_scale[i] = energy_scale[i*scaling + 100]
+        bg_channels[..., i] = np.min(
+            channels[..., i*scaling + 50:(i+1)*scaling+50], axis=-1)
     bg_function = \
-    sp.interpolate.interp1d(bg_energy_scale, bg_channels, kind = 'cubic',
-                            fill_value = (0,0), bounds_error = False)
-    bg_intensity = bg_function(fittingdata.energy_scale)
+    interpolate.interp1d(bg_energy_scale, bg_channels, kind = 'cubic',
+                         axis = -1, fill_value = (0,0),
+                         bounds_error = False)
+    bg_intensity = bg_function(energy_scale).astype(dtype)
     bg_intensity = bg_intensity.clip(min=0)
-    bg_corrected = fittingdata.channels - bg_intensity
-    fittingdata.channels = bg_corrected.clip(min=0)
-    return
+    bg_corrected = channels.astype(dtype) - bg_intensity
+    return bg_corrected.clip(min=0)
         
 
 
 
-def spectra_fit(directory_path, fitter, method, elements):
+def spectra_fit(directory_path, fitter, method, elements, pipeline=None):
+    # pipeline: spectrum_pipeline.SpectrumPipeline replacing the fixed
+    # pileup/SCALEDSNIP/polycap preprocessing; its stage outputs are cached,
+    # so refitting with one stage retuned only reruns that stage and the fit;
+    # spectrum_pipeline.default_pipeline() gives the same spectra as None
     files = []
     spx_files =[]
     roi_data = elements
     model_data = elements
+    import pandas as pd
     print(elements)
     life_time_in_ms = []
     for (dirpath, dirnames, filenames) in walk(directory_path):
@@ -340,36 +550,10 @@ def spectra_fit(directory_path, fitter, method, elements):
     for file in spx_files:
         print(file)
         spx_file = file
-        spx = bruker_io.FittingData(directory_path + '/' + spx_file)
-        bruker_io.bruker_spx_import(spx)
-        pulse_pileup_removal(spx)
-        SCALEDSNIP(spx)
-        polycap_remove(spx)
-        hsEDS = hs.signals.EDSSEMSpectrum(spx.channels)
-        hsEDS.set_microscope_parameters(50000)
-        hsEDS.axes_manager[0].name = 'XRF spectra'
-        hsEDS.axes_manager[0].offset = spx.calibration_abs
-        hsEDS.axes_manager[0].scale = spx.calibration_lin
-        hsEDS.axes_manager[0].units = 'eV'
-        hsEDS.add_elements(elements)
-        hsEDS.add_lines()
-        line_names = hsEDS.metadata.Sample.xray_lines
-        #print(line_names)
-        mod = hsEDS.create_model()
-        mod.remove('background_order_6')
-        new_roi = np.zeros(len(elements))
-        new_model = np.zeros(len(elements))
-        mod.fit(fitter= fitter, method= method)
-        for i in np.arange(len(elements)):
-            new_roi[i] = np.float(hsEDS.get_lines_intensity([line_names[i]])[0].data[0])
-            model_call = ''.join(['mod.components.',line_names[i],'.A.value'])
-            new_model[i] = eval(model_call)
-            #test_param[i] = ''.join(['mod.components.', line_names[i], '.A.value'])
-            #new_model[i]= np.float(test_param)
-        #Hf_La_model.append(np.float())
-        #Si_Ka_model.append(np.float(mod.components.Si_Ka.A.value))
-        #Hf_Si_ratio.append(np.float(mod.components.Hf_La.A.value)/np.float(mod.components.Si_Ka.A.value))
-        life_time_in_ms.append(spx.life_time_in_ms)
+        line_names, new_roi, new_model, new_life_time = spectrum_fit(
+            directory_path + '/' + spx_file, fitter, method, elements,
+            pipeline)
+        life_time_in_ms.append(new_life_time)
         roi_data = np.vstack((roi_data,new_roi))
         model_data = np.vstack((model_data,new_model))
     roi_data = roi_data[1:,:]
@@ -390,6 +574,59 @@ def spectra_fit(directory_path, fitter, method, elements):
     model_df['life time in ms'] = life_time_in_ms
     return roi_df, model_df
 
+
+###########################
+#  20261019
+#  The fit of one spectrum, taken out of the loop of spectra_fit so that
+#  single files can be fitted on their own (see fit_queue).
+#
+def spectrum_fit(file_name, fitter, method, elements, pipeline=None):
+    """ preprocesses and fits one *.spx* file as spectra_fit does
+
+    Returns
+    -------
+
+    (line_names, roi, model, life_time_in_ms) with the ROI intensity and
+    the model area of each line
+
+    """
+    import hyperspy.api as hs
+    spx = bruker_io.FittingData(file_name)
+    bruker_io.bruker_spx_import(spx)
+    if pipeline is None:
+        pulse_pileup_removal(spx)
+        SCALEDSNIP(spx)
+        polycap_remove(spx)
+    else:
+        spx.channels = pipeline.run_spectrum(
+            spx.channels, spx.energy_scale, spx.life_time_in_ms,
+            spx.shaping_time, spx.calibration_abs, spx.calibration_lin)
+    hsEDS = hs.signals.EDSSEMSpectrum(spx.channels)
+    hsEDS.set_microscope_parameters(50000)
+    hsEDS.axes_manager[0].name = 'XRF spectra'
+    hsEDS.axes_manager[0].offset = spx.calibration_abs
+    hsEDS.axes_manager[0].scale = spx.calibration_lin
+    hsEDS.axes_manager[0].units = 'eV'
+    hsEDS.add_elements(elements)
+    hsEDS.add_lines()
+    line_names = hsEDS.metadata.Sample.xray_lines
+    #print(line_names)
+    mod = hsEDS.create_model()
+    mod.remove('background_order_6')
+    new_roi = np.zeros(len(elements))
+    new_model = np.zeros(len(elements))
+    mod.fit(fitter= fitter, method= method)
+    for i in np.arange(len(elements)):
+        new_roi[i] = np.float(hsEDS.get_lines_intensity([line_names[i]])[0].data[0])
+        model_call = ''.join(['mod.components.',line_names[i],'.A.value'])
+        new_model[i] = eval(model_call)
+        #test_param[i] = ''.join(['mod.components.', line_names[i], '.A.value'])
+        #new_model[i]= np.float(test_param)
+    #Hf_La_model.append(np.float())
+    #Si_Ka_model.append(np.float(mod.components.Si_Ka.A.value))
+    #Hf_Si_ratio.append(np.float(mod.components.Hf_La.A.value)/np.float(mod.components.Si_Ka.A.value))
+    return line_names, new_roi, new_model, spx.life_time_in_ms
+
 #def model_lookup(mod, line_name):
 #    model_call = {'N_Ka': mod.components.N_Ka.A.value,
 #                  'O_Ka': mod.components.O_Ka.A.value,
@@ -462,47 +699,174 @@ def spectra_fit(directory_path, fitter, method, elements):
 
 
 
-#Work in progress - it performs a tophat on the fly, and is very
-#confusing to read through 20190401 daw    
-## Peak Search - LOCPEAKS uses tophyhat filter
-##
-## Input:  Y           Spectrum
-##         NCHAN       Number of channels
-##         R           Peak search sensitivity factor (typcially 2 to 4)
-##         IWID        Width of the filter, approx, FWHM of the peaks
-##         MAXP        Maxiumum number of peaks allowed (sets max arrays)
-## OUtput: NPEAK       Number of peaks found
-##         IPOS        Array of peak positions
+# Peak Search - LOCPEAKS uses tophat filter (pg 325 in Fortran)
+# (completed 20261019 - vectorized over a stack of spectra with
+#  running sums, instead of the on-the-fly tophat of the Fortran code)
+#
+# Input:  Y           Spectrum (or stack of spectra, one per row)
+#         NCHAN       Number of channels
+#         IWID        Width of the filter, approx, FWHM of the peaks
+#         R           Peak search sensitivity factor (typcially 2 to 4)
+#         MAXP        Maxiumum number of peaks allowed (sets max arrays)
+# Output: NPEAK       Number of peaks found
+#         IPOS        Array of peak positions
 #
-#def LOCPEAKS (Y, NCHAN, IWID, R, MAXP):
-#    # Width of filter (number of channels in the tophat)
-#    # must be odd and at least 3
-#    NP = np.int(np.max([(IWID/2)*2 + 1, 3]))
-#    print ("NP: ", NP)
-#    NPEAKS = 0 #initiallize the number of peaks 
-#    # Calculate the half width and start and stop channel
-#    N = np.int(NP/2)
-#    I1 = NP
-#    I2 = NCHAN - NP
-#    # INisitalize the running sums
-#    I = I1
-#    TOTAL = 0
-#    TOP = 0
-#    for i in np.arange(2*NP+1):
-#        TOTAL = TOTAL + Y[i]
-#    print("TOTAL: ", TOTAL)
-#    for i in np.arange(2*N+1):
-#        TOP = TOP + (i)
-#    print("TOP: ", TOP)
-#    #Loop ofver all channels
-#    LASTPOS = 0
-#    SENS = R**2
-#    FI = 0
-#    FNEXT = 0
-#    SNEXT = 0
-#    for i in np.arange(I2-I1):
-#        TOP = TOP - Y[i+I1 - N] + Y[i+I1 + N]
-#        TOTAL = TOTAL - Y[i+I1-NP] + Y[i+I1+NP]
-#    print("TOP: ", TOP)
-#    print("TOTAL: ", TOTAL)
-#    return
\ No newline at end of file
+# The top of the hat covers NP = 2N+1 channels (NP odd and at least 3), the
+# total filter 2NP+1 channels, so the two negative wings hold NP+1 channels.
+# With running (cumulative) sums TOP and TOTAL the filtered spectrum and its
+# variance are
+#         F   = TOP/NP - (TOTAL-TOP)/(NP+1)
+#         VAR = TOP/NP**2 + (TOTAL-TOP)/(NP+1)**2
+# and a peak is found where F is a local maximum and F**2 > R**2*VAR.
+
+def TOPHATSUMS(Y, IWID):
+    Y = np.atleast_2d(np.asarray(Y, dtype=float))
+    NCHAN = Y.shape[-1]
+    NP = int(np.max([(IWID//2)*2 + 1, 3]))
+    N = NP//2
+    # running sums with a leading zero: SUMS[:, i] = sum of Y[:, :i]
+    SUMS = np.zeros((Y.shape[0], NCHAN + 1))
+    SUMS[:, 1:] = np.cumsum(Y, axis=1)
+    F = np.zeros(Y.shape)
+    VAR = np.zeros(Y.shape)
+    I = np.arange(NP, NCHAN - NP)
+    TOP = SUMS[:, I + N + 1] - SUMS[:, I - N]
+    TOTAL = SUMS[:, I + NP + 1] - SUMS[:, I - NP]
+    F[:, I] = TOP/NP - (TOTAL - TOP)/(NP + 1)
+    VAR[:, I] = TOP/NP**2 + (TOTAL - TOP)/(NP + 1)**2
+    return F, VAR
+
+
+def LOCPEAKS(Y, NCHAN, IWID, R, MAXP):
+    F, VAR = TOPHATSUMS(np.atleast_2d(Y)[:, :NCHAN], IWID)
+    POS, SIG = PEAKSELECT(F, VAR, R, MAXP, IWID)
+    IPOS = np.round(POS[0][np.isfinite(POS[0])]).astype(int)
+    NPEAK = len(IPOS)
+    return NPEAK, np.sort(IPOS)
+
+
+def PEAKSELECT(F, VAR, R, MAXP, IWID):
+    # significant local maxima of the filtered spectra, the MAXP most
+    # significant kept per spectrum; a maximum within IWID channels of a
+    # more significant one is dropped; positions are refined by a parabola
+    # through the three channels around each maximum
+    # returns POS, SIG [n_spectra, MAXP] (NaN where fewer peaks were found)
+    import scipy.ndimage as ndimage
+    SENS = R**2
+    LOCALMAX = np.zeros(F.shape, dtype=bool)
+    LOCALMAX[:, 1:-1] = (F[:, 1:-1] > F[:, :-2]) & (F[:, 1:-1] >= F[:, 2:])
+    FOUND = LOCALMAX & (F > 0) & (F**2 > SENS*VAR)
+    SIG = np.full(F.shape, -np.inf)
+    SIG[FOUND] = F[FOUND]/np.sqrt(VAR[FOUND])
+    SIG[SIG < ndimage.maximum_filter1d(SIG, size=2*(IWID//2) + 1, axis=1)] = -np.inf
+    ORDER = np.argsort(-SIG, axis=1)[:, :MAXP]
+    ROWS = np.arange(F.shape[0])[:, np.newaxis]
+    SIGKEEP = SIG[ROWS, ORDER]
+    LEFT = F[ROWS, np.maximum(ORDER - 1, 0)]
+    CENTER = F[ROWS, ORDER]
+    RIGHT = F[ROWS, np.minimum(ORDER + 1, F.shape[1] - 1)]
+    CURVE = LEFT - 2*CENTER + RIGHT
+    with np.errstate(divide='ignore', invalid='ignore'):
+        SHIFT = np.where(CURVE < 0, 0.5*(LEFT - RIGHT)/CURVE, 0)
+    POS = ORDER + SHIFT
+    MISSING = ~np.isfinite(SIGKEEP)
+    POS[MISSING] = np.nan
+    SIGKEEP[MISSING] = np.nan
+    return POS, SIGKEEP
+
+
+# X-ray line energies (keV) used to name the peaks found by peak_search,
+# named as the hyperspy lines (Element_Line).  Only the main K and L lines
+# of the elements met in these XRF measurements are listed.
+XRF_LINES = {
+    'C_Ka': 0.277, 'N_Ka': 0.392, 'O_Ka': 0.525, 'F_Ka': 0.677,
+    'Ne_Ka': 0.849, 'Na_Ka': 1.041, 'Na_Kb': 1.071, 'Mg_Ka': 1.254,
+    'Mg_Kb': 1.302, 'Al_Ka': 1.487, 'Al_Kb': 1.557, 'Si_Ka': 1.740,
+    'Si_Kb': 1.836, 'P_Ka': 2.014, 'P_Kb': 2.139, 'S_Ka': 2.308,
+    'S_Kb': 2.464, 'Cl_Ka': 2.622, 'Cl_Kb': 2.816, 'Ar_Ka': 2.957,
+    'Ar_Kb': 3.190, 'K_Ka': 3.314, 'K_Kb': 3.590, 'Ca_Ka': 3.692,
+    'Ca_Kb': 4.013, 'Sc_Ka': 4.091, 'Sc_Kb': 4.461, 'Ti_Ka': 4.511,
+    'Ti_Kb': 4.932, 'V_Ka': 4.952, 'V_Kb': 5.427, 'Cr_Ka': 5.415,
+    'Cr_Kb': 5.947, 'Mn_Ka': 5.899, 'Mn_Kb': 6.490, 'Fe_Ka': 6.404,
+    'Fe_Kb': 7.058, 'Co_Ka': 6.930, 'Co_Kb': 7.649, 'Ni_Ka': 7.478,
+    'Ni_Kb': 8.265, 'Cu_Ka': 8.048, 'Cu_Kb': 8.905, 'Zn_Ka': 8.639,
+    'Zn_Kb': 9.572, 'Ga_Ka': 9.252, 'Ga_Kb': 10.264, 'Ge_Ka': 9.886,
+    'Ge_Kb': 10.982, 'As_Ka': 10.544, 'As_Kb': 11.726, 'Se_Ka': 11.222,
+    'Se_Kb': 12.496, 'Br_Ka': 11.924, 'Br_Kb': 13.291, 'Kr_Ka': 12.649,
+    'Rb_Ka': 13.395, 'Rb_Kb': 14.961, 'Rb_La': 1.694, 'Sr_Ka': 14.165,
+    'Sr_Kb': 15.836, 'Sr_La': 1.806, 'Y_Ka': 14.958, 'Y_Kb': 16.738,
+    'Y_La': 1.923, 'Zr_Ka': 15.775, 'Zr_Kb': 17.668, 'Zr_La': 2.042,
+    'Nb_Ka': 16.615, 'Nb_Kb': 18.623, 'Nb_La': 2.166, 'Mo_Ka': 17.479,
+    'Mo_Kb': 19.608, 'Mo_La': 2.293, 'Mo_Lb1': 2.395, 'Ru_Ka': 19.279,
+    'Ru_La': 2.558, 'Rh_Ka': 20.216, 'Rh_Kb': 22.724, 'Rh_La': 2.697,
+    'Rh_Lb1': 2.834, 'Pd_Ka': 21.177, 'Pd_La': 2.838, 'Pd_Lb1': 2.990,
+    'Ag_Ka': 22.163, 'Ag_Kb': 24.942, 'Ag_La': 2.984, 'Ag_Lb1': 3.151,
+    'Cd_Ka': 23.174, 'Cd_Kb': 26.096, 'Cd_La': 3.134, 'Cd_Lb1': 3.317,
+    'In_Ka': 24.210, 'In_La': 3.287, 'Sn_Ka': 25.271, 'Sn_Kb': 28.486,
+    'Sn_La': 3.444, 'Sn_Lb1': 3.663, 'Sb_Ka': 26.359, 'Sb_La': 3.605,
+    'Te_Ka': 27.472, 'Te_La': 3.769, 'I_Ka': 28.612, 'I_La': 3.938,
+    'Cs_Ka': 30.973, 'Cs_La': 4.286, 'Ba_Ka': 32.194, 'Ba_La': 4.466,
+    'Ba_Lb1': 4.828, 'La_La': 4.651, 'Ce_La': 4.840, 'Nd_La': 5.230,
+    'Sm_La': 5.636, 'Eu_La': 5.846, 'Gd_La': 6.057, 'Hf_La': 7.899,
+    'Ta_La': 8.146, 'W_La': 8.398, 'W_Lb1': 9.672, 'Re_La': 8.652,
+    'Os_La': 8.911, 'Ir_La': 9.175, 'Pt_La': 9.442, 'Pt_Lb1': 11.071,
+    'Au_La': 9.713, 'Au_Lb1': 11.443, 'Hg_La': 9.989, 'Hg_Lb1': 11.823,
+    'Tl_La': 10.269, 'Pb_La': 10.551, 'Pb_Lb1': 12.614, 'Bi_La': 10.839,
+    'Bi_Lb1': 13.024, 'Th_La': 12.968, 'U_La': 13.615}
+
+
+def candidate_lines(energy, tolerance=0.075, lines=XRF_LINES):
+    """ names of the X-ray lines within *tolerance* keV of *energy*, nearest
+    first, joined by ', ' (an empty string when there is none) """
+    names = [name for name in lines
+             if abs(lines[name] - energy) <= tolerance]
+    names.sort(key=lambda name: abs(lines[name] - energy))
+    return ', '.join(names)
+
+
+def peak_search(stack, width=None, R=3, max_peaks=40, tolerance=0.075,
+                lines=XRF_LINES):
+    """Vectorized LOCPEAKS over every spectrum of a SpectrumStack.
+
+    Parameters
+    ----------
+
+    stack : spectrum_stack.SpectrumStack
+        spectra to be searched
+    width : int
+        top hat width in channels, about the FWHM of the peaks; by default
+        15 channels (~150 eV, the Mn FWHM of the M4 detectors)
+    R : float
+        sensitivity factor, a peak must be R standard deviations above the
+        filtered background
+    max_peaks : int
+        most significant peaks kept per spectrum
+    tolerance : float
+        keV window used to name candidate lines (None skips the naming)
+
+    Returns
+    -------
+
+    pandas.DataFrame with one row per peak: filename, channel (sub-channel
+    position), energy in keV, filtered height, significance, and lines
+
+    """
+    import pandas as pd
+    if width is None:
+        width = 15
+    F, VAR = TOPHATSUMS(stack.channels, width)
+    POS, SIG = PEAKSELECT(F, VAR, R, max_peaks, width)
+    found = np.isfinite(POS)
+    spectrum = np.nonzero(found)[0]
+    position = POS[found]
+    height = F[spectrum, np.round(position).astype(int)]
+    energy = (stack.calibration_abs[spectrum] +
+              stack.calibration_lin[spectrum]*position)/1000
+    peaks = pd.DataFrame({'filename': [stack.file_names[i] for i in spectrum],
+                          'channel': position,
+                          'energy in keV': energy,
+                          'height': height,
+                          'significance': SIG[found]})
+    if tolerance is not None:
+        peaks['lines'] = [candidate_lines(e, tolerance, lines) for e in energy]
+    return peaks.sort_values(['filename', 'energy in keV']).reset_index(drop=True)
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""
+.. module:: spectrum_pca
+   :platform: Windows
+   :synopsis: out-of-core PCA of full-channel spectrum stacks
+
+Created on Mon Oct 19 2026
+
+"""
+#
+
+############################
+#  20261019
+#
+#  PCA run directly on the (background removed) spectra rather than on the
+#  table of element statistics.  The spectra are read in chunks of files and
+#  fed to scikit-learn's IncrementalPCA, so only one chunk is in memory at a
+#  time.  Three passes are made over the files: the mean spectrum (needed for
+#  the Poisson scaling), the incremental fit, and the projection to scores.
+#
+#  Poisson scaling (Keenan and Kotula, Surf. Interface Anal. 36 (2004) 203)
+#  divides each channel by the square root of its mean count, an estimate of
+#  its standard deviation, so that strong lines do not dominate the PCA only
+#  through their larger counting noise.
+#
+###########################
+#
+import numpy as np
+import pandas as pd
+from sklearn.decomposition import IncrementalPCA
+import bruker_io as bruker_io
+import spectrum_stack as spectrum_stack
+
+
+def spx_chunks(file_names, chunk_size=500, preprocess=None):
+    """ Function returning a chunk source over a list of *.spx* files
+
+    Parameters
+    ----------
+
+    file_names : list of str
+        *.spx* files to be analysed
+    chunk_size : int [500]
+        number of spectra read at once
+    preprocess : function [None]
+        applied to each SpectrumStack chunk before use (e.g. background
+        removal); must return a SpectrumStack
+
+    Returns
+    -------
+
+    function with no arguments returning a new iterator of SpectrumStack
+    chunks each time it is called
+
+    """
+    def chunk_source():
+        for start in np.arange(0, len(file_names), chunk_size):
+            stack = spectrum_stack.load_spx_stack(
+                file_names[start:start + chunk_size])
+            if preprocess is not None:
+                stack = preprocess(stack)
+            yield stack
+            # released before the next chunk is read
+            del stack
+    return chunk_source
+
+
+def channel_weights(chunk_source):
+    """ mean spectrum and Poisson channel weights 1/sqrt(mean) from one pass
+    over the chunks (channels with no counts get a weight of 0) """
+    total = None
+    count = 0
+    for stack in chunk_source():
+        if total is None:
+            total = np.zeros(stack.no_channels)
+        total = total + stack.channels.sum(axis=0)
+        count = count + len(stack)
+        del stack
+    mean_spectrum = total/count
+    weights = np.zeros(mean_spectrum.shape)
+    positive = mean_spectrum > 0
+    weights[positive] = 1/np.sqrt(mean_spectrum[positive])
+    return mean_spectrum, weights
+
+
+def incremental_spectrum_pca(chunk_source, n_components=5,
+                             poisson_scaling=True):
+    """ Function running an incremental PCA over a chunked spectrum stack
+
+    Parameters
+    ----------
+
+    chunk_source : function
+        returns a new iterator of SpectrumStack chunks on each call
+        (see spx_chunks); each chunk is fitted as soon as it is read, but
+        for its last *n_components* spectra, which are fitted with the next
+        chunk (or on their own at the end), so that chunks shorter than
+        *n_components* (e.g. the remainder of a map that does not divide by
+        the chunk size) can be fitted; a ValueError is raised when there are
+        fewer than *n_components* spectra in all
+    n_components : int [5]
+        number of principal components kept
+    poisson_scaling : bool [True]
+        weight each channel by 1/sqrt(mean count) before the PCA
+
+    Returns
+    -------
+
+    loadings : pandas.DataFrame [n_channels, n_components]
+        loadings indexed by energy (keV); with Poisson scaling they are
+        returned to count units by multiplying back the channel scaling
+    scores : pandas.DataFrame
+        filename, grid row and col, and one column per component
+    pca : sklearn.decomposition.IncrementalPCA
+        the fitted model (in the scaled space)
+
+    """
+    if poisson_scaling:
+        mean_spectrum, weights = channel_weights(chunk_source)
+    pca = IncrementalPCA(n_components=n_components)
+    energy_scale = None
+    # partial_fit needs at least n_components spectra: the last
+    # n_components spectra of each batch are carried (copied, so that the
+    # batch itself is released) into the next one, and the carry left at the
+    # end always holds enough spectra to be fitted on its own
+    carry = np.zeros((0, 0))
+    for stack in chunk_source():
+        if energy_scale is None:
+            energy_scale = stack.energy_scale(0)
+            if not poisson_scaling:
+                weights = np.ones(stack.no_channels)
+            carry = np.zeros((0, stack.no_channels))
+        batch = stack.channels*weights
+        del stack
+        if len(carry):
+            batch = np.vstack((carry, batch))
+        if len(batch) >= 2*n_components:
+            pca.partial_fit(batch[:-n_components])
+            carry = batch[-n_components:].copy()
+        else:
+            carry = batch
+        del batch
+    if len(carry) < n_components:
+        raise ValueError('at least n_components = ' + str(n_components)
+                         + ' spectra are needed')
+    pca.partial_fit(carry)
+    del carry
+    scores = []
+    file_names = []
+    for stack in chunk_source():
+        scores.append(pca.transform(stack.channels*weights))
+        file_names.extend(stack.file_names)
+        del stack
+    component_names = ['PC ' + str(i + 1) for i in np.arange(n_components)]
+    unscale = np.zeros(weights.shape)
+    unscale[weights > 0] = 1/weights[weights > 0]
+    loadings = pd.DataFrame(data=(pca.components_*unscale).T,
+                            index=pd.Index(energy_scale, name='energy in keV'),
+                            columns=component_names)
+    scores = pd.DataFrame(data=np.vstack(scores), columns=component_names)
+    grid = np.array([bruker_io.grid_index(file_name)
+                     for file_name in file_names], dtype=int)
+    scores.insert(0, 'filename', file_names)
+    scores.insert(1, 'row', grid[:, 0])
+    scores.insert(2, 'col', grid[:, 1])
+    return loadings, scores, pca
+
+
+def scores_to_grid(scores, component='PC 1'):
+    """ lays the scores of one component out on the map grid as a 2D array
+    [row, col] (points not measured are NaN); spectra without a grid
+    position (row, col = -1, e.g. the wafer) are left out, a ValueError is
+    raised when no spectrum has one (use the XYZ stage positions instead,
+    see camera_mosaic.point_map) """
+    on_grid = (scores['row'].values >= 0) & (scores['col'].values >= 0)
+    if not np.any(on_grid):
+        raise ValueError('no spectrum has a map grid position')
+    rows = scores['row'].values[on_grid]
+    cols = scores['col'].values[on_grid]
+    grid = np.full((rows.max() + 1, cols.max() + 1), np.nan)
+    grid[rows, cols] = scores[component].values[on_grid]
+    return grid
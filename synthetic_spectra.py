@@ -0,0 +1,344 @@
+# -*- coding: utf-8 -*-
+"""
+.. module:: synthetic_spectra
+   :platform: Windows
+   :synopsis: SRM 1831 like Poisson spectra with known line areas
+
+Created on Mon Oct 19 2026
+
+"""
+#
+
+############################
+#  20261019
+#
+#  Synthetic spectra for load tests and accuracy checks of the loader,
+#  background removal, fitting and PCA at 1e4 - 1e6 spectra, far more than
+#  the few hundred measured per series.
+#
+#  A SpectrumTemplate is taken from measured *.spx* files: calibration, live
+#  and real time, shaping time and Mn FWHM of the detector, the continuum
+#  (the mean spectrum minus its SNIP and polycap corrected counts, i.e. what
+#  spectra_fit removes) and the area of every line of *lines* (non-negative
+#  least squares of Gaussian line profiles to the corrected mean spectrum).
+#  Peaks that are not in *lines* (zero peak, Compton scatter, escape peaks)
+#  are kept in the continuum: the corrected counts the lines leave more than
+#  two FWHM away from every line.
+#  The width of a line at energy E follows the Mn FWHM as
+#      FWHM(E)**2 = FWHM(Mn Ka)**2 + 2.49 eV * (E - 5899 eV)
+#  (2.49 eV = 8 ln2 * SigmaLin of the M4 detectors).
+#
+#  Each synthetic spectrum is a Poisson sample of continuum plus lines, with
+#  its true line areas (expected counts, varied between spectra by
+#  *heterogeneity*) returned in a table laid out as spectra_fit output.
+#  Spectra are made in blocks so that a million spectra never need to be in
+#  memory, and are written as *.spx* files built on the template file (only
+#  name, live time, real time and channels differ), which bruker_spx_import
+#  reads as measured files.
+#
+###########################
+#
+import math
+import os
+import re
+import numpy as np
+import pandas as pd
+import bruker_io as bruker_io
+import spectrum_stack as spectrum_stack
+import spectrum_evaluation as spectrum_evaluation
+
+# lines seen in the SRM 1831 glass spectra (Rh: tube lines)
+SRM_1831_LINES = ['Na_Ka', 'Mg_Ka', 'Al_Ka', 'Si_Ka', 'Si_Kb', 'S_Ka',
+                  'Rh_La', 'K_Ka', 'Ca_Ka', 'Ca_Kb', 'Ti_Ka',
+                  'Fe_Ka', 'Fe_Kb', 'Sr_Ka', 'Zr_Ka', 'Rh_Ka', 'Rh_Kb']
+MN_KA_ENERGY = 5899
+
+
+def line_fwhm(energy, mn_fwhm):
+    """FWHM (eV) of a line at *energy* (keV) for a detector of Mn FWHM
+    *mn_fwhm* (eV)"""
+    return np.sqrt(np.maximum(mn_fwhm**2 + 2.49*(1000*np.asarray(energy)
+                                                - MN_KA_ENERGY), 1))
+
+
+def line_profiles(energy_scale, mn_fwhm, lines=SRM_1831_LINES,
+                  line_energies=spectrum_evaluation.XRF_LINES):
+    """ Gaussian profile of each line integrated over every channel of
+    *energy_scale* (keV), one unit area line per row [n_lines, n_channels] """
+    from scipy.special import erf
+    energy_scale = np.asarray(energy_scale, dtype=float)
+    half_width = (energy_scale[1] - energy_scale[0])/2
+    energy = np.array([line_energies[line] for line in lines])[:, np.newaxis]
+    sigma = line_fwhm(energy, mn_fwhm)/1000/math.sqrt(8*math.log(2))
+    upper = erf((energy_scale + half_width - energy)/(math.sqrt(2)*sigma))
+    lower = erf((energy_scale - half_width - energy)/(math.sqrt(2)*sigma))
+    return (upper - lower)/2
+
+
+class SpectrumTemplate:
+    """ everything needed to synthesise spectra of one detector
+
+    def __init__(self, file_name, calibration_abs, calibration_lin,
+                 no_channels, mn_fwhm, life_time_in_ms, real_time_in_ms,
+                 shaping_time, background, line_areas):
+
+    **file_name:** str
+        *.spx* file whose XML is reused by write_spx
+
+    **calibration_abs, calibration_lin:** float
+        calibration in eV (FittingData units)
+
+    **no_channels:** int
+        channels per spectrum
+
+    **mn_fwhm:** float
+        Mn Ka FWHM in eV, sets the line widths
+
+    **life_time_in_ms, real_time_in_ms, shaping_time:** float
+        acquisition of the template; live time is the reference of
+        *background* and *line_areas*
+
+    **background:** np.array [no_channels,]
+        expected continuum counts in *life_time_in_ms*
+
+    **line_areas:** dict
+        expected counts of each line in *life_time_in_ms*
+
+    """
+
+    def __init__(self, file_name, calibration_abs, calibration_lin,
+                 no_channels, mn_fwhm, life_time_in_ms, real_time_in_ms,
+                 shaping_time, background, line_areas):
+        self.file_name = file_name
+        self.calibration_abs = float(calibration_abs)
+        self.calibration_lin = float(calibration_lin)
+        self.no_channels = int(no_channels)
+        self.mn_fwhm = float(mn_fwhm)
+        self.life_time_in_ms = float(life_time_in_ms)
+        self.real_time_in_ms = float(real_time_in_ms)
+        self.shaping_time = float(shaping_time)
+        self.background = np.asarray(background, dtype=float)
+        self.line_areas = dict(line_areas)
+
+    @property
+    def lines(self):
+        """names of the synthesised lines"""
+        return list(self.line_areas)
+
+    def energy_scale(self):
+        """energy (keV) of each channel"""
+        return (self.calibration_abs + self.calibration_lin
+                * np.arange(self.no_channels))/1000
+
+    def profiles(self):
+        """unit area profile of each line [n_lines, no_channels]"""
+        return line_profiles(self.energy_scale(), self.mn_fwhm, self.lines)
+
+    def expected(self):
+        """expected counts of the template spectrum (continuum and lines)"""
+        areas = np.array([self.line_areas[line] for line in self.lines])
+        return self.background + areas @ self.profiles()
+
+
+def spectrum_template(file_names, lines=SRM_1831_LINES):
+    """ Function building a SpectrumTemplate from measured spectra
+
+    Parameters
+    ----------
+
+    file_names : list of str
+        *.spx* files of one detector and calibration (e.g. the det_1 files
+        of the 20x20 map); their mean spectrum is the template
+    lines : list of str [SRM_1831_LINES]
+        lines (names of spectrum_evaluation.XRF_LINES) whose areas are
+        estimated and synthesised
+
+    Returns
+    -------
+
+    SpectrumTemplate
+
+    """
+    stack = spectrum_stack.load_spx_stack(file_names)
+    if np.ptp(stack.calibration_abs) > 0 or np.ptp(stack.calibration_lin) > 0:
+        raise ValueError('template spectra must share one calibration')
+    spx = bruker_io.FittingData(file_names[0])
+    bruker_io.bruker_spx_import(spx, lazy=True)
+    mean = stack.channels.mean(axis=0)
+    energy_scale = stack.energy_scale(0)
+    net = spectrum_evaluation.polycap_corrected(
+        spectrum_evaluation.snip_corrected(mean, energy_scale, dtype=float),
+        energy_scale, dtype=float)
+    background = (mean - net).clip(min=0)
+    # zero peak and noise below 0 keV are left in the continuum
+    background[energy_scale <= 0] = mean[energy_scale <= 0]
+    from scipy.optimize import nnls
+    profiles = line_profiles(energy_scale, spx.mn_fwhm, lines)
+    positive = energy_scale > 0
+    areas, residual = nnls(profiles[:, positive].T, net[positive])
+    energy = np.array([spectrum_evaluation.XRF_LINES[line] for line in lines])
+    far = np.all(np.abs(energy_scale[:, np.newaxis] - energy)
+                 > 2*line_fwhm(energy, spx.mn_fwhm)/1000, axis=1)
+    background[positive & far] += (net - areas @ profiles).clip(
+        min=0)[positive & far]
+    return SpectrumTemplate(file_names[0], stack.calibration_abs[0],
+                            stack.calibration_lin[0], stack.no_channels,
+                            spx.mn_fwhm, np.mean(stack.life_time_in_ms),
+                            spx.real_time_in_ms*np.mean(stack.life_time_in_ms)
+                            /spx.life_time_in_ms,
+                            np.mean(stack.shaping_time), background,
+                            dict(zip(lines, areas)))
+
+
+def synthetic_names(prefix, detector, index, columns):
+    """map style names (*prefix*det_<detector>_<row>_<col>.spx) of spectra
+    *index*, filling rows of *columns* points"""
+    return [prefix + 'det_' + str(detector) + '_' + str(i//columns) + '_'
+            + str(i % columns) + '.spx' for i in index]
+
+
+def synthetic_stack(template, n_spectra, line_areas=None, heterogeneity=0.0,
+                    live_time_in_ms=None, detector=1, prefix='SYNTH_1831',
+                    columns=None, start=0, seed=None):
+    """ Function synthesising a stack of Poisson spectra
+
+    Parameters
+    ----------
+
+    template : SpectrumTemplate
+        detector, continuum and default line areas
+    n_spectra : int
+        spectra to make
+    line_areas : dict [None]
+        expected counts of each line in the template live time,
+        *template.line_areas* by default (lines left out are not made)
+    heterogeneity : float or dict [0.0]
+        relative standard deviation of the line areas between spectra, one
+        value for all elements or one per element (e.g. {'Fe': 0.05}); the
+        lines of an element vary together
+    live_time_in_ms : float or np.array [None]
+        live time of each spectrum, the template live time by default; the
+        continuum and line areas scale with it
+    detector, prefix, columns, start : [1, 'SYNTH_1831', None, 0]
+        names are synthetic_names(prefix, detector, start + i, columns) with
+        a square grid by default
+    seed : int or np.random.Generator [None]
+        random state
+
+    Returns
+    -------
+
+    (SpectrumStack, truth) with the counts (PRECISION.counts) and a
+    pandas.DataFrame of the expected area of each line in each spectrum:
+    'filename', one column per line, 'life time in ms'
+
+    """
+    rng = np.random.default_rng(seed)
+    if line_areas is None:
+        line_areas = template.line_areas
+    lines = list(line_areas)
+    if columns is None:
+        columns = int(math.ceil(math.sqrt(start + n_spectra)))
+    if live_time_in_ms is None:
+        live_time_in_ms = template.life_time_in_ms
+    live_time_in_ms = np.broadcast_to(np.asarray(live_time_in_ms, dtype=float),
+                                      (n_spectra,))
+    scale = live_time_in_ms/template.life_time_in_ms
+    areas = np.outer(scale, [line_areas[line] for line in lines])
+    elements = [line.split('_')[0] for line in lines]
+    if not isinstance(heterogeneity, dict):
+        heterogeneity = {element: heterogeneity for element in elements}
+    for element in sorted(set(elements)):
+        sd = heterogeneity.get(element, 0.0)
+        if sd > 0:
+            factor = (1 + sd*rng.standard_normal(n_spectra)).clip(min=0)
+            areas[:, [e == element for e in elements]] *= factor[:, np.newaxis]
+    profiles = line_profiles(template.energy_scale(), template.mn_fwhm, lines)
+    expected = np.outer(scale, template.background) + areas @ profiles
+    channels = rng.poisson(expected).astype(spectrum_stack.PRECISION.counts)
+    file_names = synthetic_names(prefix, detector,
+                                 np.arange(start, start + n_spectra), columns)
+    stack = spectrum_stack.SpectrumStack(
+        channels, template.calibration_abs, template.calibration_lin,
+        live_time_in_ms, file_names, template.shaping_time)
+    truth = pd.DataFrame(areas, columns=lines)
+    truth.insert(0, 'filename', file_names)
+    truth['life time in ms'] = live_time_in_ms
+    return stack, truth
+
+
+def iter_synthetic_stacks(template, n_spectra, block_size=10000, seed=None,
+                          **options):
+    """ synthetic_stack in blocks of *block_size* spectra (named as one
+    series of *n_spectra*), each block with its own random stream spawned
+    from *seed*; yields (stack, truth) """
+    columns = options.pop('columns', None)
+    if columns is None:
+        columns = int(math.ceil(math.sqrt(n_spectra)))
+    starts = np.arange(0, n_spectra, block_size)
+    streams = np.random.SeedSequence(seed).spawn(len(starts))
+    for start, stream in zip(starts, streams):
+        yield synthetic_stack(template, min(block_size, n_spectra - start),
+                              columns=columns, start=int(start),
+                              seed=np.random.default_rng(stream), **options)
+
+
+def write_spx(template, stack, directory_path):
+    """ writes every spectrum of *stack* as a *.spx* file in
+    *directory_path*, built on the XML of the template file; returns the
+    file names """
+    with open(template.file_name, 'rb') as file:
+        content = file.read()
+    begin = content.index(b'<Channels>') + len(b'<Channels>')
+    end = content.index(b'</Channels>')
+    header, tail = content[:begin], content[end:]
+    real_per_live = template.real_time_in_ms/template.life_time_in_ms
+    os.makedirs(directory_path, exist_ok=True)
+    file_names = []
+    for i in np.arange(len(stack)):
+        name = os.path.basename(stack.file_names[i])
+        live = stack.life_time_in_ms[i]
+        spectrum_header = re.sub(
+            rb'(<ClassInstance Type="TRTSpectrum" Name=")[^"]*',
+            b'\\g<1>' + name.replace('.spx', '').encode('ascii'), header,
+            count=1)
+        spectrum_header = re.sub(
+            rb'<LifeTime>[^<]*', b'<LifeTime>' + b'%d' % round(live),
+            spectrum_header, count=1)
+        spectrum_header = re.sub(
+            rb'<RealTime>[^<]*',
+            b'<RealTime>' + b'%d' % round(live*real_per_live),
+            spectrum_header, count=1)
+        file_name = directory_path + '/' + name
+        with open(file_name, 'wb') as file:
+            file.write(spectrum_header)
+            file.write(','.join(map(str, stack.channels[i].tolist())).encode(
+                'ascii'))
+            file.write(tail)
+        file_names.append(file_name)
+    return file_names
+
+
+def write_synthetic_series(template, directory_path, n_spectra,
+                           block_size=10000, seed=None, **options):
+    """ Function writing a series of synthetic *.spx* files
+
+    The spectra of iter_synthetic_stacks(template, n_spectra, block_size,
+    seed, **options) are written to *directory_path* and their true line
+    areas to *directory_path*/<prefix>_truth.pkl.
+
+    Returns
+    -------
+
+    pandas.DataFrame of the true line areas (see synthetic_stack)
+
+    """
+    truth = []
+    for stack, block_truth in iter_synthetic_stacks(
+            template, n_spectra, block_size, seed, **options):
+        write_spx(template, stack, directory_path)
+        truth.append(block_truth)
+    truth = pd.concat(truth, ignore_index=True)
+    truth.to_pickle(directory_path + '/'
+                    + options.get('prefix', 'SYNTH_1831') + '_truth.pkl')
+    return truth
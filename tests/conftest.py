@@ -0,0 +1,9 @@
+# -*- coding: utf-8 -*-
+"""
+The analysis modules sit at the top of the repository, next to the
+notebooks; make them importable from the tests.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
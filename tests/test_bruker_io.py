@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""tests of the bruker_io readers and writers on the bundled M4 spectra"""
+import os
+import numpy as np
+import pytest
+import bruker_io as bruker_io
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SPX_FILES = [ROOT + '/M4_measurements/SRM_1831_300s_20x20/'
+             'SRM_1831_300s_20x20det_1_0_' + str(i) + '.spx' for i in range(3)]
+
+
+@pytest.fixture
+def lazy_limit(monkeypatch):
+    """keep a single lazily decoded spectrum in memory"""
+    monkeypatch.setattr(bruker_io, 'LAZY_CHANNEL_LIMIT', 1)
+    monkeypatch.setattr(bruker_io, '_lazy_decoded', bruker_io.OrderedDict())
+
+
+def lazy_spectra():
+    spectra = []
+    for file_name in SPX_FILES[:2]:
+        spx = bruker_io.FittingData(file_name)
+        bruker_io.bruker_spx_import(spx, lazy=True)
+        spectra.append(spx)
+    return spectra
+
+
+def test_untouched_channels_are_released(lazy_limit):
+    first, second = lazy_spectra()
+    raw = first.channels.copy()
+    second.channels
+    assert first._channels is None
+    assert np.array_equal(first.channels, raw)
+
+
+def test_channels_changed_in_place_survive_eviction(lazy_limit):
+    first, second = lazy_spectra()
+    first.channels[:] = first.channels//2
+    corrected = first.channels.copy()
+    second.channels        # evicts first
+    assert first.channels_offset is None
+    assert np.array_equal(first.channels, corrected)
+
+
+def test_channels_replaced_survive_eviction(lazy_limit):
+    first, second = lazy_spectra()
+    first.channels = np.zeros(len(first.channels))
+    second.channels
+    first.release_channels()
+    assert first.channels_offset is None
+    assert not np.any(first.channels)
+
+
+@pytest.mark.parametrize('lazy', [False, True])
+def test_spx_counts_use_precision_policy(lazy):
+    spx = bruker_io.FittingData(SPX_FILES[0])
+    bruker_io.bruker_spx_import(spx, lazy=lazy)
+    assert spx.channels.dtype == np.uint32
+    assert spx.channels.sum() > 0
+
+
+def test_pileup_on_unsigned_counts_matches_signed():
+    import spectrum_evaluation as spectrum_evaluation
+    unsigned = bruker_io.FittingData(SPX_FILES[0])
+    bruker_io.bruker_spx_import(unsigned)
+    signed = bruker_io.FittingData(SPX_FILES[0])
+    bruker_io.bruker_spx_import(signed)
+    signed.channels = signed.channels.astype(np.int64)
+    spectrum_evaluation.pulse_pileup_removal(unsigned)
+    spectrum_evaluation.pulse_pileup_removal(signed)
+    assert np.array_equal(unsigned.channels, signed.channels)
+
+
+def spx_spectrum():
+    spx = bruker_io.FittingData(SPX_FILES[0])
+    bruker_io.bruker_spx_import(spx)
+    return spx
+
+
+def test_msa_round_trip(tmp_path):
+    spx = spx_spectrum()
+    file_name = str(tmp_path / 'spectrum.msa')
+    bruker_io.bruker_msa_export(spx, file_name)
+    msa = bruker_io.FittingData(file_name)
+    bruker_io.bruker_msa_import(msa)
+    assert msa.calibration_abs == pytest.approx(spx.calibration_abs, abs=1e-3)
+    assert msa.calibration_lin == pytest.approx(spx.calibration_lin, abs=1e-3)
+    assert np.array_equal(msa.channels, spx.channels)
+    assert np.allclose(msa.energy_scale, spx.energy_scale, atol=1e-5)
+
+
+def test_txt_round_trip(tmp_path):
+    spx = spx_spectrum()
+    file_name = str(tmp_path / 'spectrum.txt')
+    bruker_io.bruker_txt_export(spx, file_name)
+    txt = bruker_io.FittingData(file_name)
+    bruker_io.bruker_txt_import(txt)
+    assert np.array_equal(txt.channels, spx.channels)
+    assert np.allclose(txt.energy_scale, spx.energy_scale, atol=1e-4)
+
+
+def test_batch_convert_keeps_series_apart(tmp_path):
+    source = tmp_path / 'spectra'
+    for series, spx_file in (('a', SPX_FILES[0]), ('b', SPX_FILES[1])):
+        (source / series).mkdir(parents=True)
+        with open(spx_file, 'rb') as file:
+            (source / series / 'point.spx').write_bytes(file.read())
+    output = tmp_path / 'converted'
+    written = bruker_io.bruker_batch_convert(str(source), formats=('npz',),
+                                             output_directory=str(output),
+                                             processes=1)
+    assert sorted(written) == [str(output / 'a' / 'point.npz'),
+                               str(output / 'b' / 'point.npz')]
+    first = np.load(str(output / 'a' / 'point.npz'))['channels']
+    second = np.load(str(output / 'b' / 'point.npz'))['channels']
+    assert not np.array_equal(first, second)
+
+
+def test_convert_outputs_only_change_the_extension(tmp_path):
+    spx_file = os.path.join('data.spx', 'run', 'map.spx.spx')
+    outputs = bruker_io._convert_outputs(spx_file, ('txt', 'msa'), None, True)
+    assert outputs == [('txt', os.path.join('data.spx', 'run',
+                                            'map.spx_python.txt')),
+                       ('msa', os.path.join('data.spx', 'run', 'map.spx.msa'))]
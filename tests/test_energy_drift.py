@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+"""tests of the drift calibration on synthetic spectra with known drift"""
+import numpy as np
+import energy_drift as energy_drift
+import spectrum_stack as spectrum_stack
+
+# (keV, peak counts) of the main SRM 1831 lines
+LINES = [(1.74, 1e5), (2.70, 3e3), (3.31, 3e3), (3.69, 8e4), (4.01, 1.2e4),
+         (6.40, 4e3), (7.06, 6e2), (14.16, 5e2), (20.2, 1.2e3)]
+# (offset in channels, gain): channel = offset + gain * reference channel
+DRIFTS = [(0.0, 1.0), (0.8, 1.0015), (-1.2, 0.999), (0.3, 0.9996)]
+
+
+def synthetic_spectrum(offset, gain, rng=None, no_channels=4096):
+    """ Gaussian lines on a flat continuum, on the -955.2 eV, 10 eV/channel
+    axis moved by *offset* and *gain*; Poisson counts when *rng* is given """
+    channel = np.arange(no_channels)
+    counts = np.full(no_channels, 300.0)
+    for energy, height in LINES:
+        centre = offset + gain*(energy*1000 + 955.2)/10
+        sigma = gain*(4 + 0.0015*centre)
+        counts += height*np.exp(-0.5*((channel - centre)/sigma)**2)
+    return counts if rng is None else rng.poisson(counts)
+
+
+def test_drift_calibration_recovers_offset_and_gain():
+    rng = np.random.default_rng(3)
+    channels = np.array([synthetic_spectrum(offset, gain, rng)
+                         for offset, gain in DRIFTS])
+    stack = spectrum_stack.SpectrumStack(
+        channels, -955.2, 10.0, 300000,
+        ['drift_' + str(i) + '.spx' for i in range(len(DRIFTS))])
+    drift = energy_drift.drift_calibration(
+        stack, reference=synthetic_spectrum(0.0, 1.0))
+    offset, gain = np.array(DRIFTS).T
+    # tolerance: 0.05 channel (0.5 eV) in offset, 1e-4 in gain (2 eV at
+    # 20 keV); the Poisson noise of the weak Sr and Rh lines gives ~3e-5
+    assert np.allclose(drift['offset'], offset, atol=0.05)
+    assert np.allclose(drift['gain'], gain, atol=1e-4)
+    assert (drift['windows used'] == len(energy_drift.DRIFT_WINDOWS)).all()
+    assert np.allclose(drift['calibration_lin'], 10.0/gain, atol=1e-3)
+
+
+def test_single_window_gives_offset_only():
+    rng = np.random.default_rng(4)
+    stack = spectrum_stack.SpectrumStack(
+        synthetic_spectrum(0.6, 1.0, rng), -955.2, 10.0, 300000,
+        ['drift.spx'])
+    drift = energy_drift.drift_calibration(
+        stack, reference=synthetic_spectrum(0.0, 1.0), windows=[(3.5, 4.3)])
+    assert abs(drift['offset'][0] - 0.6) < 0.1
+    assert drift['gain'][0] == 1
+    assert drift['windows used'][0] == 1
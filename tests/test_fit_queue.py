@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""tests of the fit_queue work queue, mostly with stub fits instead of
+hyperspy"""
+import os
+import sqlite3
+import subprocess
+import sys
+import time
+import pandas as pd
+import pytest
+import fit_queue as fit_queue
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ELEMENT_SETS = {'COA': ['Al', 'Ca', 'Fe'], 'select': ['Si', 'K']}
+
+
+def stub_fit(file_name, fitter, method, elements):
+    """ fit stand-in; creates <file_name>.<elements>.fitted exclusively, so a
+    job fitted twice raises """
+    open(file_name + '.' + '_'.join(elements) + '.fitted', 'x').close()
+    time.sleep(0.005)
+    line_names = [element + '_Ka' for element in elements]
+    counts = [float(len(file_name) + i) for i in range(len(elements))]
+    return line_names, counts, [2*count for count in counts], 299800.0
+
+
+def failing_fit(file_name, fitter, method, elements):
+    raise RuntimeError('fit did not converge')
+
+
+def fails_once_fit(file_name, fitter, method, elements):
+    marker = file_name + '.attempted'
+    if not os.path.exists(marker):
+        open(marker, 'x').close()
+        raise RuntimeError('first attempt fails')
+    return stub_fit(file_name, fitter, method, elements)
+
+
+def queue(tmp_path, n_files=3, element_sets=ELEMENT_SETS):
+    database = str(tmp_path / 'queue.sqlite')
+    file_names = [str(tmp_path / ('map_det_1_0_' + str(i) + '.spx'))
+                  for i in range(n_files)]
+    fit_queue.enqueue(database, file_names, element_sets)
+    return database, file_names
+
+
+def jobs(database):
+    connection = sqlite3.connect(database)
+    try:
+        return pd.read_sql_query('SELECT * FROM jobs ORDER BY id', connection)
+    finally:
+        connection.close()
+
+
+def test_enqueue_again_adds_no_jobs(tmp_path):
+    database, file_names = queue(tmp_path)
+    assert len(jobs(database)) == 6
+    assert fit_queue.enqueue(database, file_names, ELEMENT_SETS) == 0
+    assert fit_queue.enqueue(database, file_names[:1],
+                             {'full': ['Na']}) == 1
+    assert len(jobs(database)) == 7
+
+
+def test_each_job_claimed_once_across_processes(tmp_path):
+    database, file_names = queue(tmp_path, n_files=20)
+    done = fit_queue.run_local_workers(database, processes=4, fit=stub_fit)
+    assert sum(done) == 40
+    table = jobs(database)
+    assert (table['status'] == 'done').all()
+    assert (table['attempts'] == 1).all()
+    assert len([file for file in os.listdir(str(tmp_path))
+                if file.endswith('.fitted')]) == 40
+
+
+def test_failed_jobs_are_retried(tmp_path):
+    database, file_names = queue(tmp_path, n_files=1)
+    assert fit_queue.run_worker(database, fit=fails_once_fit) == 2
+    table = jobs(database)
+    # the first job fails once, the second finds the marker of the first
+    assert list(table['status']) == ['done', 'done']
+    assert list(table['attempts']) == [2, 1]
+    assert table['error'].isna().all()
+
+
+def test_failing_jobs_end_failed(tmp_path):
+    database, file_names = queue(tmp_path, n_files=1)
+    assert fit_queue.run_worker(database, fit=failing_fit,
+                                max_attempts=3) == 0
+    table = jobs(database)
+    assert (table['status'] == 'failed').all()
+    assert (table['attempts'] == 3).all()
+    assert table['error'].str.contains('fit did not converge').all()
+    assert fit_queue.queue_status(database).loc['COA', 'failed'] == 1
+
+
+def test_expired_lease_is_reclaimed(tmp_path):
+    database, file_names = queue(tmp_path, n_files=1,
+                                 element_sets={'COA': ['Al']})
+    connection = fit_queue.connect(database)
+    try:
+        job = fit_queue.claim(connection, 'dead worker', lease=60)
+        # the job is not handed out again while the lease holds
+        assert fit_queue.claim(connection, 'other', lease=60) is None
+        connection.execute('UPDATE jobs SET claimed = ? WHERE id = ?',
+                           (time.time() - 120, job[0]))
+    finally:
+        connection.close()
+    assert fit_queue.run_worker(database, fit=stub_fit, lease=60) == 1
+    table = jobs(database).set_index('id')
+    assert table.loc[job[0], 'status'] == 'done'
+    assert table.loc[job[0], 'attempts'] == 2
+    assert table.loc[job[0], 'worker'] != 'dead worker'
+
+
+def test_expired_lease_on_last_attempt_fails(tmp_path):
+    database, file_names = queue(tmp_path, n_files=1,
+                                 element_sets={'COA': ['Al']})
+    connection = fit_queue.connect(database)
+    try:
+        job = fit_queue.claim(connection, 'dead worker', lease=60,
+                              max_attempts=1)
+        connection.execute('UPDATE jobs SET claimed = ? WHERE id = ?',
+                           (time.time() - 120, job[0]))
+    finally:
+        connection.close()
+    fit_queue.run_worker(database, fit=stub_fit, lease=60, max_attempts=1)
+    table = jobs(database).set_index('id')
+    assert table.loc[job[0], 'status'] == 'failed'
+    assert table.loc[job[0], 'error'] == 'lease expired'
+
+
+def test_collect_results_matches_notebook_tables(tmp_path):
+    database, file_names = queue(tmp_path)
+    fit_queue.run_worker(database, fit=stub_fit)
+    roi, model = fit_queue.collect_results(database, 'COA', str(tmp_path))
+    notebook = pd.read_pickle(
+        os.path.join(ROOT, 'SRM_1831_300s_100pts_300c_COA_roi.pkl'))
+    assert notebook.columns[0] == 'filename'
+    assert notebook.columns[-1] == 'life time in ms'
+    assert list(roi.columns) == ['filename', 'Al_Ka', 'Ca_Ka', 'Fe_Ka',
+                                 'life time in ms']
+    assert list(model.columns) == list(roi.columns)
+    assert list(roi['filename']) == [os.path.basename(file_name)
+                                     for file_name in file_names]
+    assert (model['Al_Ka'] == 2*roi['Al_Ka']).all()
+    assert (roi['life time in ms'] == 299800.0).all()
+    assert len(fit_queue.collect_results(database, 'COA',
+                                         str(tmp_path / 'other'))[0]) == 0
+
+
+def test_worker_process_runs_the_hyperspy_fit(tmp_path):
+    # the real path: a fresh 'python fit_queue.py work' process, which has
+    # not imported hyperspy beforehand, fitting with spectrum_fit
+    pytest.importorskip('hyperspy.api')
+    database = str(tmp_path / 'queue.sqlite')
+    spx_file = os.path.join(ROOT, 'M4_measurements', 'SRM_1831_300s_20x20',
+                            'SRM_1831_300s_20x20det_1_0_0.spx')
+    fit_queue.enqueue(database, [spx_file], {'COA': ['Ca', 'Fe']})
+    subprocess.run([sys.executable, 'fit_queue.py', 'work', database,
+                    '--processes', '1', '--attempts', '1'],
+                   cwd=ROOT, check=True, timeout=600)
+    table = jobs(database)
+    assert list(table['status']) == ['done'], table['error'][0]
+    roi, model = fit_queue.collect_results(database, 'COA')
+    assert list(roi.columns) == ['filename', 'Ca_Ka', 'Fe_Ka',
+                                 'life time in ms']
+    assert (roi[['Ca_Ka', 'Fe_Ka']].values > 0).all()
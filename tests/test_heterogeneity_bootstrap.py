@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+"""tests of the PCA projection of bootstrap replicates"""
+import numpy as np
+import pytest
+from sklearn.decomposition import PCA
+from sklearn.preprocessing import StandardScaler
+import heterogeneity_bootstrap as heterogeneity_bootstrap
+from heterogeneity_stats import sample_moments, STATISTICS
+
+COLUMNS = ('var', 'skew', 'kurtosis')
+
+
+INDEX = [STATISTICS.index(column) for column in COLUMNS]
+
+
+@pytest.mark.parametrize('with_scaler', [True, False])
+def test_projection_matches_sklearn_transform(with_scaler):
+    rng = np.random.default_rng(1)
+    values = rng.gamma(rng.uniform(1, 10, 12), 100.0, (60, 12))
+    table = sample_moments(values, axis=0)[:, INDEX]
+    scaler = StandardScaler().fit(table) if with_scaler else None
+    pca = PCA(2).fit(table if scaler is None else scaler.transform(table))
+    projection = heterogeneity_bootstrap.pca_projection(pca, scaler, COLUMNS)
+    moments, scores = heterogeneity_bootstrap.bootstrap_moments(
+        values, n_replicates=15, block_size=10, processes=1,
+        projection=projection)
+    for replicate in range(15):
+        table = moments[replicate][:, INDEX]
+        if scaler is not None:
+            table = scaler.transform(table)
+        assert np.allclose(scores[replicate], pca.transform(table))
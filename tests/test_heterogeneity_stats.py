@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+"""tests of the moment statistics against pandas"""
+import numpy as np
+import pandas as pd
+from heterogeneity_stats import MomentAccumulator, sample_moments, STATISTICS
+
+
+def test_sample_moments_and_accumulator_agree_with_pandas():
+    rng = np.random.default_rng(5)
+    values = rng.gamma(2.0, 50.0, (120, 4))
+    values[:, 3] = 7.0          # constant column: skew and kurtosis 0
+    table = pd.DataFrame(values, columns=list('abcd'))
+    accumulator = MomentAccumulator(table.columns)
+    for start in range(0, 120, 25):
+        accumulator.update_batch(values[start:start + 25])
+    expected = pd.DataFrame({'mean': table.mean(), 'std': table.std(),
+                             'var': table.var(), 'skew': table.skew(),
+                             'kurtosis': table.kurt()})[STATISTICS]
+    expected.loc['d', ['skew', 'kurtosis']] = 0
+    assert np.allclose(accumulator.to_frame().values, expected.values)
+    assert np.allclose(sample_moments(values), expected.values)
+    # replicates stacked on a leading axis, as in the bootstrap
+    stacked = sample_moments(np.stack((values, values[::-1])), axis=1)
+    assert np.allclose(stacked[1], expected.values)
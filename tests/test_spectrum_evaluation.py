@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+"""tests of the batched legacy background routines of spectrum_evaluation"""
+import numpy as np
+import pytest
+import spectrum_evaluation as spectrum_evaluation
+
+NCHAN = 64
+
+
+@pytest.mark.parametrize('ICH1, ICH2', [(0, NCHAN), (0, 20), (5, 40),
+                                        (30, NCHAN), (1, NCHAN - 1),
+                                        (10, 10)])
+@pytest.mark.parametrize('FWHM', [1, 3, 7])
+def test_snipbgbatch_equals_snipbg_bit_for_bit(ICH1, ICH2, FWHM):
+    rng = np.random.default_rng(ICH1 + 100*ICH2 + FWHM)
+    channel = np.arange(NCHAN)
+    Y = rng.poisson(50 + 2000*np.exp(-0.5*((channel - 25)/2.5)**2)
+                    + 800*np.exp(-0.5*((channel - 45)/3)**2),
+                    (4, NCHAN)).astype(float)
+    batch = spectrum_evaluation.SNIPBGBATCH(Y, NCHAN, ICH1, ICH2, FWHM, 3,
+                                            20)
+    for row in np.arange(len(Y)):
+        single = spectrum_evaluation.SNIPBG(Y[row].copy(), NCHAN, ICH1, ICH2,
+                                            FWHM, 3, 20)
+        assert np.array_equal(batch[row], single)
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""tests of spectrum_pca on small synthetic stacks"""
+import weakref
+import numpy as np
+import pandas as pd
+import pytest
+import spectrum_pca as spectrum_pca
+import spectrum_stack as spectrum_stack
+
+
+def make_chunks(n_spectra, chunk_size, n_channels=64, seed=0):
+    """chunk source over *n_spectra* Poisson spectra named on a 5 column map"""
+    rng = np.random.default_rng(seed)
+    mean = 50 + 400*np.exp(-0.5*((np.arange(n_channels) - 20)/3)**2)
+    channels = rng.poisson(mean*rng.uniform(0.5, 1.5, (n_spectra, 1)))
+    names = ['map_det_1_' + str(i//5) + '_' + str(i % 5) + '.spx'
+             for i in range(n_spectra)]
+
+    def chunk_source():
+        for start in range(0, n_spectra, chunk_size):
+            yield spectrum_stack.SpectrumStack(
+                channels[start:start + chunk_size], -955.2, 10.0, 300000,
+                names[start:start + chunk_size])
+    return chunk_source, channels
+
+
+def test_pca_with_short_last_chunk():
+    # 23 spectra in chunks of 10: the last chunk (3) is below n_components
+    chunk_source, channels = make_chunks(23, 10)
+    loadings, scores, pca = spectrum_pca.incremental_spectrum_pca(
+        chunk_source, n_components=5)
+    assert len(scores) == 23
+    assert pca.n_samples_seen_ == 23
+    assert loadings.shape == (64, 5)
+
+
+def test_pca_with_short_first_chunk():
+    chunk_source, channels = make_chunks(12, 3)
+    loadings, scores, pca = spectrum_pca.incremental_spectrum_pca(
+        chunk_source, n_components=5)
+    assert pca.n_samples_seen_ == 12
+
+
+@pytest.mark.parametrize('poisson_scaling', [True, False])
+def test_chunk_released_before_next_is_read(poisson_scaling):
+    chunk_source, channels = make_chunks(47, 10)
+    alive = []
+
+    def tracked_source():
+        previous = None
+        for stack in chunk_source():
+            alive.append(previous is not None and previous() is not None)
+            previous = weakref.ref(stack)
+            yield stack
+            del stack
+    loadings, scores, pca = spectrum_pca.incremental_spectrum_pca(
+        tracked_source, n_components=5, poisson_scaling=poisson_scaling)
+    assert len(alive) == (3 if poisson_scaling else 2)*5
+    assert not any(alive)
+    assert pca.n_samples_seen_ == 47
+
+
+def test_pca_too_few_spectra():
+    chunk_source, channels = make_chunks(3, 10)
+    with pytest.raises(ValueError):
+        spectrum_pca.incremental_spectrum_pca(chunk_source, n_components=5)
+
+
+def test_scores_to_grid_skips_points_without_grid():
+    scores = pd.DataFrame({'row': [0, 0, 1, -1], 'col': [0, 1, 1, -1],
+                           'PC 1': [1.0, 2.0, 3.0, 4.0]})
+    grid = spectrum_pca.scores_to_grid(scores)
+    assert grid.shape == (2, 2)
+    assert grid[0, 1] == 2.0 and grid[1, 1] == 3.0
+    assert np.isnan(grid[1, 0])
+
+
+def test_scores_to_grid_without_any_grid():
+    scores = pd.DataFrame({'row': [-1, -1], 'col': [-1, -1],
+                           'PC 1': [1.0, 2.0]})
+    with pytest.raises(ValueError):
+        spectrum_pca.scores_to_grid(scores)
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""tests of the preprocessing pipeline against the spectra_fit stages"""
+import os
+import numpy as np
+import pytest
+import bruker_io as bruker_io
+import spectrum_evaluation as spectrum_evaluation
+import spectrum_pipeline as spectrum_pipeline
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SPX_FILE = (ROOT + '/M4_measurements/SRM_1831_300s_20x20/'
+            'SRM_1831_300s_20x20det_1_0_0.spx')
+
+
+@pytest.fixture(scope='module')
+def spectra():
+    """raw spectrum and its legacy pile-up/SCALEDSNIP/polycap preprocessing"""
+    spx = bruker_io.FittingData(SPX_FILE)
+    bruker_io.bruker_spx_import(spx)
+    raw = spx.channels.copy()
+    spectrum_evaluation.pulse_pileup_removal(spx)
+    spectrum_evaluation.SCALEDSNIP(spx)
+    spectrum_evaluation.polycap_remove(spx)
+    return raw, spx
+
+
+def run(pipeline, raw, spx):
+    return pipeline.run_spectrum(raw, spx.energy_scale, spx.life_time_in_ms,
+                                 spx.shaping_time, spx.calibration_abs,
+                                 spx.calibration_lin)
+
+
+def test_default_pipeline_matches_spectra_fit(spectra):
+    raw, spx = spectra
+    assert np.array_equal(run(spectrum_pipeline.default_pipeline(), raw, spx),
+                          spx.channels)
+
+
+def test_float_pipeline_keeps_fractional_counts(spectra):
+    # without the truncation of spectra_fit the net counts differ by at most
+    # a few counts per channel
+    raw, spx = spectra
+    channels = run(spectrum_pipeline.default_pipeline(whole_counts=False),
+                   raw, spx)
+    difference = np.abs(channels - spx.channels)
+    assert 0 < difference.max() < 3
+    assert abs(channels.sum() - spx.channels.sum()) < 1e-3*spx.channels.sum()
+
+
+def test_stage_cache_keeps_to_its_byte_budget():
+    cache = spectrum_pipeline.StageCache(max_bytes=3*4096*8)
+    for i in range(5):
+        cache.put(str(i), np.full(4096, float(i)))
+    assert len(cache) == 3
+    assert cache.nbytes == 3*4096*8
+    assert '0' not in cache and '4' in cache
+    assert spectrum_pipeline.SpectrumPipeline([]).cache.max_bytes == \
+        spectrum_pipeline.MAX_CACHE_BYTES